@@ -29,76 +29,174 @@
 '''
 
 # cross-platform non-blocking console IO
+#
+# The input thread sleeps in the OS until a key is pressed (or until kill() is
+#   called), so it costs nothing while the program is idle.  Characters are
+#   handed to other threads through a deque, which is safe to append to and
+#   pop from concurrently without extra locking.
 
+import os
 import sys
+import errno
 import threading
 import platform
+import collections
 
 if ( platform.system() == 'Windows'):
     import msvcrt
 else:
     import tty, termios, select
 
+# How often to check the keyboard on Windows, where we can't block on the
+#   console and a wakeup channel at the same time.
+WINDOWS_POLL_INTERVAL = 0.05
+
 class TermInput ( threading.Thread ):
 
     def __init__(self):
-        self._eventQueue = []
+        threading.Thread.__init__ ( self, name="TermInput" )
+        self.daemon = True
+        self._eventQueue = collections.deque()
+        self._notifyCallbacks = []
+        self._charAvailable = threading.Condition(threading.Lock())
         self._done = threading.Event()
         self._done.clear()
-        self.deamon = True
-        threading.Thread.__init__ ( self )
+        
+        # kill() writes to this pipe to wake the input thread out of select().
+        self._wakeLock = threading.Lock()
+        if ( platform.system() == 'Windows'):
+            self._wakeRead = None
+            self._wakeWrite = None
+        else:
+            (self._wakeRead, self._wakeWrite) = os.pipe()
     
     # Returns the least recent character or control code entered on sys.stdin
     #   (this is the same as the order in which the user enters them).
     # If the there are no new characters since the last call to popChar(),
     #   then 0 (the null character) will be returned.
     def popChar(self):
-        if len(self._eventQueue) > 0:
-            return self._eventQueue.pop(0)
-        else:
+        try:
+            return self._eventQueue.popleft()
+        except IndexError:
             return '\0'
+    
+    # Like popChar(), but blocks until a character arrives or until timeout
+    #   seconds have passed.  A timeout of None waits forever.
+    # Returns 0 (the null character) if the timeout expired.
+    def waitChar(self, timeout=None):
+        self._charAvailable.acquire()
+        try:
+            if len(self._eventQueue) == 0 and not self._done.isSet():
+                self._charAvailable.wait(timeout)
+        finally:
+            self._charAvailable.release()
+        
+        return self.popChar()
+
+    # Registers func() to be called from the input thread whenever a character
+    #   is queued.  This lets an event loop sleep until there is input instead
+    #   of polling popChar().  The callback should not block.
+    def addNotifyCallback(self, func):
+        self._notifyCallbacks.append(func)
 
     # Used to push a character into the character queue.  This is mostly for
     #  internal use, but can be called as a way to emulate input being placed
     #  on sys.stdin.
     def pushChar(self,ch):
-        self._eventQueue.append(ch)
+        self._charAvailable.acquire()
+        try:
+            self._eventQueue.append(ch)
+            self._charAvailable.notifyAll()
+        finally:
+            self._charAvailable.release()
+        
+        for func in self._notifyCallbacks:
+            func()
 
     # Execute this to start looping.
     def run ( self ):
         
-        self._done.clear()
-        
-        if ( platform.system() == 'Windows'):
-            while not self._done.isSet():
-                # We use kbhit() to see if anything has been entered yet.
-                # This is important, because if we don't then we will block
-                #   on getch() and be unable to tell when _done.isSet().
-                if msvcrt.kbhit(): 
-                    self.pushChar(msvcrt.getch())
-        else:
-            ''' we're not on Windows, so we try the Unix-like approach '''
+        try:
+            if ( platform.system() == 'Windows'):
+                self._runWindows()
+            else:
+                self._runUnix()
+        finally:
+            self._wakeLock.acquire()
+            for fd in (self._wakeRead, self._wakeWrite):
+                if fd != None:
+                    os.close(fd)
+            self._wakeRead = None
+            self._wakeWrite = None
+            self._wakeLock.release()
+    
+    def _runWindows(self):
+        while not self._done.isSet():
+            # We use kbhit() to see if anything has been entered yet.
+            # This is important, because if we don't then we will block
+            #   on getch() and be unable to tell when _done.isSet().
+            while msvcrt.kbhit():
+                self.pushChar(msvcrt.getch())
             
-            fd = sys.stdin.fileno( )
-            old_settings = termios.tcgetattr(sys.stdin)
-            try:
+            self._done.wait(WINDOWS_POLL_INTERVAL)
+    
+    def _runUnix(self):
+        ''' we're not on Windows, so we try the Unix-like approach '''
+        
+        fd = sys.stdin.fileno( )
+        
+        # Headless machines may run us with stdin redirected from somewhere
+        #   that isn't a terminal.  There's no line discipline to change then.
+        old_settings = None
+        if os.isatty(fd):
+            old_settings = termios.tcgetattr(fd)
+        
+        try:
+            if old_settings != None:
                 tty.setcbreak(fd)
+            
+            watched = [fd, self._wakeRead]
+            while not self._done.isSet():
+                # Sleep until there is input or until kill() wakes us.
+                # Reading stdin directly would block without any way to
+                #   notice when _done.isSet().
+                try:
+                    (readable, dummy, dummy) = select.select(watched, [], [])
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
                 
-                while not self._done.isSet():
-                    # We use _isData() to see if anything has been entered yet.
-                    # This is important, because if we don't then we will block
-                    #   on stdin.read() and be unable to tell when _done.isSet().
-                    if _isData():
-                        self.pushChar(sys.stdin.read(1))
-                    
-            finally:
+                if self._wakeRead in readable:
+                    break
+                
+                if fd in readable:
+                    # Read from the descriptor rather than sys.stdin so that
+                    #   Python's buffering can't hide characters from select().
+                    chars = os.read(fd, 64)
+                    if len(chars) == 0:
+                        # End of input.  Nothing more will ever arrive, so
+                        #   just wait around for kill().
+                        watched = [self._wakeRead]
+                    for ch in chars:
+                        self.pushChar(ch)
+            
+        finally:
+            if old_settings != None:
                 termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
     # Kill yourself.
     def kill(self):
         self._done.set() # I'm done for!
-
-
-# Used to find out if there is data to read on stdin on linux/unix/etc.
-def _isData():
-    return select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], [])
+        
+        self._wakeLock.acquire()
+        try:
+            if self._wakeWrite != None:
+                os.write(self._wakeWrite, 'x')
+        finally:
+            self._wakeLock.release()
+        
+        # Release anyone stuck in waitChar().
+        self._charAvailable.acquire()
+        self._charAvailable.notifyAll()
+        self._charAvailable.release()
@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Spectral analysis of recorded raw waveforms.
+#
+# The Zeo reports the power in seven frequency bands every second (the
+#   spectrogram files), but the raw waveforms it sends along with them are
+#   only ever stored.  This works out the same band powers from a recorded
+#   raw file, so they can be checked against what the Zeo reported, and can
+#   also write a finer spectrogram with a column for every FFT frequency.
+#
+# Each output row comes from a window of the last few one second slices
+#   (2 seconds by default), with a Hann window and the mean taken out, and
+#   has the timestamp of the window's last slice.  Windows that span a gap
+#   in the recording are skipped.  Band powers are in uV^2, summed over the
+#   FFT frequencies f with low <= f < high; --relative divides them by their
+#   total instead, which is closer to what the Zeo reports.
+#
+# numpy does the work a few thousand slices at a time, so a whole night
+#   takes seconds.  Uncompressed .bin files are memory-mapped rather than
+#   read.
+#
+#   python bandpower.py raw.csv -o computed_spectrogram.csv \
+#       [--fine fine.csv] [--compare spectrogram.csv]
+#
+# The band output is written like a spectrogram file (.csv, .bin, and
+#   compressed versions of either), so anything that reads those reads it.
+
+import os
+import sys
+import csv
+import time
+from optparse import OptionParser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from common import *
+from binformat import BIN_EXTENSION, readHeader, recordDtype
+from compressedio import codecForPath, stripCodecExtension, BlockCompressedFile
+from timeindex import readTimeRange, zeoTime
+from replay import replayDataType, ReplayError
+from rowwriter import openSink
+from sleepconfig import RecordingSection
+from termcolor import colored
+
+SAMPLE_RATE = 128      # Hz
+SAMPLES_PER_SLICE = 128
+
+# How many slices to work on at once.
+DEFAULT_CHUNK_SLICES = 4096
+
+DEFAULT_WINDOW_SLICES = 2
+
+# The Zeo's bands, as (low Hz, high Hz), in FREQUENCY_BINS order.
+BANDS = [tuple(float(edge) for edge in name.split('-')) for name in FREQUENCY_BINS]
+
+class AnalysisError(ValueError):
+    ''' A file can't be analysed, or the analysis can't be done as asked. '''
+    pass
+
+def _requireNumpy():
+    if numpy == None:
+        raise AnalysisError("Spectral analysis needs numpy, which isn't installed.")
+
+# A piece of a raw recording, as numpy arrays with one entry per slice:
+#   epochTimes, versions, sqis, impedances (-1 where not given), badSignals
+#   (booleans), and samples, which is slices by SAMPLES_PER_SLICE.
+class RawChunk:
+    def __init__(self, epochTimes, versions, sqis, impedances, badSignals, samples):
+        self.epochTimes = epochTimes
+        self.versions = versions
+        self.sqis = sqis
+        self.impedances = impedances
+        self.badSignals = badSignals
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.epochTimes)
+
+# Yields the slices of a recorded raw file as RawChunks of up to chunkSlices
+#   slices.
+def readRawChunks(path, chunkSlices=DEFAULT_CHUNK_SLICES):
+    _requireNumpy()
+    if replayDataType(path) != DATA_RAW:
+        raise AnalysisError(path+" is not a raw waveform recording.")
+
+    isBin = stripCodecExtension(path).endswith(BIN_EXTENSION)
+    if isBin and codecForPath(path) == None:
+        for chunk in _mappedChunks(path, chunkSlices):
+            yield chunk
+        return
+
+    records = []
+    for row in readTimeRange(path, -(1 << 62), 1 << 62):
+        if not isBin:
+            row = _csvRecord(row)
+        if len(row[5]) != SAMPLES_PER_SLICE:
+            continue
+        records.append(row)
+        if len(records) == chunkSlices:
+            yield _chunkOf(records)
+            records = []
+    if len(records) > 0:
+        yield _chunkOf(records)
+
+def _mappedChunks(path, chunkSlices):
+    fileObj = open(path, 'rb')
+    try:
+        header = readHeader(fileObj)
+    finally:
+        fileObj.close()
+    if header.nValues != SAMPLES_PER_SLICE:
+        raise AnalysisError(path+" has "+str(header.nValues)+
+            " samples per slice, not "+str(SAMPLES_PER_SLICE)+".")
+
+    nRecords = (os.path.getsize(path) - header.headerSize) // header.recordSize
+    if nRecords == 0:
+        return
+    records = numpy.memmap(path, dtype=numpy.dtype(recordDtype(header)),
+        mode='r', offset=header.headerSize, shape=(nRecords,))
+    for start in xrange(0, nRecords, chunkSlices):
+        part = records[start : start + chunkSlices]
+        yield RawChunk(numpy.array(part['epochTime'], dtype=numpy.int64),
+            numpy.array(part['version']), numpy.array(part['sqi']),
+            numpy.array(part['impedance']), part['badSignal'] != 0,
+            numpy.array(part['values'], dtype=numpy.float64))
+
+def _optionalInt(text):
+    if text == '--' or text == '':
+        return -1
+    return int(float(text))
+
+# Turns a raw CSV row into the fields of a .bin record.
+def _csvRecord(row):
+    return (zeoTime(row[0]), int(row[1]), _optionalInt(row[2]),
+        _optionalInt(row[3]), row[4] == 'Y', row[5:])
+
+def _chunkOf(records):
+    columns = zip(*records)
+    return RawChunk(numpy.array(columns[0], dtype=numpy.int64),
+        numpy.array(columns[1]), numpy.array(columns[2]),
+        numpy.array(columns[3]), numpy.array(columns[4], dtype=bool),
+        numpy.array(columns[5], dtype=numpy.float64))
+
+# The results for a RawChunk: epochTimes, versions, sqis, impedances and
+#   badSignals for each row, as in RawChunk, plus bands (rows by len(BANDS))
+#   and, if asked for, fine (rows by len(frequencies)).
+class SpectrumChunk:
+    def __init__(self, raw, rows, bands, fine):
+        self.epochTimes = raw.epochTimes[rows]
+        self.versions = raw.versions[rows]
+        self.sqis = raw.sqis[rows]
+        self.impedances = raw.impedances[rows]
+        self.badSignals = raw.badSignals[rows]
+        self.bands = bands
+        self.fine = fine
+
+    def __len__(self):
+        return len(self.epochTimes)
+
+# Works out band powers, and optionally a fine spectrogram, for RawChunks
+#   given to it in time order.  The last few slices of each chunk are kept
+#   so that windows can span chunks.
+class SpectralAnalyzer:
+
+    # windowSlices is how many one second slices go into each FFT.  The fine
+    #   spectrogram has the FFT frequencies below fineMaxHz, or none if
+    #   fineMaxHz is None.  If relative is True, band powers are divided by
+    #   their total.
+    def __init__(self, windowSlices=DEFAULT_WINDOW_SLICES, fineMaxHz=None,
+                 relative=False):
+        _requireNumpy()
+        if windowSlices < 1:
+            raise AnalysisError("The window has to be at least one slice long.")
+        self.windowSlices = windowSlices
+        self.relative = relative
+
+        size = windowSlices * SAMPLES_PER_SLICE
+        self.window = numpy.hanning(size)
+        self.frequencies = numpy.fft.rfftfreq(size, 1.0 / SAMPLE_RATE)
+        step = self.frequencies[1]
+
+        # One sided power spectral density times the frequency step, so that
+        #   summing over frequencies gives power in uV^2.
+        self.scale = 2.0 / (SAMPLE_RATE * numpy.sum(self.window ** 2)) * step
+
+        # bandMatrix[f, b] is 1 if frequency f is in band b.
+        self.bandMatrix = numpy.zeros((len(self.frequencies), len(BANDS)))
+        for (b, (low, high)) in enumerate(BANDS):
+            self.bandMatrix[:, b] = (self.frequencies >= low) & (self.frequencies < high)
+
+        self.fineMaxHz = fineMaxHz
+        self.fineColumns = numpy.arange(0)
+        if fineMaxHz != None:
+            self.fineColumns = numpy.nonzero(self.frequencies < fineMaxHz)[0]
+
+        self._carry = None
+
+    def fineFrequencies(self):
+        return self.frequencies[self.fineColumns]
+
+    # Returns a SpectrumChunk for the windows that end in this chunk.
+    def process(self, raw):
+        if self._carry != None:
+            raw = RawChunk(*[numpy.concatenate((old, new)) for (old, new) in
+                zip(self._fields(self._carry), self._fields(raw))])
+        w = self.windowSlices
+        self._carry = RawChunk(*[field[-(w - 1):] if w > 1 else field[:0]
+                                 for field in self._fields(raw)])
+
+        n = len(raw) - w + 1
+        if n <= 0:
+            fine = None
+            if self.fineMaxHz != None:
+                fine = numpy.zeros((0, len(self.fineColumns)))
+            return SpectrumChunk(raw, numpy.arange(0), numpy.zeros((0, len(BANDS))),
+                fine)
+
+        # Only windows of back to back slices.
+        ends = numpy.arange(w - 1, len(raw))
+        rows = ends[raw.epochTimes[ends] - raw.epochTimes[ends - (w - 1)] == w - 1]
+
+        # Each row of windows is w consecutive slices laid end to end.
+        windows = numpy.concatenate([raw.samples[rows - (w - 1) + k] for k in xrange(w)],
+            axis=1)
+        windows -= windows.mean(axis=1)[:, numpy.newaxis]
+        spectrum = numpy.fft.rfft(windows * self.window, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+
+        bands = power.dot(self.bandMatrix)
+        if self.relative:
+            totals = bands.sum(axis=1)
+            totals[totals == 0.0] = 1.0
+            bands /= totals[:, numpy.newaxis]
+
+        fine = None
+        if self.fineMaxHz != None:
+            fine = power[:, self.fineColumns]
+        return SpectrumChunk(raw, rows, bands, fine)
+
+    def _fields(self, raw):
+        return (raw.epochTimes, raw.versions, raw.sqis, raw.impedances,
+                raw.badSignals, raw.samples)
+
+# The first five columns of a spectrogram row.
+def _rowPrefix(spectrum, i):
+    epochTime = int(spectrum.epochTimes[i])
+    sqi = int(spectrum.sqis[i])
+    impedance = int(spectrum.impedances[i])
+    return [time.strftime(ZEO_TIMESTAMP_FORMAT, time.gmtime(epochTime)),
+            int(spectrum.versions[i]), sqi < 0 and '--' or sqi,
+            impedance < 0 and '--' or impedance,
+            spectrum.badSignals[i] and 'Y' or 'N']
+
+# Writes the fine spectrogram as CSV, plain or compressed.
+class FineSpectrogramWriter:
+    def __init__(self, path, frequencies):
+        codec = codecForPath(path)
+        if codec != None:
+            self.fstream = BlockCompressedFile(path, codec)
+        else:
+            self.fstream = open(path, 'wb')
+        self.writer = csv.writer(self.fstream)
+        self.writer.writerow(getHeader(DATA_SGRAM)[:5] +
+            ["%g Hz" % frequency for frequency in frequencies])
+
+    def write(self, spectrum):
+        for i in xrange(len(spectrum)):
+            self.writer.writerow(_rowPrefix(spectrum, i) + spectrum.fine[i].tolist())
+
+    def close(self):
+        self.fstream.close()
+
+# Reads the bands of a spectrogram file into (epoch times, bands) arrays.
+def readSpectrogram(path):
+    _requireNumpy()
+    if replayDataType(path) != DATA_SGRAM:
+        raise AnalysisError(path+" is not a spectrogram recording.")
+    isBin = stripCodecExtension(path).endswith(BIN_EXTENSION)
+    times = []
+    bands = []
+    for row in readTimeRange(path, -(1 << 62), 1 << 62):
+        if isBin:
+            times.append(row[0])
+            bands.append(row[5])
+        else:
+            times.append(zeoTime(row[0]))
+            bands.append([float(value) for value in row[5:]])
+    return (numpy.array(times, dtype=numpy.int64),
+            numpy.array(bands, dtype=numpy.float64).reshape((-1, len(BANDS))))
+
+# Lines up computed and reported band powers by time.  Returns (number of
+#   rows matched, [(band name, correlation, median ratio of computed to
+#   reported)]).
+def compareBands(times, bands, reportedTimes, reportedBands):
+    (common, mine, theirs) = numpy.intersect1d(times, reportedTimes,
+        assume_unique=False, return_indices=True)
+    results = []
+    for (b, name) in enumerate(FREQUENCY_BINS):
+        computed = bands[mine, b]
+        reported = reportedBands[theirs, b]
+        correlation = float('nan')
+        if len(common) > 1 and computed.std() > 0 and reported.std() > 0:
+            correlation = float(numpy.corrcoef(computed, reported)[0, 1])
+        nonzero = reported != 0
+        ratio = float('nan')
+        if nonzero.any():
+            ratio = float(numpy.median(computed[nonzero] / reported[nonzero]))
+        results.append((name, correlation, ratio))
+    return (len(common), results)
+
+def parseCommandLine(argv):
+    parser = OptionParser(usage="%prog [options] RAW_FILE...")
+    parser.add_option("-o", "--output", metavar="FILE",
+        help="Write the band powers to FILE as a spectrogram file (.csv, .bin, "+
+             "or either compressed).")
+    parser.add_option("--fine", metavar="FILE",
+        help="Write the power at every FFT frequency to FILE as CSV.")
+    parser.add_option("--fine-max-hz", type="float", default=SAMPLE_RATE / 2.0 + 1.0,
+        metavar="HZ", help="Leave frequencies at or above HZ out of --fine.")
+    parser.add_option("--window", type="int", default=DEFAULT_WINDOW_SLICES,
+        metavar="SECONDS", help="Seconds of waveform in each FFT (default "+
+        str(DEFAULT_WINDOW_SLICES)+").")
+    parser.add_option("--relative", action="store_true", default=False,
+        help="Give each band's share of the total instead of uV^2.")
+    parser.add_option("--compare", metavar="FILE",
+        help="Compare the band powers with the Zeo's, from spectrogram FILE.")
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) == 0:
+        parser.error("Give one or more raw recordings.")
+    if options.output == None and options.fine == None and options.compare == None:
+        parser.error("Nothing to do; give -o, --fine or --compare.")
+    for path in (options.output, options.fine):
+        if path != None and os.path.exists(path):
+            parser.error(path+" already exists.")
+    return (options, args)
+
+def main(argv):
+    (options, args) = parseCommandLine(argv)
+    if numpy == None:
+        print colored("bandpower.py needs numpy, which isn't installed.", 'red', attrs=['bold'])
+        sys.exit(1)
+
+    try:
+        analyse(options, args)
+    except (AnalysisError, ReplayError, EnvironmentError) as e:
+        print colored(str(e), 'red', attrs=['bold'])
+        sys.exit(1)
+
+def analyse(options, args):
+    # Before any output files are made.
+    for path in args:
+        if replayDataType(path) != DATA_RAW:
+            raise AnalysisError(path+" is not a raw waveform recording.")
+    if options.compare != None and replayDataType(options.compare) != DATA_SGRAM:
+        raise AnalysisError(options.compare+" is not a spectrogram recording.")
+
+    started = time.time()
+    fineMaxHz = None
+    if options.fine != None:
+        fineMaxHz = options.fine_max_hz
+    analyzer = SpectralAnalyzer(options.window, fineMaxHz, options.relative)
+
+    sink = None
+    if options.output != None:
+        sink = openSink(os.path.abspath(options.output), DATA_SGRAM, RecordingSection())
+    fineWriter = None
+    if options.fine != None:
+        fineWriter = FineSpectrogramWriter(options.fine, analyzer.fineFrequencies())
+
+    nSlices = 0
+    nRows = 0
+    times = []
+    bands = []
+    try:
+        for path in args:
+            for raw in readRawChunks(path):
+                nSlices += len(raw)
+                spectrum = analyzer.process(raw)
+                nRows += len(spectrum)
+                if sink != None:
+                    for i in xrange(len(spectrum)):
+                        sink.write(_rowPrefix(spectrum, i) + spectrum.bands[i].tolist(),
+                                   int(spectrum.epochTimes[i]))
+                if fineWriter != None:
+                    fineWriter.write(spectrum)
+                if options.compare != None:
+                    times.append(spectrum.epochTimes)
+                    bands.append(spectrum.bands)
+    finally:
+        if sink != None:
+            sink.close()
+        if fineWriter != None:
+            fineWriter.close()
+
+    print "Analysed "+str(nSlices)+" slices into "+str(nRows)+" rows in "+\
+        ("%.1f" % (time.time() - started))+" seconds."
+
+    if options.compare != None:
+        (reportedTimes, reportedBands) = readSpectrogram(options.compare)
+        (matched, results) = compareBands(
+            numpy.concatenate(times or [numpy.zeros(0, dtype=numpy.int64)]),
+            numpy.concatenate(bands or [numpy.zeros((0, len(BANDS)))]),
+            reportedTimes, reportedBands)
+        print ""
+        print "Compared with "+colored(options.compare, 'green', attrs=['bold'])+\
+            " over "+str(matched)+" matching seconds:"
+        print "%10s %12s %14s" % ("band (Hz)", "correlation", "median ratio")
+        for (name, correlation, ratio) in results:
+            print "%10s %12.3f %14.4g" % (name, correlation, ratio)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Benchmarks for the recording hot path.
+#
+#   python benchmark.py [options]
+#
+# Each benchmark runs the same synthetic night (see synthzeo.py) through one
+#   part of the pipeline and reports operations and rows per second, latency
+#   percentiles per operation, and how many objects each operation leaves
+#   behind.  Results can be written as JSON with --json, and a saved result
+#   can be compared against the current one with --compare:
+#
+#   python benchmark.py --json before.json
+#   (change things)
+#   python benchmark.py --compare before.json
+#
+# The output tables, their path templates and the file format are set from
+#   the command line; files are written to a temporary directory that is
+#   deleted afterwards.  For the benchmarks that write files, the total time
+#   (and so the rates) includes waiting for the writer thread to get every
+#   row to disk, while the latencies are what the serial link's thread sees.
+#
+# Python 2 has no tracemalloc, so "allocations" are the growth in the garbage
+#   collector's count of container objects (lists, dicts, tuples, ...) per
+#   operation, with collection turned off while timing as timeit does.  The
+#   peak resident set size of the whole process is reported as well.
+
+import os
+import gc
+import sys
+import imp
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from timeit import default_timer
+from optparse import OptionParser
+
+from common import *
+from sleepconfig import SleepConfig
+from slicedispatch import SliceDispatcher, freezeSlice
+from synthzeo import SyntheticZeo, FREQUENCY_BINS
+from termcolor import colored
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The pipeline classes live in the main script.
+_here = os.path.dirname(os.path.abspath(__file__))
+encabulator = imp.load_source('encabulator', os.path.join(_here, 'encabulator.pyw'))
+
+BENCHMARKS = ['context', 'calculatePath', 'outputRow', 'recordData', 'display',
+              'pipeline']
+
+# Path templates, by --template.
+TEMPLATES = {
+    'flat' : '%(dir)s/out%(n)d/%(name)s',
+    'date' : '%(dir)s/out%(n)d/%%Y-%%m-%%d/%(name)s',
+    'name' : '%(dir)s/out%(n)d/%%Y-%%m-%%d/%%NAME{core,nap1,nap2,nap3}/%(name)s',
+}
+
+# File names, by --format.
+FORMATS = {
+    'csv' : ('raw_samples.csv', 'spectrogram.csv'),
+    'bin' : ('raw_samples.bin', 'spectrogram.bin'),
+    'gz'  : ('raw_samples.csv.gz', 'spectrogram.csv.gz'),
+}
+
+_CONFIG_TEMPLATE = '''
+timespan_names
+    core =  0:00 - 10:00
+    nap1 = 10:00 - 14:00
+    nap2 = 14:00 - 20:00
+    nap3 = 20:00 - 24:00
+end
+
+recording
+    flush_rows = 256
+    flush_ms = 1000
+    flush_on_epoch = yes
+end
+'''
+
+_OUTPUT_TEMPLATE = '''
+output
+    raw =         "%(raw)s"
+    spectrogram = "%(sgram)s"
+    hypnogram =   "%(hgram)s"
+    events =      "%(events)s"
+end
+'''
+
+# Writes a config file for the benchmark into directory and returns its path.
+def writeConfig(directory, nTables, template, fileFormat):
+    text = _CONFIG_TEMPLATE % {'dir' : directory}
+    (rawName, sgramName) = FORMATS[fileFormat]
+    for n in xrange(nTables):
+        def path(name):
+            return TEMPLATES[template] % {'dir' : directory, 'n' : n, 'name' : name}
+        text += _OUTPUT_TEMPLATE % {
+            'raw'    : path(rawName),
+            'sgram'  : path(sgramName),
+            'hgram'  : path('hypnogram.csv'),
+            'events' : path('events.csv'),
+            }
+
+    configPath = os.path.join(directory, 'benchmark.conf')
+    configFile = open(configPath, 'w')
+    configFile.write(text)
+    configFile.close()
+    return configPath
+
+# Collects per-operation timings for one benchmark.
+class Measurement:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.rows = 0
+        self.total = 0.0
+        self.gcObjects = 0
+        self._gcStart = None
+
+    def start(self):
+        gc.collect()
+        gc.disable()
+        self._gcStart = gc.get_count()[0]
+        self._wallStart = default_timer()
+
+    def stop(self):
+        self.total = default_timer() - self._wallStart
+        self.gcObjects = gc.get_count()[0] - self._gcStart
+        gc.enable()
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def percentile(q):
+            if count == 0:
+                return 0.0
+            return latencies[min(count - 1, int(q * count))] * 1e6
+
+        result = {
+            'operations'      : count,
+            'seconds'         : self.total,
+            'opsPerSecond'    : count / self.total if self.total > 0 else 0.0,
+            'rows'            : self.rows,
+            'rowsPerSecond'   : self.rows / self.total if self.total > 0 else 0.0,
+            'p50us'           : percentile(0.50),
+            'p90us'           : percentile(0.90),
+            'p99us'           : percentile(0.99),
+            'maxus'           : percentile(1.0),
+            'gcObjectsPerOp'  : float(self.gcObjects) / count if count > 0 else 0.0,
+            }
+        return result
+
+class BenchmarkRun:
+
+    def __init__(self, options):
+        self.options = options
+        self.directory = tempfile.mkdtemp(prefix='encabulator-bench-')
+        self.configPath = writeConfig(self.directory, options.tables,
+            options.template, options.format)
+        self.config = SleepConfig(self.configPath)
+
+        zeo = SyntheticZeo(options.seed, options.bad_signal)
+        self.slices = [freezeSlice(slice) for slice in zeo.slices(options.slices)]
+
+    def close(self):
+        if self.options.keep:
+            print "Output kept in "+colored(self.directory, 'green')
+        else:
+            shutil.rmtree(self.directory, True)
+
+    def _newOutput(self, context):
+        output = encabulator.ZeoToCSV(self.config, context)
+        output.writer.blockWhenFull = True
+        return output
+
+    def _time(self, measurement, func, *args):
+        start = default_timer()
+        func(*args)
+        measurement.latencies.append(default_timer() - start)
+
+    def benchContext(self, m):
+        context = encabulator.SleepContext()
+        m.start()
+        for slice in self.slices:
+            self._time(m, context.updateSlice, slice)
+        m.stop()
+        context.close()
+
+    def benchCalculatePath(self, m):
+        tables = self.config.outputTables
+        index = self.config.timespanIndex
+        m.start()
+        for slice in self.slices:
+            for table in tables:
+                self._time(m, table.calculatePath, DATA_RAW, slice.timeStruct, index)
+        m.stop()
+
+    def benchOutputRow(self, m):
+        context = encabulator.SleepContext()
+        output = self._newOutput(context)
+        nTables = len(self.config.outputTables)
+        m.start()
+        for slice in self.slices:
+            if len(slice['Waveform']) == 0:
+                continue
+            row = [slice['ZeoTimestamp'], slice['Version'], '30', '500', 'N'] + \
+                list(slice['Waveform'])
+            for index in xrange(nTables):
+                self._time(m, output._outputRowOnDestIndex, DATA_RAW, index, row,
+                    slice.timeStruct, slice.epochTime)
+        output.close()
+        m.stop()
+        m.rows = output.writer.rowsWritten
+        context.close()
+
+    def benchRecordData(self, m):
+        context = encabulator.SleepContext()
+        output = self._newOutput(context)
+        m.start()
+        for slice in self.slices:
+            context.updateSlice(slice)
+            self._time(m, output.updateSlice, slice)
+        output.close()
+        m.stop()
+        m.rows = output.writer.rowsWritten
+        context.close()
+
+    def benchDisplay(self, m):
+        context = encabulator.SleepContext()
+        output = self._newOutput(context)
+        m.start()
+        for slice in self.slices:
+            context.updateSlice(slice)
+            if slice['SleepStage'] != None:
+                self._time(m, output.displaySleepState)
+        m.stop()
+        output.close()
+        context.close()
+
+    # Everything the serial link's thread does for a slice, and the time it
+    #   takes the writer to get it all to disk.
+    def benchPipeline(self, m):
+        context = encabulator.SleepContext()
+        trainer = encabulator.NapTrainer(context, self.config)
+        trainer.runAlarms = False
+        output = self._newOutput(context)
+        dispatcher = SliceDispatcher()
+        dispatcher.addConsumer(context)
+        dispatcher.addConsumer(trainer)
+        dispatcher.addConsumer(output)
+        m.start()
+        for slice in self.slices:
+            self._time(m, dispatcher.updateSlice, slice)
+        output.close()
+        m.stop()
+        m.rows = output.writer.rowsWritten
+        context.close()
+
+    def run(self, names):
+        results = {}
+        for name in names:
+            method = getattr(self, 'bench' + name[0].upper() + name[1:])
+            m = Measurement(name)
+            # The sleep stage display prints; keep it off the terminal.
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                method(m)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            results[name] = m.result()
+        return results
+
+def _gitCommit():
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=_here, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0].strip()
+        if process.returncode == 0:
+            return output
+    except OSError:
+        pass
+    return None
+
+def _maxRssKb():
+    if resource == None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        rss //= 1024 # Bytes there, kilobytes everywhere else.
+    return rss
+
+def printResults(report):
+    print ""
+    print "%-14s %10s %10s %9s %9s %9s %9s %8s" % ("benchmark", "ops/s",
+        "rows/s", "p50 us", "p90 us", "p99 us", "max us", "objs/op")
+    for name in BENCHMARKS:
+        result = report['results'].get(name)
+        if result == None:
+            continue
+        print "%-14s %10.0f %10.0f %9.1f %9.1f %9.1f %9.1f %8.2f" % (name,
+            result['opsPerSecond'], result['rowsPerSecond'], result['p50us'],
+            result['p90us'], result['p99us'], result['maxus'],
+            result['gcObjectsPerOp'])
+    if report['maxRssKb'] != None:
+        print ""
+        print "Peak resident set size: "+str(report['maxRssKb'])+" KB"
+
+# Prints how the results changed relative to an older report.  Changes of
+#   more than threshold (a fraction) are highlighted.
+def printComparison(old, new, threshold=0.10):
+    print ""
+    print "Compared to "+colored(str(old.get('commit')), 'green')+\
+        " from "+str(old.get('date'))+":"
+    print "%-14s %12s %12s" % ("benchmark", "ops/s", "p99 us")
+    for name in BENCHMARKS:
+        if name not in old['results'] or name not in new['results']:
+            continue
+        before = old['results'][name]
+        after = new['results'][name]
+
+        def change(key, higherIsBetter):
+            if before[key] <= 0:
+                return "%12s" % "--"
+            ratio = after[key] / before[key] - 1.0
+            text = "%+11.1f%%" % (ratio * 100.0)
+            if higherIsBetter:
+                ratio = -ratio
+            if ratio > threshold:
+                return colored(text, 'red', attrs=['bold'])
+            if ratio < -threshold:
+                return colored(text, 'green', attrs=['bold'])
+            return text
+
+        print "%-14s %s %s" % (name, change('opsPerSecond', True),
+            change('p99us', False))
+
+def parseCommandLine(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--slices", type="int", default=3600,
+        help="Seconds of synthetic data to run through each benchmark.")
+    parser.add_option("--tables", type="int", default=1,
+        help="Number of output sections.")
+    parser.add_option("--template", choices=sorted(TEMPLATES.keys()),
+        default="name", help="Output path template: flat, date, or name "+
+        "(dates and %NAME{} timespans, the default).")
+    parser.add_option("--format", choices=sorted(FORMATS.keys()), default="csv",
+        help="Raw and spectrogram file format: csv, bin or gz.")
+    parser.add_option("--bad-signal", type="float", default=0.05,
+        help="Fraction of epochs with a bad signal.")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--only", action="append", choices=BENCHMARKS,
+        help="Run just this benchmark.  Can be given more than once.")
+    parser.add_option("--json", metavar="FILE",
+        help="Write the results to FILE as JSON ('-' for standard output).")
+    parser.add_option("--compare", metavar="FILE",
+        help="Compare the results against an earlier --json file.")
+    parser.add_option("--keep", action="store_true", default=False,
+        help="Keep the files that were written.")
+    (options, args) = parser.parse_args(argv)
+    if options.slices < 1 or options.tables < 1:
+        parser.error("--slices and --tables must be at least 1.")
+    return options
+
+def main(argv):
+    options = parseCommandLine(argv)
+
+    run = BenchmarkRun(options)
+    try:
+        results = run.run(options.only or BENCHMARKS)
+    finally:
+        run.close()
+
+    report = {
+        'date'       : time.strftime("%Y-%m-%d %H:%M:%S"),
+        'commit'     : _gitCommit(),
+        'python'     : platform.python_version(),
+        'platform'   : platform.platform(),
+        'parameters' : {
+            'slices'    : options.slices,
+            'tables'    : options.tables,
+            'template'  : options.template,
+            'format'    : options.format,
+            'badSignal' : options.bad_signal,
+            'seed'      : options.seed,
+            },
+        'maxRssKb'   : _maxRssKb(),
+        'results'    : results,
+        }
+
+    if options.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print ""
+    else:
+        printResults(report)
+        if options.json != None:
+            jsonFile = open(options.json, 'w')
+            json.dump(report, jsonFile, indent=2, sort_keys=True)
+            jsonFile.close()
+
+    if options.compare != None:
+        oldFile = open(options.compare, 'r')
+        old = json.load(oldFile)
+        oldFile.close()
+        if old.get('parameters') != report['parameters']:
+            print colored("The parameters differ from the earlier run's.", 'yellow')
+        printComparison(old, report)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# The binary recording format, used for output paths ending in .bin.
+#
+# Raw waveforms and spectrograms are most of what gets recorded, and as CSV
+#   text they are big and slow to write.  A .bin file holds the same rows as
+#   fixed-size little endian records after a small header, so it can be
+#   appended to, and read back with numpy.memmap() or the array module
+#   without parsing anything:
+#
+#   records = numpy.memmap(path, dtype=numpy.dtype(recordDtype(header)),
+#                          mode='r', offset=header.headerSize)
+#
+# Header, HEADER_SIZE bytes:
+#   8s  magic
+#   I   format version
+#   I   data type (DATA_RAW or DATA_SGRAM from common.py)
+#   I   values per record
+#   I   record size in bytes
+#   I   header size in bytes (the offset of the first record)
+#   the rest is zeros.
+#
+# Record:
+#   q   Zeo time of the slice, in epoch seconds (see ZeoTimeDecoder)
+#   i   Zeo version
+#   i   SQI, or -1 if not given
+#   i   impedance, or -1 if not given
+#   B   1 if the signal was bad, else 0
+#   3x  padding
+#   f * values per record: the samples (uV) or the frequency bins, in the
+#       same order as the CSV columns.
+
+import os
+import struct
+
+from common import *
+
+BIN_EXTENSION = ".bin"
+
+BIN_MAGIC   = b'PEBIN\0\0\0'
+BIN_VERSION = 1
+HEADER_FORMAT = '<8sIIIII'
+HEADER_SIZE = 64
+
+RECORD_PREFIX_FORMAT = '<qiiiB3x'
+RECORD_PREFIX_SIZE = struct.calcsize(RECORD_PREFIX_FORMAT)
+
+# The data types that can be written as .bin files.  The others have text in
+#   them.
+BIN_DATA_TYPES = (DATA_RAW, DATA_SGRAM)
+
+class BinFormatError(ValueError):
+    ''' A file is not a .bin recording, or doesn't match what was expected. '''
+    pass
+
+class BinHeader:
+    def __init__(self, dataType, nValues):
+        self.dataType = dataType
+        self.nValues = nValues
+        self.recordSize = RECORD_PREFIX_SIZE + 4 * nValues
+        self.headerSize = HEADER_SIZE
+
+    def pack(self):
+        header = struct.pack(HEADER_FORMAT, BIN_MAGIC, BIN_VERSION,
+            self.dataType, self.nValues, self.recordSize, self.headerSize)
+        return header + b'\0' * (HEADER_SIZE - len(header))
+
+# Reads the header from the start of an open file.
+def readHeader(fileObj):
+    fileObj.seek(0)
+    return parseHeader(fileObj.read(struct.calcsize(HEADER_FORMAT)))
+
+# Reads the header from the first bytes of a file.
+def parseHeader(data):
+    size = struct.calcsize(HEADER_FORMAT)
+    if len(data) < size:
+        raise BinFormatError("File is too short to be a .bin recording.")
+
+    (magic, version, dataType, nValues, recordSize, headerSize) = \
+        struct.unpack(HEADER_FORMAT, data[:size])
+    if magic != BIN_MAGIC:
+        raise BinFormatError("Not a .bin recording.")
+    if version != BIN_VERSION:
+        raise BinFormatError("Unsupported .bin version: "+str(version))
+
+    header = BinHeader(dataType, nValues)
+    if header.recordSize != recordSize or headerSize < HEADER_SIZE:
+        raise BinFormatError("Corrupt .bin header.")
+    header.headerSize = headerSize
+    return header
+
+# The struct format of a whole record.
+def recordFormat(header):
+    return RECORD_PREFIX_FORMAT + str(header.nValues) + 'f'
+
+# A numpy dtype description of a record.  Pass it to numpy.dtype().
+def recordDtype(header):
+    return [('epochTime', '<i8'), ('version', '<i4'), ('sqi', '<i4'),
+            ('impedance', '<i4'), ('badSignal', 'u1'), ('pad', 'V3'),
+            ('values', '<f4', (header.nValues,))]
+
+# Turns a row, as ZeoToCSV builds them, into a record.
+def packRecord(header, packer, row, epochTime):
+    (timestamp, version, sqi, impedance, badSignal) = row[:5]
+    values = row[5:]
+    if len(values) != header.nValues:
+        raise BinFormatError("Expected "+str(header.nValues)+" values in the row, got "+
+            str(len(values)))
+
+    return packer.pack(epochTime, _intOr(version, 0), _intOr(sqi, -1),
+        _intOr(impedance, -1), int(badSignal == 'Y'), *values)
+
+def _intOr(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+# Reads the records of a .bin file without numpy.
+class BinReader:
+    def __init__(self, path):
+        self.path = path
+        self.fileObj = open(path, 'rb')
+        self.header = readHeader(self.fileObj)
+        self._unpacker = struct.Struct(recordFormat(self.header))
+
+    # Number of complete records in the file.
+    def __len__(self):
+        size = os.path.getsize(self.path) - self.header.headerSize
+        return max(0, size // self.header.recordSize)
+
+    # Returns record i as (epoch time, version, sqi, impedance, bad signal,
+    #   (values...)).  Unknown SQI and impedance are -1.
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("record index out of range")
+
+        self.fileObj.seek(self.header.headerSize + i * self.header.recordSize)
+        fields = self._unpacker.unpack(self.fileObj.read(self.header.recordSize))
+        return fields[:5] + (fields[5:],)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def close(self):
+        self.fileObj.close()
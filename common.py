@@ -28,6 +28,9 @@
     
 '''
 
+import time
+import calendar
+
 # Data type constants.
 DATA_RAW    = 0
 DATA_HGRAM  = 1
@@ -35,8 +38,10 @@ DATA_SGRAM  = 2
 DATA_EVENTS = 3
 
 # Don't store more than this many epochs in sleep history memory.
-# This matters only for regular expression matching.
-MAX_HISTORY_LEN = 30000 # Lil' more than 10 days worth ;)
+# This matters only for regular expression matching and display.
+# Appending to the history costs the same no matter how long it is, so this can
+#   be as large as memory allows; each epoch takes two bytes.
+MAX_HISTORY_LEN = 2 * 1024 * 1024 # A bit under 2 years worth ;)
 
 
 def errUknownSleepType():
@@ -49,7 +54,26 @@ def dataTypeConstToString(dtype):
     elif dtype == DATA_EVENTS: return "events"
     
     errUnknownSleepType()
+
+# Column names for the first row of each kind of output file.
+def getHeader(dataType):
+    if dataType == DATA_RAW:
+        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)","Voltage (uV)"]
+    elif dataType == DATA_SGRAM:
+        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)",
+                                "2-4 Hz","4-8 Hz","8-13 Hz","11-14 Hz","13-18 Hz","18-21 Hz","30-50 Hz"]
+    elif dataType == DATA_HGRAM:
+        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)","State (0-4)","State (named)"]
+    elif dataType == DATA_EVENTS:
+        header = ["Time Stamp","Version","Event"]
+    else:
+        errUnknownSleepType()
     
+    return header
+
+# The keys of a slice's 'FrequencyBins', in spectrogram column order.
+FREQUENCY_BINS = ['2-4','4-8','8-13','11-14','13-18','18-21','30-50']
+
 # The Zeo will send these string constants at us.
 SLEEP_STATE_UNDEFINED = 'Undefined'
 SLEEP_STATE_DEEP      = 'Deep'
@@ -64,4 +88,93 @@ SLEEP_STATE_TO_HEIGHT =  {  'Undefined' : 0,
                             'Light'     : 2,
                             'REM'       : 3,
                             'Awake'     : 4,
-                            'Not Given' : 0}
\ No newline at end of file
+                            'Not Given' : 0}
+
+# The format of the timestamps that the Zeo puts in its slices.
+ZEO_TIMESTAMP_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+# Turns Zeo timestamps into (epoch seconds, time struct) pairs.
+# The epoch seconds treat the Zeo's clock as if it were UTC, which is what
+#   calendar.timegm(time.strptime(...)) always gave us, so they are only good
+#   for measuring differences between Zeo timestamps.
+# Consecutive slices usually share a timestamp and always share a date, so the
+#   last timestamp and the last date are remembered.  Anything that doesn't
+#   look like the usual "MM/DD/YYYY HH:MM:SS" goes through time.strptime().
+# Raises ValueError for timestamps that strptime() can't parse either.
+class ZeoTimeDecoder:
+    def __init__(self):
+        # These are replaced rather than modified, so one decoder can safely
+        #   be shared between threads.
+        self._lastTimestamp = None # (timestamp string, epoch seconds, time struct)
+        self._lastDate = None      # (date string, epoch at midnight, date fields)
+    
+    def decode(self, timestamp):
+        last = self._lastTimestamp
+        if last != None and last[0] == timestamp:
+            return (last[1], last[2])
+        
+        result = self._decodeFast(timestamp)
+        if result == None:
+            timeStruct = time.strptime(timestamp, ZEO_TIMESTAMP_FORMAT)
+            result = (calendar.timegm(timeStruct), timeStruct)
+        
+        self._lastTimestamp = (timestamp, result[0], result[1])
+        return result
+    
+    def _decodeFast(self, timestamp):
+        if ( len(timestamp) != 19 or timestamp[2] != '/' or timestamp[5] != '/' or
+             timestamp[10] != ' ' or timestamp[13] != ':' or timestamp[16] != ':' ):
+            return None
+        
+        # int() would also take leading spaces and signs, which strptime()
+        #   doesn't.
+        if not ( timestamp[11:13].isdigit() and timestamp[14:16].isdigit() and
+                 timestamp[17:19].isdigit() ):
+            return None
+        
+        try:
+            hour   = int(timestamp[11:13])
+            minute = int(timestamp[14:16])
+            second = int(timestamp[17:19])
+        except ValueError:
+            return None
+        
+        if hour > 23 or minute > 59 or second > 61:
+            return None
+        
+        datePart = timestamp[0:10]
+        date = self._lastDate
+        if date == None or date[0] != datePart:
+            if not ( timestamp[0:2].isdigit() and timestamp[3:5].isdigit() and
+                     timestamp[6:10].isdigit() ):
+                return None
+            
+            try:
+                month = int(timestamp[0:2])
+                day   = int(timestamp[3:5])
+                year  = int(timestamp[6:10])
+            except ValueError:
+                return None
+            
+            if ( month < 1 or month > 12 or day < 1 or
+                 day > calendar.monthrange(year, month)[1] ):
+                return None
+            
+            midnight = calendar.timegm((year, month, day, 0, 0, 0, 0, 0, 0))
+            dayStruct = time.gmtime(midnight)
+            fields = (year, month, day, dayStruct.tm_wday, dayStruct.tm_yday)
+            date = (datePart, midnight, fields)
+            self._lastDate = date
+        
+        (datePart, midnight, (year, month, day, wday, yday)) = date
+        epoch = midnight + (hour * 3600) + (minute * 60) + second
+        
+        # This reads exactly like what strptime() returns, tm_isdst = -1
+        #   included.
+        timeStruct = time.struct_time((year, month, day, hour, minute, second,
+            wday, yday, -1))
+        
+        return (epoch, timeStruct)
+
+# Shared decoder for code that doesn't want one of its own.
+zeoTimeDecoder = ZeoTimeDecoder()
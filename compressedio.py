@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Compressed output files, written a block at a time.
+#
+# Compressing each row on its own would make the files barely smaller, so
+#   rows are collected in memory and compressed together once there are
+#   enough of them (or they have waited long enough).  Each block is a
+#   complete compressed stream of its own, and the file is just the blocks one
+#   after another.  gzip, bzip2 and xz tools all read such files as if they
+#   were one stream, and zlib streams can be read back with readBlocks().
+#
+# A crash can only damage the block being written.  When a file is opened
+#   to append to it, only its first block and its last are read: the last
+#   block is found by searching backwards from the end for the bytes every
+#   block starts with.  If the file doesn't end with a complete block, all
+#   of the blocks are checked and anything after the last complete one is
+#   cut off, so writing picks up at a block boundary.
+#
+# The codec is chosen by the file's extension; see CODECS.
+
+import os
+import zlib
+import bz2
+import time
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+class Codec:
+    def __init__(self, name, compress, decompressor, magic):
+        self.name = name
+        self.compress = compress         # compress(data) -> one block
+        self.decompressor = decompressor # decompressor() -> object with
+                                         #   decompress() and unused_data
+        self.magic = magic               # What every block starts with.
+
+def _gzipCompress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _gzipDecompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+# Compressed file extensions and how to handle them.
+#   The zlib magic is the header zlib.compress() writes at its default level.
+CODECS = {
+    '.gz'  : Codec('gzip',  _gzipCompress, _gzipDecompressor, b'\x1f\x8b\x08'),
+    '.zz'  : Codec('zlib',  zlib.compress, zlib.decompressobj, b'\x78\x9c'),
+    '.bz2' : Codec('bzip2', bz2.compress,  bz2.BZ2Decompressor, b'BZh'),
+    }
+
+if lzma != None:
+    CODECS['.xz'] = Codec('xz', lzma.compress, lzma.LZMADecompressor,
+        b'\xfd7zXZ\x00')
+
+# Sizes used when none are given.
+DEFAULT_BLOCK_SIZE = 256 * 1024
+DEFAULT_BLOCK_SECONDS = 60.0
+
+# How much to read at a time when checking a file.
+_SCAN_CHUNK_SIZE = 64 * 1024
+
+# Bytes of decompressed data that are kept from the front of a file's first
+#   block when it is opened, so callers can look at its header.
+_HEAD_SIZE = 4096
+
+class CompressedFileError(IOError):
+    ''' An existing file couldn't be read with the codec its name implies. '''
+    pass
+
+# Returns the Codec for a path, or None if it isn't a compressed file name.
+def codecForPath(path):
+    return CODECS.get(os.path.splitext(path)[1].lower())
+
+# Returns the path with any compression extension taken off.
+def stripCodecExtension(path):
+    (base, ext) = os.path.splitext(path)
+    if ext.lower() in CODECS:
+        return base
+    return path
+
+# True if decompressor has seen the whole of its stream.
+def _streamEnded(decompressor):
+    if decompressor.unused_data:
+        return True
+
+    # Anything given to a finished stream ends up in unused_data (or raises
+    #   EOFError, for bz2 and lzma).  A stream that isn't finished either
+    #   swallows it or chokes on it.
+    sentinel = b'\0'
+    try:
+        decompressor.decompress(sentinel)
+    except EOFError:
+        return True
+    except Exception:
+        return False
+    return decompressor.unused_data.endswith(sentinel)
+
+# Reads a compressed file a block at a time.  Yields (end offset in the file,
+#   decompressed data) for each complete block, and stops at the first block
+#   that is damaged or incomplete.
+# start is the file offset to begin at, which must be where a block starts.
+def readBlocks(path, codec=None, start=0):
+    if codec == None:
+        codec = codecForPath(path)
+
+    fileObj = open(path, 'rb')
+    try:
+        fileObj.seek(start)
+        blockStart = start
+        fed = 0        # Bytes of the current block given to decompressor.
+        output = []
+        decompressor = None
+        while True:
+            pending = fileObj.read(_SCAN_CHUNK_SIZE)
+            if not pending:
+                break
+
+            while pending:
+                if decompressor == None:
+                    decompressor = codec.decompressor()
+                    fed = 0
+                    output = []
+
+                try:
+                    output.append(decompressor.decompress(pending))
+                except EOFError:
+                    # The block ended right at the end of the last read.
+                    blockStart += fed
+                    decompressor = None
+                    yield (blockStart, b''.join(output))
+                    continue
+                except Exception:
+                    return
+
+                unused = decompressor.unused_data
+                fed += len(pending) - len(unused)
+                pending = unused
+                if unused:
+                    blockStart += fed
+                    decompressor = None
+                    yield (blockStart, b''.join(output))
+
+        if decompressor != None and fed > 0 and _streamEnded(decompressor):
+            yield (blockStart + fed, b''.join(output))
+    finally:
+        fileObj.close()
+
+# A file that data is appended to in compressed blocks.  It has the parts of
+#   the file interface that csv.writer and the sinks use.
+class BlockCompressedFile:
+
+    # blockSize is how many bytes to collect before compressing them.
+    #   flush() also writes out whatever has waited blockSeconds or more.
+    def __init__(self, path, codec, blockSize=DEFAULT_BLOCK_SIZE,
+                 blockSeconds=DEFAULT_BLOCK_SECONDS):
+        self.path = path
+        self.codec = codec
+        self.blockSize = blockSize
+        self.blockSeconds = blockSeconds
+
+        # What the existing blocks of the file hold.  head is the start of
+        #   the first block's data, and is empty if there are no blocks.
+        #   lastBlock is the file offset of the last block and the size of
+        #   its data.
+        self.head = b''
+        self.lastBlock = None
+        self.droppedBytes = 0 # Damaged bytes cut off of the end.
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            self._recover()
+
+        self.fileObj = open(path, 'ab')
+        self.compressedSize = os.path.getsize(path)
+        self._pending = []
+        self._pendingSize = 0
+        self._pendingSince = None
+
+    def _recover(self):
+        fileSize = os.path.getsize(self.path)
+        firstEnd = 0
+        for (end, data) in readBlocks(self.path, self.codec):
+            firstEnd = end
+            self.head = data[:_HEAD_SIZE]
+            self.lastBlock = (0, len(data))
+            break
+
+        if firstEnd == 0:
+            # Rather than throw away something that was never ours.
+            raise CompressedFileError(self.path+" is not a "+self.codec.name+
+                " file, or its first block is damaged.")
+
+        if firstEnd == fileSize:
+            return
+
+        lastBlock = self._findLastBlock(firstEnd, fileSize)
+        if lastBlock != None:
+            self.lastBlock = lastBlock
+            return
+
+        # The end is damaged.  Find the last complete block the slow way.
+        validEnd = firstEnd
+        for (end, data) in readBlocks(self.path, self.codec, firstEnd):
+            self.lastBlock = (validEnd, len(data))
+            validEnd = end
+
+        self.droppedBytes = fileSize - validEnd
+        fileObj = open(self.path, 'r+b')
+        try:
+            fileObj.truncate(validEnd)
+        finally:
+            fileObj.close()
+
+    # Searches backwards from the end of the file, over a longer stretch each
+    #   time, for the block that the file ends with.  Blocks before lowest
+    #   aren't looked at.  Returns the block's (offset, data size), or None if
+    #   the file doesn't end with a complete block.
+    def _findLastBlock(self, lowest, fileSize):
+        magic = self.codec.magic
+        fileObj = open(self.path, 'rb')
+        try:
+            searched = fileSize # Candidates from here on have been tried.
+            window = _SCAN_CHUNK_SIZE
+            while searched > lowest:
+                windowStart = max(lowest, fileSize - window)
+                fileObj.seek(windowStart)
+                data = fileObj.read(searched - windowStart + len(magic) - 1)
+
+                candidate = data.rfind(magic)
+                while candidate >= 0:
+                    start = windowStart + candidate
+                    lastStart = None
+                    blockEnd = start
+                    for (end, block) in readBlocks(self.path, self.codec, start):
+                        lastStart = blockEnd
+                        blockSize = len(block)
+                        blockEnd = end
+
+                    if lastStart != None:
+                        # A real block.  Either it leads to the end of the
+                        #   file or the end is damaged.
+                        if blockEnd == fileSize:
+                            return (lastStart, blockSize)
+                        return None
+                    candidate = data.rfind(magic, 0, candidate + len(magic) - 1)
+
+                searched = windowStart
+                window *= 2
+        finally:
+            fileObj.close()
+
+        return None
+
+    def write(self, data):
+        if self._pendingSize == 0:
+            self._pendingSince = time.time()
+        self._pending.append(data)
+        self._pendingSize += len(data)
+        if self._pendingSize >= self.blockSize:
+            self._writeBlock()
+
+    # Compresses and writes what's waiting if it has waited long enough,
+    #   then flushes the file.  If force is True, it doesn't wait.
+    def flush(self, sync=False, force=False):
+        if self._pendingSize > 0 and ( force or
+           time.time() - self._pendingSince >= self.blockSeconds ):
+            self._writeBlock()
+
+        self.fileObj.flush()
+        if sync:
+            os.fsync(self.fileObj.fileno())
+
+    # Returns where the next byte written will end up: the file offset of the
+    #   block it will be in, and how far into that block's data it will be.
+    def blockPosition(self):
+        return (self.compressedSize, self._pendingSize)
+
+    def close(self):
+        if self.fileObj == None:
+            return
+        self.flush(force=True)
+        self.fileObj.close()
+        self.fileObj = None
+
+    def _writeBlock(self):
+        data = b''.join(self._pending)
+        self._pending = []
+        self._pendingSize = 0
+        self._pendingSince = None
+        block = self.codec.compress(data)
+        self.fileObj.write(block)
+        self.lastBlock = (self.compressedSize, len(data))
+        self.compressedSize += len(block)
@@ -58,12 +58,25 @@ import platform
 import traceback
 import io
 import re
+import json
+import socket
+from optparse import OptionParser
 from sleepconfig import *
 from threading import RLock, Thread, Timer
 from termcolor import colored
 from serial import *
-from glob import glob
 import TermInput
+from rowwriter import RowWriter
+from portwatcher import PortWatcher, PORT_ADDED, PORT_REMOVED
+from eventloop import *
+from slicedispatch import SliceDispatcher
+from sleephistory import SleepHistory, RunLengthHistory, SECONDS_PER_EPOCH
+from triggerengine import TriggerEngine, PRIME_EPOCHS
+from replay import ReplayLink, REPLAY_MAX_SPEED, ReplayError, recordedSpan
+from stats import pipelineStats, summarize, formatReport, FrameErrorCounter, clock
+from sampleprofiler import SamplingProfiler
+from streamserver import SliceStreamServer
+from shmring import RingExporter
 
 if ( USE_ZEO_RDL ):
     from ZeoRawData import BaseLink, Parser
@@ -75,12 +88,13 @@ def printException():
     print "The exception's message is as follows:"
     traceback.print_exc()
 
-def scanPorts():
+# Opens each of the numbered serial ports to see which ones exist.
+# This is slow, so the PortWatcher only calls it every once in a while.  Ports
+#   that appear as device nodes (ex: /dev/ttyUSB*) are found by the watcher
+#   itself without having to open anything.
+def probePorts():
     portList = []
     
-    # Helps find USB>Serial converters on linux
-    for p in glob('/dev/ttyUSB*'):
-        portList.append(p)
     #Linux and Windows
     for i in range(256):
         try:
@@ -158,19 +172,31 @@ class NullStream(io.IOBase):
     def writelines(self,lines):
         ''' nop '''
 
-# A better way to do this would be to create a polling interface for grabbing
-#   data events.  This way the calling code could determine when events fire,
-#   rather than having the events fired at arbitrary times by the thread
-#   scheduler.
+# Data events are fired from the link's own thread.  Connection state changes
+#   are reported through connectCallbacks and disconnectCallbacks, which are
+#   also called from the link's thread; the main loop turns them into events.
 class ToughLink(BaseLink.BaseLink):
     
     def __init__(self, port):
         #colorama.init()
         BaseLink.BaseLink.__init__(self,port)
+        self.name = "ToughLink"
+        self.portStr = port
         self.connected = False
-        self.disconnectEvents = []
+        self.connectCallbacks = []
+        self.disconnectCallbacks = []
         self.ioLock = None
+        self.killed = False
     
+    # Gives up on the link.  Closing the port makes the read in run() fail,
+    #   which ends the thread.
+    def kill(self):
+        self.killed = True
+        if ( self.ser != None ):
+            try:
+                self.ser.close()
+            except Exception:
+                pass
     
     def run(self):
         
@@ -181,6 +207,8 @@ class ToughLink(BaseLink.BaseLink):
         #   have to do for now.
         def _setConnectFlag( context ):
             context.connected = True
+            for func in context.connectCallbacks:
+                func(context)
     
         timer = Timer(0.5, _setConnectFlag, [self])
         timer.start()
@@ -188,6 +216,7 @@ class ToughLink(BaseLink.BaseLink):
             BaseLink.BaseLink.run(self)
         
         except SerialException as e:
+            pipelineStats.count('link errors')
             if ( self.ioLock != None ): self.ioLock.acquire()
             print "SerialException: "
             traceback.print_exc()
@@ -196,6 +225,7 @@ class ToughLink(BaseLink.BaseLink):
             if ( self.ioLock != None ): self.ioLock.release()
             
         except OSError as e:
+            pipelineStats.count('link errors')
             if ( self.ioLock != None ): self.ioLock.acquire()
             print "OSError: "
             traceback.print_exc()
@@ -204,72 +234,87 @@ class ToughLink(BaseLink.BaseLink):
             if ( self.ioLock != None ): self.ioLock.release()
         
         except Exception:
+            pipelineStats.count('link errors')
             if ( self.ioLock != None ): self.ioLock.acquire()
             printException()
             self.connected = False
             timer.cancel()
             if ( self.ioLock != None ): self.ioLock.release()
         
+        self.connected = False
+        timer.cancel()
+        
         if ( self.ser != None ):
             self.ser.close()
+        
+        for func in self.disconnectCallbacks:
+            func(self)
     
 
-def getHeader(dataType):
-    if dataType == DATA_RAW:
-        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)","Voltage (uV)"]
-    elif dataType == DATA_SGRAM:
-        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)",
-                                "2-4 Hz","4-8 Hz","8-13 Hz","11-14 Hz","13-18 Hz","18-21 Hz","30-50 Hz"]
-    elif dataType == DATA_HGRAM:
-        header = ["Time Stamp","Version","SQI","Impedance","Bad Signal (Y/N)","State (0-4)","State (named)"]
-    elif dataType == DATA_EVENTS:
-        header = ["Time Stamp","Version","Event"]
-    else:
-        errUnknownSleepType()
-    
-    return header
-
-class StreamCache:
-    def __init__(self):
-        self.fstreams = {
-            DATA_RAW    : None,
-            DATA_HGRAM  : None,
-            DATA_SGRAM  : None,
-            DATA_EVENTS : None,
-        }
-
 class SleepContext:
     
-    def __init__(self, parent=None):
-        self.history = ""
+    # If historyPath is given, the sleep history is kept in that file and
+    #   picks up where it left off the last time.
+    def __init__(self, historyPath=None, parent=None):
+        self.history = None
+        if historyPath != None:
+            try:
+                historyDir = os.path.dirname(historyPath)
+                if not os.path.isdir(historyDir):
+                    os.makedirs(historyDir)
+                self.history = SleepHistory(MAX_HISTORY_LEN, historyPath)
+            except (IOError, OSError, EnvironmentError):
+                print "Could not open the sleep history file "+\
+                    colored(historyPath, 'yellow', attrs=['bold'])
+                traceback.print_exc()
+                print "Sleep history will not be saved."
+        
+        if self.history == None:
+            self.history = SleepHistory(MAX_HISTORY_LEN)
+        
+        # The same history as runs of epochs, for questions like "how long
+        #   has this stage lasted?"
+        self.runs = RunLengthHistory.fromHistory(self.history)
+        
         self.currentSlice = {}
         self.currentTimeStruct = time.localtime()
+        self.currentEpochTime = calendar.timegm(self.currentTimeStruct)
+        if self.history.lastEpochTime != None:
+            # Don't record the last epoch twice if it gets sent again.
+            self.currentEpochTime = self.history.lastEpochTime
         self.currentZeoVersion = ""
         self.currentSignalIsBad = False
         self.currentSleepStage = SLEEP_STATE_NOT_GIVEN
         
+        # How many epochs the last slice added to the history, including
+        #   any unrecorded ones before it.  Negative if it changed one that
+        #   was already there instead; see SleepHistory.record().
+        self.epochsAdded = 0
+        
     
     def updateSlice(self, slice):
         
         if slice['SleepStage'] == None:
             return
         
+        self.epochsAdded = 0
+        
         timestamp = slice['ZeoTimestamp']
         
-        timeStruct = None
+        # The dispatcher decoded the timestamp already.
+        timeStruct = slice.timeStruct
+        newTime = slice.epochTime
         timeIsSystemTime = False
-        try:
-            timeStruct = time.strptime(timestamp, "%m/%d/%Y %H:%M:%S")
-        except Exception:
+        if timeStruct == None:
             timeStruct = time.localtime()
+            newTime = calendar.timegm(timeStruct)
             timeIsSystemTime = True
         
-        newTime = calendar.timegm(timeStruct)
-        oldTime = calendar.timegm(self.currentTimeStruct)
-        if ( newTime == oldTime ):
+        if ( newTime == self.currentEpochTime ):
             return
         
         self.currentTimeStruct = timeStruct
+        self.currentEpochTime = newTime
         
         if ( timeIsSystemTime ):
             print ""
@@ -288,9 +333,8 @@ class SleepContext:
         #else:
         #    self.currentSleepStage = SLEEP_STATE_NOT_GIVEN
 
-        # TODO: How do we acquire NOT_GIVEN sleep states?  It would make sense
-        #   to count how many epochs (30 sec intervals) have elapsed since the
-        #   last reading and then insert blank history data for those.
+        # Epochs that never arrived (NOT_GIVEN) are filled in by the history,
+        #   which places each epoch according to its timestamp.
         givenSleepState = ' '
         if   self.currentSleepStage == SLEEP_STATE_UNDEFINED:
             givenSleepState = 'U'
@@ -306,12 +350,17 @@ class SleepContext:
         if self.currentSignalIsBad:
             givenSleepState = givenSleepState.lower()
         
-        self.history = self.history + givenSleepState
-        if len(self.history) > MAX_HISTORY_LEN:
-            self.history = self.history[-MAX_HISTORY_LEN : len(self.history)]
+        self.epochsAdded = self.history.record(givenSleepState, newTime)
+        self.runs.record(givenSleepState, newTime)
         
         return
     
+    def updateEvent(self, timestamp, version, event):
+        """Stub: not needed."""
+    
+    def close(self):
+        self.history.close()
+    
 
 class ZeoToCSV:
     
@@ -320,11 +369,23 @@ class ZeoToCSV:
         self.sleepConfig = config
         self.context = context
         
-        # Each element is a 4-pair table of dataType->stream pairs.  The paths are
-        #   paths that have already been filled in with date/name information.
-        # The elements in this array are parallel to the elements in the
-        #   self.sleepConfig.outputTables array.
-        self.outputs = []
+        # Files are opened, written and flushed on the writer's own thread so
+        #   that slow disks don't hold up the serial link.
+        # Its destinations are keyed by (output table index, data type).
+        self.writer = RowWriter(config.recording)
+        self.writer.start()
+        
+        # Number of output tables the writer's destinations were opened for.
+        self.nOutputs = 0
+        
+        # If False, rows aren't written anywhere.  If pathMap is given, every
+        #   output path goes through it before being opened.
+        self.writeRows = True
+        self.pathMap = None
+        
+        self._pathStage = pipelineStats.stage('output: path')
+        self._putStage = pipelineStats.stage('output: queue row')
+        self._displayStage = pipelineStats.stage('output: display')
         
         self.updateConfig()
         
@@ -444,10 +505,7 @@ class ZeoToCSV:
             sleepStr = sleepStr.replace("."," ")
         
         # TODO: What's our display width? This will determine how much history to dump.
-        if ( len(self.context.history) <= 80 ):
-            historyStr = self.context.history
-        else:
-            historyStr = self.context.history[-80:len(self.context.history)]
+        historyStr = self.context.history.tail(80)
         
         print timeStr + " " + sleepBar + "  " + sleepStr + "  " + sigStr + "  " + historyStr
         
@@ -455,17 +513,13 @@ class ZeoToCSV:
     
     def updateConfig(self):
         
-        if len(self.outputs) != len(self.sleepConfig.outputTables):
-            
-            for streamCache in self.outputs:
-                for dtype, stream in streamCache.fstreams.iteritems():
-                    if stream != None:
-                        stream.close()
-            
-            self.outputs = []
-            
-            for table in self.sleepConfig.outputTables:
-                self.outputs.append(StreamCache())
+        if self.nOutputs != len(self.sleepConfig.outputTables):
+            self.writer.closeAll()
+            self.nOutputs = len(self.sleepConfig.outputTables)
+    
+    # Writes out any rows that are still queued and closes the files.
+    def close(self):
+        self.writer.close()
     
     def updateSlice(self, slice):
         #print "updateSlice"
@@ -476,10 +530,18 @@ class ZeoToCSV:
     def _recordData(self, slice):
         #print "_recordData"
         
-        self.context.updateSlice(slice)
+        # The dispatcher has already given this slice to self.context.
         
         timestamp = slice['ZeoTimestamp']
         ver = slice['Version']
+        
+        # Decoded once by the dispatcher and shared by every row and output
+        #   table below.
+        timeStruct = slice.timeStruct
+        epochTime = slice.epochTime
+        if timeStruct == None:
+            timeStruct = self._timeOfRow(timestamp)
+            epochTime = calendar.timegm(timeStruct)
                                         
         if not slice['SQI'] == None:
             sqi = str(slice['SQI'])
@@ -498,156 +560,150 @@ class ZeoToCSV:
         else:
             badSignalYN = 'N'
 
-        if not slice['Waveform'] == []:
+        if len(slice['Waveform']) > 0:
             #self.rawSamples.writerow([timestamp,ver,sqi,imp,badSignal] + slice['Waveform'])
-            self._outputRow(DATA_RAW, [timestamp,ver,sqi,imp,badSignalYN] + slice['Waveform'])
+            self._outputRow(DATA_RAW, [timestamp,ver,sqi,imp,badSignalYN] + list(slice['Waveform']),
+                                        timeStruct, epochTime)
 
         if len(slice['FrequencyBins'].values()) == 7:
             f = slice['FrequencyBins']
             bins = [f['2-4'],f['4-8'],f['8-13'],f['11-14'],f['13-18'],f['18-21'],f['30-50']]
             #self.spectrogram.writerow([timestamp,ver,sqi,imp,badSignal] + bins)
-            self._outputRow(DATA_SGRAM, [timestamp,ver,sqi,imp,badSignalYN] + bins)
+            self._outputRow(DATA_SGRAM, [timestamp,ver,sqi,imp,badSignalYN] + bins,
+                                        timeStruct, epochTime)
 
         if not slice['SleepStage'] == None:
             stage = slice['SleepStage']
             #self.hypnogram.writerow([timestamp,ver,sqi,imp,badSignal] +
             #                         [self.hypToHeight[stage],str(stage)])
             self._outputRow(DATA_HGRAM, [timestamp,ver,sqi,imp,badSignalYN] +
-                                        [SLEEP_STATE_TO_HEIGHT[stage],str(stage)])
+                                        [SLEEP_STATE_TO_HEIGHT[stage],str(stage)],
+                                        timeStruct, epochTime, epochEnd=True)
             
+            start = clock()
             self.displaySleepState()
+            self._displayStage.record(clock() - start)
         
         #for dataType, stream in self.outputs.iteritems():
         #    stream.flush()
     
     def updateEvent(self, timestamp, version, event):
         self.updateConfig()
-        self._outputRow(DATA_EVENTS, [timestamp,version,event])
+        timeStruct = self._timeOfRow(timestamp)
+        self._outputRow(DATA_EVENTS, [timestamp,version,event], timeStruct,
+                        calendar.timegm(timeStruct))
 
         #self.eventsOut.writerow([timestamp,version,event])
     
-    # Row must be an array.
-    def _outputRow(self, dataType, row):
-        #print "self._outputRow"
-        index = 0
-        for table in self.outputs:
-            self._outputRowOnDestIndex(dataType, index, row)
-            index += 1
-        
-    def _outputRowOnDestIndex(self, dataType, index, row):
-        #print "self._outputRowOnDestIndex"
-        
-        # Calculate the timestamp first since it is needed in some filepaths.
-        timeStruct = None
-        timestamp = row[0] # row[0] should always be the timestamp given by Zeo.
+    # Returns the time struct for a Zeo timestamp, or the current system time
+    #   if the timestamp is bad.
+    def _timeOfRow(self, timestamp):
         try:
-            timeStruct = time.strptime(timestamp, "%m/%d/%Y %H:%M:%S")
+            (epochTime, timeStruct) = zeoTimeDecoder.decode(timestamp)
         except Exception:
             print ""
             print "Bad timestamp value given: "+colored(timestamp, 'red', attrs=['bold'])
             timeStruct = time.localtime()
             print "Using system time instead: "+colored(time.strftime("%m/%d/%Y %H:%M:%S",timeStruct), 'green', attrs=['bold'])
         
-        # Open or switch files as needed.
-        destination = self.outputs[index]
-        fstream = destination.fstreams[dataType]
+        return timeStruct
+    
+    # Row must be an array.
+    # timeStruct is the row's decoded timestamp, which is needed in some
+    #   filepaths, and epochTime is the same time in epoch seconds.
+    # epochEnd marks the last row written for a 30 second epoch.
+    def _outputRow(self, dataType, row, timeStruct, epochTime, epochEnd=False):
+        #print "self._outputRow"
+        if not self.writeRows:
+            return
+        for index in xrange(len(self.sleepConfig.outputTables)):
+            self._outputRowOnDestIndex(dataType, index, row, timeStruct, epochTime, epochEnd)
         
-        oldPath = ""
-        newPath = ""
+    def _outputRowOnDestIndex(self, dataType, index, row, timeStruct, epochTime, epochEnd=False):
+        #print "self._outputRowOnDestIndex"
         
-        if ( fstream != None ):
-            oldPath = fstream.name
+        newPath = ""
         
         table = self.sleepConfig.outputTables[index]
+        start = clock()
         try:
-            newPath = table.calculatePath(dataType, timeStruct, self.sleepConfig.timespanTable)
+            newPath = table.calculatePath(dataType, timeStruct, self.sleepConfig.timespanIndex)
         except SpanNameNotFoundError as e:
             traceback.print_exc()
         except SecondHasNoSpanError:
             ''' nop '''
+        if newPath != "" and self.pathMap != None:
+            newPath = self.pathMap(newPath)
+        queued = clock()
+        self._pathStage.record(queued - start)
 
-        # Streams are opened and closed lazily. This allows them to easily and
-        #   efficiently stay in sync with the config file, assuming updateConfig()
-        #   is called everytime a row is written.  
-        
-        try:
-            needHeader = False # Set to true for new files.
-            if ( oldPath != newPath ):
-                if ( fstream != None ):
-                    fstream.close()
-                
-                newDir = os.path.dirname(newPath)
-                if not os.path.isdir(newDir):
-                    os.makedirs(newDir)
-                
-                if not os.path.isfile(newPath):
-                    needHeader = True
-                
-                (dummy,ext) = os.path.splitext(newPath)
-                #if   ext == "zip":
-                #    fstream = zipfile.ZipFile(newPath, 'a+b')
-                if ext == "gz":
-                    fstream = gzip.GzipFile(newPath, 'ab')
-                else:
-                    fstream = open(newPath, 'ab')
-                
-                destination.fstreams[dataType] = fstream
-            
-            # destination.fstreams[dataType] now contains the correct stream.
-            # The only thing left is to write out the row:
-            fstream = destination.fstreams[dataType]
-            writer = csv.writer(fstream, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            
-            if needHeader:
-                writer.writerow(getHeader(dataType))
-            
-            writer.writerow(row)
-            
-            del writer
-            fstream.flush()
-        except Exception as e:
-            print ""
-            print "Could not write data with timestamp "+colored(timestamp, 'yellow', attrs=['bold'])
-            print "The destination file was "+colored(newPath, 'yellow', attrs=['bold'])
-            print "The following exception was given:"
-            traceback.print_exc()
+        # Streams are opened and closed lazily by the writer. This allows them
+        #   to easily and efficiently stay in sync with the config file,
+        #   assuming updateConfig() is called everytime a row is written.  
+        self.writer.put((index, dataType), newPath, dataType, row, epochTime, epochEnd)
+        self._putStage.record(clock() - queued)
         
         return
 
+# Runs the action_trigger sections of the config file.
 class NapTrainer:
-    def __init__(self, context, parent=None):
+    def __init__(self, context, config, parent=None):
         self.alarmProcess = None
-        self.lightCount = 0
+        # If False, triggers are only reported.
+        self.runAlarms = True
         self.context = context
+        self.engine = TriggerEngine(config.triggerTables, config.timespanIndex)
         
+        # Pick up any patterns that were already in progress before we
+        #   started.
+        history = context.history
+        self.engine.prime(history.tail(PRIME_EPOCHS), history.lastEpochTime)
     
     def updateSlice(self, slice):
         
-        # TODO: integrate this stuff.
-        return
+        if slice['SleepStage'] == None:
+            return
         
-        timestamp = slice['ZeoTimestamp']
-
-        if not slice['BadSignal'] and not slice['SleepStage'] == None:
-            stage = slice['SleepStage']
-            print "Sleep stage: "+ stage
-            #if stage == 'Awake':
-            if stage == 'Light':
-                self.lightCount = self.lightCount + 1
-            else:
-                self.lightCount = 0
+        # The context has already added this epoch to the history, unless
+        #   it was a repeat.
+        epochsAdded = self.context.epochsAdded
+        if epochsAdded == 0:
+            return
+        
+        epochTime = self.context.history.lastEpochTime
+        if epochsAdded < 0:
+            # A late reading changed an epoch the engine has already seen.
+            fired = self.engine.revise(self.context.history.tail(-epochsAdded), epochTime)
+            for trigger in fired:
+                self.fire(trigger)
+            return
         
-        currentHour = time.localtime().tm_hour
+        if epochsAdded > 1:
+            self.engine.skipGap(epochsAdded - 1, epochTime - SECONDS_PER_EPOCH)
         
-        # This is about 2 minutes of light sleep.
-        #if self.lightCount >= 1:
-        #if self.lightCount >= 4:
-        if self.lightCount >= (2 * leewayByHour[currentHour]):
-            #subprocess.call(["mplayer","alarm.wav"])
-            self.alarmProcess = subprocess.Popen(["mplayer","alarm.wav"])
-            self.lightCount = 0
+        fired = self.engine.update(self.context.history[-1], epochTime)
+        for trigger in fired:
+            self.fire(trigger)
+    
+    def fire(self, trigger):
+        print ""
+        print "Trigger "+colored(trigger.name, 'green', attrs=['bold'])+\
+            " matched "+colored(trigger.pattern.source, 'green')
         
-        #getRem = re.compile("(a|u|l|d)+r{30}(a|u|d|l)+r{30}((a|u|l){5}|((a|u|l)*d))", re.U)
+        command = trigger.section.alarm
+        if command == None or not self.runAlarms:
+            return
+        
+        if self.alarmProcess != None and self.alarmProcess.poll() == None:
+            print "The alarm is already going."
+            return
+        
+        try:
+            self.alarmProcess = subprocess.Popen(command, shell=True)
+        except OSError:
+            print "Could not run the alarm command "+\
+                colored(command, 'yellow', attrs=['bold'])
+            traceback.print_exc()
     
     def updateEvent(self, timestamp, version, event):
         """Stub: not needed."""
@@ -656,16 +712,49 @@ class PhasicEncabulator:
     def __init__(self):
         self.trainer = None
         self.output = None
+        self.dispatcher = None
         self.link = None
         self.ioLock = RLock()
+        self.portWatcher = None
+        self.inputThread = None
+        self.loop = None
     
         self.linkWasConnected = False
         self.defaultPort = ""
-        self.oldPorts = []
+        self.pendingPorts = []
+        self.connectTimeout = None
         
         self.config = None
         self.context = None
         
+        # Recorded files to play back instead of connecting to a Zeo, and
+        #   how fast; see replay.py.
+        self.replayPaths = []
+        self.replaySpeed = REPLAY_MAX_SPEED
+        
+        # Where a replay writes its output: None for where the config file
+        #   says, or a directory to put the same layout of files in instead.
+        #   If replayWritesOutput is False, nothing is written.
+        self.replayOutput = None
+        self.replayWritesOutput = True
+        self._replayRoot = None
+        
+        # Globs for the device nodes to watch for a Zeo, or None for the
+        #   usual ones.
+        self.portPatterns = None
+        
+        # Sends live slices to other programs, if the config file asks for it.
+        self.streamServer = None
+        
+        # Shares waveforms and spectrograms through memory-mapped rings, if
+        #   the config file asks for it.
+        self.ringExporter = None
+        
+        # The last snapshots shown by the S key and written to the stats
+        #   file, so each shows what happened since the one before.
+        self.lastStatsShown = None
+        self.lastStatsDumped = None
+        
     def printZeoTos(self):
         self.ioLock.acquire()
         
@@ -691,6 +780,7 @@ class PhasicEncabulator:
         print "  W ............ Print disclaimer."
         print "  L ............ Print license (the full GPL v3 text)."
         print "  O ............ Print available options/hotkeys (this text)."
+        print "  S ............ Print pipeline statistics."
         self.ioLock.release()
         
     def printDisclaimer(self):
@@ -755,72 +845,337 @@ class PhasicEncabulator:
         
         self.ioLock.release()
         
+    # Replaces the objects that slices go through with fresh ones.
+    def startPipeline(self, historyPath):
+        if self.output != None:
+            self.output.close()
+        if self.context != None:
+            self.context.close()
+        self.context = SleepContext(historyPath)
+        self.trainer = NapTrainer(self.context, self.config)
+        self.output = ZeoToCSV(self.config, self.context)
+        # Decode each packet once and fan the slices out to everything that
+        #   wants them.  The context goes first so the others see its state
+        #   for the current slice.
+        self.dispatcher = SliceDispatcher()
+        self.dispatcher.ioLock = self.ioLock
+        self.dispatcher.addConsumer(self.context)
+        self.dispatcher.addConsumer(self.trainer)
+        self.dispatcher.addConsumer(self.output)
+        if self.streamServer != None:
+            self.dispatcher.addConsumer(self.streamServer)
+        if self.ringExporter != None:
+            self.dispatcher.addConsumer(self.ringExporter)
+    
+    def _watchLink(self):
+        self.link.ioLock = self.ioLock
+        self.link.connectCallbacks.append(
+            lambda link: self.loop.post(EVENT_LINK_CONNECTED, link))
+        self.link.disconnectCallbacks.append(
+            lambda link: self.loop.post(EVENT_LINK_DISCONNECTED, link))
+    
+    # Starts connecting to the given port.  This returns right away; the main
+    #   loop finds out how it went through link events or the timeout.
     def attachSerial(self,portStr):
         print "------------------------------------------------"
         print "Attempting to connect on port " + \
             colored( portStr, 'green', attrs=['bold'] )
         # Initialize
-        self.context = SleepContext()
-        self.trainer = NapTrainer(self.context)
-        self.output = ZeoToCSV(self.config, self.context)
+        self.startPipeline(self.config.historyPath())
         self.link = ToughLink(portStr)
-        self.link.ioLock = self.ioLock
-        parser1 = Parser.Parser()
-        parser2 = Parser.Parser()
-        # Add callbacks
-        self.link.addCallback(parser1.update)
-        parser1.addEventCallback(self.trainer.updateEvent)
-        parser1.addSliceCallback(self.trainer.updateSlice)
-        self.link.addCallback(parser2.update)
-        parser2.addEventCallback(self.output.updateEvent)
-        parser2.addSliceCallback(self.output.updateSlice)
+        self._watchLink()
+        self.portWatcher.markBusy(portStr)
+        parser = Parser.Parser()
+        # Add callbacks.  Slices are dispatched from inside parser.update(),
+        #   so the packet stage includes the dispatcher's stages.
+        packetStage = pipelineStats.stage('link: packet')
+        link = self.link
+        def updateParser(timestamp, timestampSubsec, version, data):
+            if link.killed:
+                return
+            start = clock()
+            parser.update(timestamp, timestampSubsec, version, data)
+            packetStage.record(clock() - start)
+            pipelineStats.count('packets')
+            pipelineStats.count('packet bytes', len(data))
+        self.link.addCallback(updateParser)
+        parser.addEventCallback(self.dispatcher.updateEvent)
+        parser.addSliceCallback(self.dispatcher.updateSlice)
         # Start Link 
         self.link.start()
         
-        timeoutBegin = time.time()
-        while not self.link.connected:
-            ''' spin until it connects '''
-            ''' otherwise we would revisit this connection
-                code over and over and hang '''
-            
-            currentPorts = scanPorts()
-            if ( currentPorts.count(portStr) == 0 ):
-                print "Port "+colored(portStr, 'green', attrs=['bold'])+\
-                    " no longer available."
-                print "Aborting connection attempt."
-                print ""
-                # We say we're aborting, but if they plug the cable back in
-                #   we'll just try again.
-                return
-            
-            # Give up after some time.  This will just cause the calling code
-            #   to attempt the connection again, which is necessary because
-            #   if the link fails to connect then it won't retry by itself.
-            if ( time.time() > timeoutBegin + 5.0 ):
-                print "Connection attempt timed out."
-                print ""
-                return
-
-        self.defaultPort = portStr
+        # Give up after some time.  This lets the main loop move on to other
+        #   ports, which is necessary because if the link fails to connect
+        #   then it won't retry by itself.
+        self.connectTimeout = self.loop.callLater(5.0, self.onConnectTimeout, self.link)
+    
+    # Plays back recorded files instead of connecting to a Zeo.  The saved
+    #   sleep history is left out of it, so that replaying the same files
+    #   always gives the same results.  Alarms aren't run, and rows are
+    #   never dropped.
+    def attachReplay(self):
+        print "------------------------------------------------"
+        print "Replaying:"
+        for path in self.replayPaths:
+            print colored(path, 'green', attrs=['bold'])
+        self.startPipeline(None)
+        if not self.replayWritesOutput:
+            self.output.writeRows = False
+        elif self.replayOutput != None:
+            self.output.pathMap = self.replayOutputPath
+        self.trainer.runAlarms = False
+        self.output.writer.blockWhenFull = True
+        self.link = ReplayLink(self.replayPaths, self.replaySpeed)
+        self._watchLink()
+        self.link.addSliceCallback(self.dispatcher.updateSlice)
+        self.link.addEventCallback(self.dispatcher.updateEvent)
+        self.link.start()
+    
+    # Maps a path from the config file's output sections into replayOutput,
+    #   keeping its place below the directory that all of them share.
+    def replayOutputPath(self, path):
+        if self.replayOutput == None:
+            return path
+        
+        if self._replayRoot == None:
+            directories = []
+            for table in self.config.outputTables:
+                for dataType in (DATA_RAW, DATA_SGRAM, DATA_HGRAM, DATA_EVENTS):
+                    directories.append(table.staticDirectory(dataType).split(os.sep))
+            shared = os.path.commonprefix(directories)
+            self._replayRoot = os.sep.join(shared) or os.sep
+        
+        return os.path.join(os.path.abspath(self.replayOutput),
+            os.path.relpath(path, self._replayRoot))
+    
+    # Replaying into the files being replayed would read back what it writes
+    #   and never finish.  Returns False, after saying so, if any output file
+    #   for the replayed rows would be one of the replayed files.
+    # Output paths only change from one minute to the next, so this checks
+    #   every minute from each file's first row to its last.
+    def checkReplayOutputs(self):
+        if not self.replayWritesOutput:
+            return True
+        
+        minutes = set()
+        for path in self.replayPaths:
+            try:
+                span = recordedSpan(path)
+            except (ReplayError, EnvironmentError):
+                # ReplayLink reports unreadable files itself.
+                continue
+            if span != None:
+                minutes.update(xrange(span[0] // 60, span[1] // 60 + 1))
+        
+        inputs = set(os.path.realpath(path) for path in self.replayPaths)
+        resolved = {}
+        clashes = set()
+        for minute in sorted(minutes):
+            timeStruct = time.gmtime(minute * 60)
+            for table in self.config.outputTables:
+                for dataType in (DATA_RAW, DATA_SGRAM, DATA_HGRAM, DATA_EVENTS):
+                    try:
+                        path = table.calculatePath(dataType, timeStruct,
+                            self.config.timespanIndex)
+                    except (SpanNameNotFoundError, SecondHasNoSpanError):
+                        continue
+                    if path not in resolved:
+                        resolved[path] = os.path.realpath(self.replayOutputPath(path))
+                    if resolved[path] in inputs:
+                        clashes.add(resolved[path])
+        
+        if len(clashes) == 0:
+            return True
+        
+        print colored("The replay would write its output into the files being replayed:",
+            'red', attrs=['bold'])
+        for path in sorted(clashes):
+            print colored(path, 'yellow', attrs=['bold'])
+        print "Use --replay-output to put the output somewhere else, or "+\
+            "--replay-no-output to not write any."
+        print ""
+        return False
+    
+    def onReplayFinished(self, link):
+        print ""
+        print "Replay finished: "+str(link.slicesSent)+" slices and "+\
+            str(link.eventsSent)+" events in "+("%.2f" % link.elapsed())+\
+            " seconds ("+colored("%.0f slices/s" % link.slicesPerSecond(), 'green')+")."
+        self.loop.stop()
+    
+    # True while a link has been started but hasn't connected yet.
+    def isAttaching(self):
+        return self.connectTimeout != None
+    
+    # Connects to the next port that has shown up, if we're idle.
+    def attachPendingPort(self):
+        if self.isAttaching() or (self.link != None and self.link.connected):
+            return
+        
+        if len(self.pendingPorts) > 0:
+            self.attachSerial(self.pendingPorts.pop(0))
+    
+    def onConnectTimeout(self, link):
+        if link is not self.link or link.connected:
+            return
+        
+        self.connectTimeout = None
+        print "Connection attempt timed out."
+        print ""
+        self.dropLink()
+        self.attachPendingPort()
+    
+    # Stops the current link and cuts it off from the pipeline, so that
+    #   startPipeline() can close the old objects without the link's thread
+    #   still writing into them.
+    def dropLink(self):
+        self.link.kill()
+        self.dispatcher.close()
+        # The loop holds ioLock, which the link's thread may be waiting on,
+        #   so don't wait for it for long.  Either way it's cut off.
+        self.link.join(1.0)
+        self.link = None
+    
+    def onLinkConnected(self, link):
+        if link is not self.link:
+            return # Stale event from an old link.
+        
+        if self.connectTimeout != None:
+            self.connectTimeout.cancel()
+            self.connectTimeout = None
+        
+        self.linkWasConnected = True
+        self.defaultPort = link.portStr
         print "... done."
         print ""
-        return
+    
+    def onLinkDisconnected(self, link):
+        if isinstance(link, ReplayLink):
+            self.onReplayFinished(link)
+            return
+        
+        self.portWatcher.markBusy(link.portStr, False)
+        if link is not self.link:
+            return # Stale event from an old link.
+        
+        if self.linkWasConnected:
+            self.linkWasConnected = False
+            self.onDisconnect()
+        elif self.connectTimeout != None:
+            self.connectTimeout.cancel()
+            self.connectTimeout = None
+            print "Connection attempt failed."
+            print ""
         
+        self.attachPendingPort()
+    
+    def onPortsChanged(self, dummy):
+        event = self.portWatcher.popEvent()
+        while event != None:
+            (eventType, port) = event
+            if eventType == PORT_ADDED:
+                if port not in self.pendingPorts:
+                    self.pendingPorts.append(port)
+            elif eventType == PORT_REMOVED:
+                if port in self.pendingPorts:
+                    self.pendingPorts.remove(port)
+                if ( self.isAttaching() and self.link != None and
+                     self.link.portStr == port ):
+                    print "Port "+colored(port, 'green', attrs=['bold'])+\
+                        " no longer available."
+                    print "Aborting connection attempt."
+                    print ""
+                    # We say we're aborting, but if they plug the cable back
+                    #   in we'll just try again.
+                    self.connectTimeout.cancel()
+                    self.connectTimeout = None
+                    self.dropLink()
+            event = self.portWatcher.popEvent()
+        
+        # Port changes that happen while we're connected are remembered here,
+        #   so a replugged headband is picked up as soon as the old link goes
+        #   down.
+        self.attachPendingPort()
+    
+    def onKeys(self, dummy):
+        ch = self.inputThread.popChar()
+        while ch != '\0':
+            self.onKey(ch)
+            ch = self.inputThread.popChar()
+    
+    def onKey(self, ch):
+        if ch == ' ':
+            if ( self.trainer != None and self.trainer.alarmProcess != None and
+                 self.trainer.alarmProcess.poll() == None ):
+                print "\nSending kill signal to alarm."
+                self.trainer.alarmProcess.kill() # silence the alarm.
+            else:
+                print "\nNo alarm to kill."
+        elif ch == 'q' or ch == 'Q':
+            print "---------------------------"
+            print "Q command given.  Quitting."
+            self.loop.stop() # quit
+        elif ch == 'w' or ch == 'W':
+            self.printDisclaimer()
+            self.printOptions()
+        elif ch == 'l' or ch == 'L':
+            self.printLicense()
+            self.printOptions()
+        elif ch == 'o' or ch == 'O':
+            self.printOptions()
+        elif ch == 's' or ch == 'S':
+            self.printStats()
+        elif ch == '\x03': # ctrl-c
+            self.loop.stop() # quit
+        elif ch == '\x0A':
+            print ""
+    
+    def printStats(self):
+        snapshot = pipelineStats.snapshot()
+        print ""
+        for line in formatReport(summarize(snapshot, self.lastStatsShown)):
+            print line
+        self.lastStatsShown = snapshot
+    
+    # Appends the statistics since the last dump to the stats file, and
+    #   schedules the next dump.
+    def dumpStats(self):
+        rec = self.config.recording
+        self.loop.callLater(rec.statsSeconds, self.dumpStats)
+        
+        snapshot = pipelineStats.snapshot()
+        summary = summarize(snapshot, self.lastStatsDumped)
+        self.lastStatsDumped = snapshot
+        try:
+            statsFile = open(rec.statsFile, 'a')
+            try:
+                statsFile.write(json.dumps(summary, sort_keys=True) + "\n")
+            finally:
+                statsFile.close()
+        except (IOError, OSError):
+            print "Could not write statistics to "+\
+                colored(rec.statsFile, 'yellow', attrs=['bold'])
+            traceback.print_exc()
+    
     def onDisconnect(self):
         if self.link != None and not self.link.connected:
-            print "Zeo disconnected from port "+colored(self.link.ser.portstr, "green", attrs=['bold'])
+            print "Zeo disconnected from port "+colored(self.link.portStr, "green", attrs=['bold'])
         else:
             print "Zeo disconnected"
         
         print ""
-        time.sleep(0.3) # Wait briefly for the OS to update its device nodes.
+        
+        # Wait briefly for the OS to update its device nodes.
+        self.loop.callLater(0.3, self.printPortStatus)
+    
+    def printPortStatus(self):
         print "Current serial port status:"
         self.printPorts()
         print ""
         
     def printPorts(self):
         defaultFound = False
-        ports = scanPorts()
+        ports = self.portWatcher.getPorts()
         for port in ports:
             print port
             if port == self.defaultPort:
@@ -867,10 +1222,130 @@ class PhasicEncabulator:
         
         print "-------------------------"
         
-        # Find ports.
+        self.portWatcher = None
+        if len(self.replayPaths) == 0:
+            self.findPorts()
+        elif not self.checkReplayOutputs():
+            return
+        
+        self.pendingPorts = []
+        self.connectTimeout = None
+        
+        print "Hit "+colored("ctrl-C","green")+\
+            " or "+colored("q","green")+" at any time to stop."
+        print "Hit space bar to cancel any playing alarms."
+        print ""
+
+        # The Zeo Raw Data Library only prints its frame errors.
+        if not isinstance(sys.stdout, FrameErrorCounter):
+            sys.stdout = FrameErrorCounter(sys.stdout, pipelineStats)
+        pipelineStats.addGauge('writer queue depth', lambda:
+            self.output != None and self.output.writer.queueDepth() or 0)
+        
+        self.loop = EventLoop(self.ioLock)
+        self.loop.addHandler(EVENT_KEY, self.onKeys)
+        self.loop.addHandler(EVENT_PORTS_CHANGED, self.onPortsChanged)
+        self.loop.addHandler(EVENT_LINK_CONNECTED, self.onLinkConnected)
+        self.loop.addHandler(EVENT_LINK_DISCONNECTED, self.onLinkDisconnected)
+        
+        self.inputThread = TermInput.TermInput()
+        self.inputThread.addNotifyCallback(lambda: self.loop.post(EVENT_KEY))
+        self.inputThread.start()
+        
+        self.startStreamServer()
+        self.startRingExport()
+        
+        if self.portWatcher != None:
+            # Ports present at startup were queued as newly added before the
+            #   callback was registered, so poke the loop to connect to them.
+            self.portWatcher.addNotifyCallback(lambda: self.loop.post(EVENT_PORTS_CHANGED))
+            self.portWatcher.start()
+            self.loop.post(EVENT_PORTS_CHANGED)
+        else:
+            self.attachReplay()
+        
+        if self.config.recording.statsFile != None:
+            self.loop.callLater(self.config.recording.statsSeconds, self.dumpStats)
+
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            print "-------------------------"
+            print "Caught ctrl-C.  Quitting."
+        finally:
+            self.inputThread.kill()
+            if self.portWatcher != None:
+                self.portWatcher.kill()
+                # Let it close its file descriptors before the interpreter
+                #   starts tearing down modules underneath it.
+                self.portWatcher.join(1.0)
+            if isinstance(self.link, ReplayLink):
+                self.link.kill()
+                self.link.join()
+            if self.streamServer != None:
+                self.streamServer.kill()
+                self.streamServer.join(1.0)
+                self.streamServer = None
+            if self.ringExporter != None:
+                # The link may still be sending slices.
+                if self.dispatcher != None:
+                    self.dispatcher.removeConsumer(self.ringExporter)
+                self.ringExporter.close()
+                self.ringExporter = None
+            self.loop.close()
+            if self.output != None:
+                self.output.close()
+                self.output = None
+            if self.context != None:
+                self.context.close()
+                self.context = None
+        
+        print ""
+    
+    # Starts serving live slices on the config file's stream_address.
+    #   Recording goes on without it if the address can't be used.
+    def startStreamServer(self):
+        rec = self.config.recording
+        if rec.streamAddress == None:
+            return
+        
+        try:
+            self.streamServer = SliceStreamServer(rec.streamAddress,
+                rec.streamBufferKb * 1024)
+        except (socket.error, OSError) as e:
+            print colored("Could not start the stream server on "+rec.streamAddress+
+                ": "+str(e), 'red', attrs=['bold'])
+            print ""
+            return
+        
+        self.streamServer.start()
+        print "Streaming live data on "+colored(rec.streamAddress, "green", attrs=['bold'])
+        print ""
+    
+    # Sets up the ring buffers on the config file's ring_path.  Recording
+    #   goes on without them if they can't be made.
+    def startRingExport(self):
+        rec = self.config.recording
+        if rec.ringPath == None:
+            return
+        
+        try:
+            self.ringExporter = RingExporter(rec.ringPath, rec.ringSlots)
+        except EnvironmentError as e:
+            print colored("Could not set up the ring buffers at "+rec.ringPath+
+                ": "+str(e), 'red', attrs=['bold'])
+            print ""
+            return
+        
+        print "Sharing live data in "+colored(rec.ringPath+".*.ring", "green", attrs=['bold'])
+        print ""
+    
+    # Sets up the port watcher and reports which ports are there now.
+    def findPorts(self):
         # TODO: offer a command line option for selecting ports.
         portStr = None
-        ports = scanPorts()
+        self.portWatcher = PortWatcher(probePorts, self.portPatterns)
+        ports = self.portWatcher.getPorts()
         if len(ports) > 0 :
             print "Found the following ports:"
             for port in ports:
@@ -887,83 +1362,54 @@ class PhasicEncabulator:
             print ""
             #sys.exit("No serial ports found.")
         
-        # This must be empty for it to connect to ports present at startup.
-        self.oldPorts = []
-        
-        print "Hit "+colored("ctrl-C","green")+\
-            " or "+colored("q","green")+" at any time to stop."
-        print "Hit space bar to cancel any playing alarms."
-        print ""
-
-        inputThread = TermInput.TermInput()
-        inputThread.start()
-
+# Returns the (options, args) pair from OptionParser.
+def parseCommandLine(argv):
+    parser = OptionParser()
+    parser.add_option("--port-glob", action="append", default=[], metavar="PATTERN",
+        help="Look for the Zeo at device nodes matching PATTERN instead of "+
+             "the usual places (such as a fakezeo.py link).  Can be given "+
+             "more than once.")
+    parser.add_option("--replay", action="append", default=[], metavar="FILE",
+        help="Play back a recorded raw, spectrogram, hypnogram or events "+
+             "file instead of connecting to a Zeo.  Give this once for each "+
+             "file.")
+    parser.add_option("--replay-speed", default="max", metavar="SPEED",
+        help="How fast to replay: 'realtime', a multiple of real time such "+
+             "as 10, or 'max' for as fast as possible (the default).")
+    parser.add_option("--replay-output", metavar="DIR",
+        help="Write the replay's output files under DIR, laid out the same "+
+             "way as the config file's output sections lay them out.")
+    parser.add_option("--replay-no-output", action="store_true", default=False,
+        help="Don't write any output files while replaying.")
+    parser.add_option("--profile", metavar="DIR",
+        help="Sample what every thread is doing and save profile snapshots "+
+             "in DIR.  Read them with sampleprofiler.py.")
+    parser.add_option("--profile-interval", type="float", default=10.0, metavar="MS",
+        help="Milliseconds between profile samples (default 10).")
+    parser.add_option("--profile-minutes", type="float", default=10.0, metavar="N",
+        help="Save a profile snapshot every N minutes (default 10).")
+    
+    (options, args) = parser.parse_args(argv)
+    
+    if options.replay_speed == "max":
+        options.replay_speed = REPLAY_MAX_SPEED
+    elif options.replay_speed == "realtime":
+        options.replay_speed = 1.0
+    else:
         try:
-            while 1:
-                try:
-                    self.ioLock.acquire()
-                    if self.linkWasConnected and (self.link == None or not self.link.connected):
-                        self.linkWasConnected = False
-                        self.onDisconnect()
-                    elif not self.linkWasConnected and (self.link != None and self.link.connected):
-                        self.linkWasConnected = True
-                        #onConnect()
-                    
-                    if self.link == None or not self.link.connected:
-                        ports = scanPorts()
-                        for port in ports:
-                            #if port == self.defaultPort:
-                            #    self.attachSerial(port)
-                            if self.oldPorts.count(port) == 0:
-                                # New port that wasn't there before.
-                                self.attachSerial(port)
-                                break
-                        
-                        self.oldPorts = ports
-                    # TODO: this if-branch is for attempting to connect
-                    #   whenever a new serial device is found.  However, it
-                    #   currently only does this when there were no devices to
-                    #   begin with.
-                    #elif len(ports) == 0 :
-                    #    ports = scanPorts()
-                    #    if len(ports) > 0 :
-                    #        self.attachSerial(ports[0])
-                
-                    ch = inputThread.popChar()
-                    if ch == ' ':
-                        if self.trainer != None and self.trainer.alarmProcess != None :
-                            print "\nSending kill signal to alarm."
-                            self.trainer.alarmProcess.kill() # silence the alarm.
-                        else:
-                            print "\nNo alarm to kill."
-                    elif ch == 'q' or ch == 'Q':
-                        print "---------------------------"
-                        print "Q command given.  Quitting."
-                        break # quit
-                    elif ch == 'w' or ch == 'W':
-                        self.printDisclaimer()
-                        self.printOptions()
-                    elif ch == 'l' or ch == 'L':
-                        self.printLicense()
-                        self.printOptions()
-                    elif ch == 'o' or ch == 'O':
-                        self.printOptions()
-                    elif ch == '\x03': # ctrl-c
-                        break # quit
-                    elif ch == '\x0A':
-                        print ""
-                except SerialException:
-                    ''' keep going.'''
-                finally:
-                    self.ioLock.release()
-            # /while 1:
-        except KeyboardInterrupt:
-            print "-------------------------"
-            print "Caught ctrl-C.  Quitting."
-        finally:
-            inputThread.kill()
-        
-        print ""
+            options.replay_speed = float(options.replay_speed)
+        except ValueError:
+            parser.error("--replay-speed must be 'realtime', 'max', or a number.")
+        if options.replay_speed <= 0.0:
+            parser.error("--replay-speed must be more than 0.")
+    
+    if options.replay_output != None and options.replay_no_output:
+        parser.error("--replay-output and --replay-no-output can't be used together.")
+    
+    if options.profile_interval <= 0.0 or options.profile_minutes <= 0.0:
+        parser.error("--profile-interval and --profile-minutes must be more than 0.")
+    
+    return (options, args)
         
 if __name__ == '__main__':
     colorama.init()
@@ -985,7 +1431,22 @@ if __name__ == '__main__':
     sys.exit()
     '''
     
+    (options, args) = parseCommandLine(sys.argv[1:])
+    
+    # Started first, so that startup shows up in the profile too.
+    profiler = None
+    if options.profile != None:
+        profiler = SamplingProfiler(options.profile,
+            options.profile_interval / 1000.0, options.profile_minutes * 60.0)
+        profiler.start()
+    
     encabulator = PhasicEncabulator()
+    encabulator.replayPaths = options.replay
+    encabulator.replaySpeed = options.replay_speed
+    encabulator.replayOutput = options.replay_output
+    encabulator.replayWritesOutput = not options.replay_no_output
+    if len(options.port_glob) > 0:
+        encabulator.portPatterns = options.port_glob
     encabulator.startup()
     
     retryDelay = 0.5
@@ -1011,5 +1472,8 @@ if __name__ == '__main__':
             if ( retryDelay > 60.0 ):
                 retryDelay = 60.0
     
+    if profiler != None:
+        profiler.stop()
+    
     sys.exit()
 
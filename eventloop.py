@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# A small event loop for the main thread.
+#
+# Other threads (the serial link, the terminal input thread, the port watcher)
+#   call post() to hand events to the main thread.  The main thread sleeps in
+#   select() on a self-pipe until either an event is posted or the next timer
+#   is due, so it uses no CPU while nothing is happening.
+#
+# Handlers are called on the main thread, one event at a time, with the loop's
+#   lock held.  That lock is the same one the rest of the program uses to keep
+#   terminal output from interleaving.
+
+import os
+import time
+import heapq
+import errno
+import select
+import platform
+import threading
+import collections
+
+if ( platform.system() != 'Windows'):
+    import fcntl
+
+# Event types used by the encabulator.
+EVENT_KEY               = 'key'
+EVENT_PORTS_CHANGED     = 'ports_changed'
+EVENT_LINK_CONNECTED    = 'link_connected'
+EVENT_LINK_DISCONNECTED = 'link_disconnected'
+
+class TimerHandle:
+    def __init__(self, when, func, args):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop:
+
+    # If lock is given, then it is held while each handler and timer runs.
+    def __init__(self, lock=None):
+        self.lock = lock
+        self._handlers = {}
+        self._events = collections.deque()
+        self._timers = []
+        self._timerSeq = 0
+        self._timersLock = threading.Lock()
+        self._stopped = False
+
+        if ( platform.system() == 'Windows'):
+            # select() only works on sockets there.
+            self._wakeRead = None
+            self._wakeWrite = None
+            self._wakeEvent = threading.Event()
+        else:
+            (self._wakeRead, self._wakeWrite) = os.pipe()
+            for fd in (self._wakeRead, self._wakeWrite):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._wakeEvent = None
+
+    # Registers func(data) to be called for each posted event of eventType.
+    def addHandler(self, eventType, func):
+        if eventType in self._handlers:
+            self._handlers[eventType].append(func)
+        else:
+            self._handlers[eventType] = [func]
+
+    # Queues an event.  This may be called from any thread.
+    def post(self, eventType, data=None):
+        self._events.append((eventType, data))
+        self._wake()
+
+    # Calls func(*args) on the loop's thread after delay seconds.
+    # This may be called from any thread.  Returns a handle with a cancel()
+    #   method.
+    def callLater(self, delay, func, *args):
+        handle = TimerHandle(time.time() + delay, func, args)
+        self._timersLock.acquire()
+        try:
+            self._timerSeq += 1
+            heapq.heappush(self._timers, (handle.when, self._timerSeq, handle))
+        finally:
+            self._timersLock.release()
+        self._wake()
+        return handle
+
+    # Makes run() return once the current event has been handled.
+    def stop(self):
+        self._stopped = True
+        self._wake()
+
+    def run(self):
+        self._stopped = False
+        while not self._stopped:
+            self._runTimers()
+
+            while len(self._events) > 0 and not self._stopped:
+                (eventType, data) = self._events.popleft()
+                for handler in self._handlers.get(eventType, []):
+                    self._call(handler, (data,))
+
+            if not self._stopped and len(self._events) == 0:
+                self._sleep(self._timeUntilNextTimer())
+
+    def close(self):
+        for fd in (self._wakeRead, self._wakeWrite):
+            if fd != None:
+                os.close(fd)
+        self._wakeRead = None
+        self._wakeWrite = None
+
+    def _call(self, func, args):
+        if self.lock != None:
+            self.lock.acquire()
+        try:
+            func(*args)
+        finally:
+            if self.lock != None:
+                self.lock.release()
+
+    def _runTimers(self):
+        now = time.time()
+        while True:
+            self._timersLock.acquire()
+            try:
+                if len(self._timers) == 0 or self._timers[0][0] > now:
+                    return
+                (when, seq, handle) = heapq.heappop(self._timers)
+            finally:
+                self._timersLock.release()
+
+            if not handle.cancelled:
+                self._call(handle.func, handle.args)
+
+    # Returns the number of seconds until the next timer, or None if there
+    #   are no timers.
+    def _timeUntilNextTimer(self):
+        self._timersLock.acquire()
+        try:
+            while len(self._timers) > 0 and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            if len(self._timers) == 0:
+                return None
+            return max(0.0, self._timers[0][0] - time.time())
+        finally:
+            self._timersLock.release()
+
+    def _sleep(self, timeout):
+        if self._wakeEvent != None:
+            self._wakeEvent.wait(timeout)
+            self._wakeEvent.clear()
+            return
+
+        try:
+            (readable, dummy, dummy) = select.select([self._wakeRead], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        if readable:
+            try:
+                while os.read(self._wakeRead, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _wake(self):
+        if self._wakeEvent != None:
+            self._wakeEvent.set()
+            return
+        
+        if self._wakeWrite == None:
+            return
+
+        try:
+            os.write(self._wakeWrite, 'x')
+        except OSError as e:
+            # A full pipe means the loop already has a wakeup pending.
+            if e.errno != errno.EAGAIN:
+                raise
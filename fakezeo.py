@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# A pretend Zeo on a pseudo-terminal, for testing without a headband.
+#
+#   python fakezeo.py --link /tmp/fakezeo/ttyUSB0 --speed 10
+#   python encabulator.pyw --port-glob '/tmp/fakezeo/ttyUSB*'
+#
+# The fake device opens a pty pair and puts a symlink to the slave side at
+#   the link path, where the port watcher can find it.  It then writes
+#   SyntheticZeo's slices to the master side as framed packets, the way the
+#   Zeo's serial port sends them, so everything from ToughLink and the Zeo Raw
+#   Data Library's BaseLink and Parser onwards runs for real.
+#
+# It can also misbehave:
+#   * corrupt checksums and mismatched lengths, at given rates, which is what
+#     a flaky connection looked like in bugs.txt ("Capture error: bad
+#     checksum", "Capture error: Mismatched lengths.").
+#   * unplug every so often: the symlink goes away and the pty is closed, so
+#     the reader gets an I/O error, and after a pause a new pty is plugged in
+#     at the same link path.
+#
+# Packet framing, as BaseLink reads it:
+#   2s  "A4"
+#   B   checksum: the sum of the data bytes, modulo 256
+#   H   data length
+#   H   data length, inverted
+#   B   low byte of the Zeo timestamp
+#   H   fraction of a second, in 1/65535ths
+#   B   sequence number
+#   data, whose first byte is the record type (RECORD_* below).
+# All numbers are little endian.  A slice is a run of records ending with
+#   RECORD_SLICE_END.
+#
+# This only works where there are ptys, so not on Windows.
+
+import os
+import sys
+import pty
+import tty
+import time
+import errno
+import fcntl
+import struct
+import random
+import threading
+from optparse import OptionParser
+
+from common import *
+from synthzeo import SyntheticZeo, FREQUENCY_BINS
+
+PACKET_START = b'A4'
+FRAME_FORMAT = '<2sBHHBHB'
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+
+RECORD_EVENT          = 0x00
+RECORD_SLICE_END      = 0x02
+RECORD_VERSION        = 0x03
+RECORD_WAVEFORM       = 0x80
+RECORD_FREQUENCY_BINS = 0x83
+RECORD_SQI            = 0x84
+RECORD_ZEO_TIMESTAMP  = 0x8A
+RECORD_IMPEDANCE      = 0x97
+RECORD_BAD_SIGNAL     = 0x9C
+RECORD_SLEEP_STAGE    = 0x9D
+
+# Sleep stage numbers, as the Zeo sends them.
+STAGE_NUMBERS = {
+    SLEEP_STATE_UNDEFINED : 0,
+    SLEEP_STATE_AWAKE     : 1,
+    SLEEP_STATE_REM       : 2,
+    SLEEP_STATE_LIGHT     : 3,
+    SLEEP_STATE_DEEP      : 4,
+}
+
+# Full scale of the raw waveform, in uV.
+WAVEFORM_FULL_SCALE = 315.0
+
+# Packs one record into a framed packet.  corrupt may be 'checksum' or
+#   'length' to damage the frame the way a bad connection does.
+def framePacket(data, epochTime, subsecond, sequence, corrupt=None):
+    checksum = sum(bytearray(data)) % 256
+    length = len(data)
+    inverted = length ^ 0xFFFF
+    if corrupt == 'checksum':
+        checksum = (checksum + 1) % 256
+    elif corrupt == 'length':
+        inverted ^= 0x0001
+    header = struct.pack(FRAME_FORMAT, PACKET_START, checksum, length,
+        inverted, epochTime & 0xFF, int(subsecond * 65535), sequence & 0xFF)
+    return header + data
+
+def _uint32Record(recordType, value):
+    return struct.pack('<BI', recordType, value)
+
+# Turns a slice (as SyntheticZeo or Parser make them) into the records the
+#   Zeo would send for it.
+def sliceRecords(slice, epochTime):
+    records = [_uint32Record(RECORD_ZEO_TIMESTAMP, epochTime),
+               _uint32Record(RECORD_VERSION, slice['Version'])]
+
+    waveform = slice['Waveform']
+    if len(waveform) > 0:
+        scale = 0x7FFF / WAVEFORM_FULL_SCALE
+        samples = [max(-0x8000, min(0x7FFF, int(round(value * scale))))
+                   for value in waveform]
+        records.append(struct.pack('<B%dh' % len(samples), RECORD_WAVEFORM, *samples))
+
+    bins = slice['FrequencyBins']
+    if len(bins) > 0:
+        values = [min(0xFFFF, int(bins[name] * 0x8000)) for name in FREQUENCY_BINS]
+        records.append(struct.pack('<B7H', RECORD_FREQUENCY_BINS, *values))
+
+    if slice['SQI'] != None:
+        records.append(_uint32Record(RECORD_SQI, slice['SQI']))
+
+    # The real part and the imaginary part, each offset by 0x8000.  An
+    #   imaginary part of -0x8000 means there's no reading.
+    impedance = slice['Impedance']
+    if impedance == None:
+        records.append(_uint32Record(RECORD_IMPEDANCE, 0x8000))
+    else:
+        real = max(0, min(0xFFFF, int(impedance) + 0x8000))
+        records.append(_uint32Record(RECORD_IMPEDANCE, (0x8000 << 16) | real))
+
+    records.append(_uint32Record(RECORD_BAD_SIGNAL, int(slice['BadSignal'])))
+
+    if slice['SleepStage'] != None:
+        records.append(_uint32Record(RECORD_SLEEP_STAGE,
+            STAGE_NUMBERS[slice['SleepStage']]))
+
+    records.append(struct.pack('<B', RECORD_SLICE_END))
+    return records
+
+# Splits a byte stream back into records, the way BaseLink does, counting the
+#   frames it has to throw away.  Useful for checking what a FakeZeo sends.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = b''
+        self.checksumErrors = 0
+        self.lengthErrors = 0
+
+    # Returns the complete records in data plus anything left over from
+    #   before.
+    def feed(self, data):
+        self.buffer += data
+        records = []
+        while True:
+            start = self.buffer.find(PACKET_START)
+            if start < 0:
+                self.buffer = self.buffer[-1:]
+                break
+            if len(self.buffer) - start < FRAME_SIZE:
+                self.buffer = self.buffer[start:]
+                break
+
+            (magic, checksum, length, inverted, lowByte, subsecond, sequence) = \
+                struct.unpack_from(FRAME_FORMAT, self.buffer, start)
+            if length ^ inverted != 0xFFFF:
+                self.lengthErrors += 1
+                self.buffer = self.buffer[start + 1:]
+                continue
+
+            end = start + FRAME_SIZE + length
+            if len(self.buffer) < end:
+                self.buffer = self.buffer[start:]
+                break
+
+            data = self.buffer[start + FRAME_SIZE:end]
+            self.buffer = self.buffer[end:]
+            if sum(bytearray(data)) % 256 != checksum:
+                self.checksumErrors += 1
+                continue
+            records.append(data)
+        return records
+
+class FakeZeo ( threading.Thread ):
+
+    # linkPath is where the symlink to the pty goes.
+    # speed is how many slices to send per second; the real Zeo sends one.
+    # checksumErrors and lengthErrors are the fraction of packets to damage.
+    # unplugEvery is the number of seconds between unplugs (0 for never),
+    #   and unplugFor how long to stay unplugged.
+    def __init__(self, linkPath, speed=1.0, seed=1, checksumErrors=0.0,
+                 lengthErrors=0.0, unplugEvery=0.0, unplugFor=3.0, slices=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.linkPath = linkPath
+        self.speed = speed
+        self.checksumErrors = checksumErrors
+        self.lengthErrors = lengthErrors
+        self.unplugEvery = unplugEvery
+        self.unplugFor = unplugFor
+        self.nSlices = slices
+        self.zeo = SyntheticZeo(seed)
+        self.random = random.Random(seed)
+
+        self.masterFd = None
+        self.slaveFd = None
+        self.sequence = 0
+        self._done = threading.Event()
+
+        # Statistics.
+        self.slicesSent = 0
+        self.packetsSent = 0
+        self.packetsDamaged = 0
+        self.packetsDropped = 0 # Nobody was reading and the pty was full.
+        self.unplugs = 0
+
+    def kill(self):
+        self._done.set()
+
+    def plugIn(self):
+        (self.masterFd, self.slaveFd) = pty.openpty()
+        # No echoing or line editing; this is a binary stream.
+        tty.setraw(self.slaveFd)
+        flags = fcntl.fcntl(self.masterFd, fcntl.F_GETFL)
+        fcntl.fcntl(self.masterFd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        linkDir = os.path.dirname(os.path.abspath(self.linkPath))
+        if not os.path.isdir(linkDir):
+            os.makedirs(linkDir)
+        if os.path.lexists(self.linkPath):
+            os.remove(self.linkPath)
+        os.symlink(os.ttyname(self.slaveFd), self.linkPath)
+
+    def unplug(self):
+        if os.path.lexists(self.linkPath):
+            os.remove(self.linkPath)
+        for fd in (self.masterFd, self.slaveFd):
+            if fd != None:
+                os.close(fd)
+        self.masterFd = None
+        self.slaveFd = None
+
+    def run(self):
+        self.plugIn()
+        try:
+            self._send()
+        finally:
+            self.unplug()
+
+    def _send(self):
+        startTime = time.time()
+        nextUnplug = None
+        if self.unplugEvery > 0:
+            nextUnplug = startTime + self.unplugEvery
+
+        slices = self.zeo.slices(self.nSlices or sys.maxint)
+        for slice in slices:
+            if self._done.isSet():
+                return
+
+            due = startTime + self.slicesSent / self.speed
+            if self._done.wait(max(0.0, due - time.time())):
+                return
+            self.slicesSent += 1
+
+            if nextUnplug != None and time.time() >= nextUnplug:
+                self.unplug()
+                self.unplugs += 1
+                if self._done.wait(self.unplugFor):
+                    return
+                self.plugIn()
+                # Don't make up for the lost time; the Zeo wouldn't.
+                startTime += self.unplugFor
+                nextUnplug = time.time() + self.unplugEvery
+
+            self._sendSlice(slice)
+
+    def _sendSlice(self, slice):
+        (epochTime, timeStruct) = zeoTimeDecoder.decode(slice['ZeoTimestamp'])
+        records = sliceRecords(slice, epochTime)
+        packets = []
+        for (i, record) in enumerate(records):
+            corrupt = None
+            roll = self.random.random()
+            if roll < self.checksumErrors:
+                corrupt = 'checksum'
+            elif roll < self.checksumErrors + self.lengthErrors:
+                corrupt = 'length'
+            if corrupt != None:
+                self.packetsDamaged += 1
+            packets.append(framePacket(record, epochTime,
+                float(i) / len(records), self.sequence, corrupt))
+            self.sequence = (self.sequence + 1) & 0xFF
+
+        self.packetsSent += len(packets)
+        self._write(b''.join(packets), len(packets))
+
+    def _write(self, data, nPackets):
+        try:
+            while data:
+                written = os.write(self.masterFd, data)
+                data = data[written:]
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EIO):
+                raise
+            # Like a Zeo with nothing on the other end of the cable.
+            self.packetsDropped += nPackets
+
+def parseCommandLine(argv):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--link", default="/tmp/fakezeo/ttyUSB0",
+        help="Where to put the symlink to the fake serial port.")
+    parser.add_option("--speed", type="float", default=1.0,
+        help="Slices per second.  The real Zeo sends 1.")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--slices", type="int", default=None,
+        help="Stop after this many seconds of data.")
+    parser.add_option("--checksum-errors", type="float", default=0.0,
+        metavar="RATE", help="Fraction of packets with a bad checksum.")
+    parser.add_option("--length-errors", type="float", default=0.0,
+        metavar="RATE", help="Fraction of packets with mismatched lengths.")
+    parser.add_option("--unplug-every", type="float", default=0.0,
+        metavar="SECONDS", help="Unplug the fake Zeo this often.")
+    parser.add_option("--unplug-for", type="float", default=3.0,
+        metavar="SECONDS", help="How long to stay unplugged.")
+    (options, args) = parser.parse_args(argv)
+    if options.speed <= 0.0:
+        parser.error("--speed must be more than 0.")
+    return options
+
+def main(argv):
+    options = parseCommandLine(argv)
+    fake = FakeZeo(options.link, options.speed, options.seed,
+        options.checksum_errors, options.length_errors, options.unplug_every,
+        options.unplug_for, options.slices)
+    fake.start()
+    print "Fake Zeo plugged in at "+options.link+".  Hit ctrl-C to stop."
+
+    unplugs = 0
+    try:
+        while fake.isAlive():
+            fake.join(1.0)
+            if fake.unplugs != unplugs:
+                unplugs = fake.unplugs
+                print "Unplugged ("+str(unplugs)+" so far)."
+    except KeyboardInterrupt:
+        fake.kill()
+        fake.join()
+
+    print ""
+    print "Sent "+str(fake.slicesSent)+" slices in "+str(fake.packetsSent)+\
+        " packets, "+str(fake.packetsDamaged)+" of them damaged on purpose and "+\
+        str(fake.packetsDropped)+" dropped while nobody was listening."
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Serial port discovery that doesn't require probing every port all the time.
+#
+# The watcher keeps a cached set of known ports.  On Linux it learns about
+#   device nodes appearing and disappearing by watching /dev with inotify.
+#   Where inotify isn't available it falls back to cheaply globbing the device
+#   directories every so often.
+# Ports that can only be found by opening them (/dev/ttyS*, COM ports on
+#   Windows) are found by the probe function given to the constructor.  The
+#   probe is expensive, so it is rate-limited to once every probeInterval
+#   seconds.
+#
+# Whenever the cached set changes, (PORT_ADDED, port) and (PORT_REMOVED, port)
+#   events are queued up for the main loop to collect with popEvent().
+
+import os
+import time
+import glob
+import errno
+import select
+import platform
+import threading
+import Queue
+
+PORT_ADDED   = 'added'
+PORT_REMOVED = 'removed'
+
+# Globs for serial devices that show up as device nodes when plugged in.
+# The USB>Serial converter used by the Zeo shows up as /dev/ttyUSB*.
+DEFAULT_PORT_PATTERNS = ['/dev/ttyUSB*']
+
+# inotify constants from <sys/inotify.h>
+_IN_ATTRIB     = 0x00000004
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO   = 0x00000080
+_IN_CREATE     = 0x00000100
+_IN_DELETE     = 0x00000200
+_IN_WATCH_MASK = _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+# Returns an (fd, libc) pair for a fresh inotify instance, or (None, None) if
+#   inotify is unavailable on this system.
+def _openInotify():
+    if platform.system() != 'Linux':
+        return (None, None)
+
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return (None, None)
+
+    if fd < 0:
+        return (None, None)
+
+    return (fd, libc)
+
+class PortWatcher ( threading.Thread ):
+
+    # probe is a function returning a list of port names.  It is called
+    #   infrequently and may take a while to run.  Pass None to skip probing.
+    # patterns is a list of globs for hotpluggable device nodes.
+    def __init__(self, probe=None, patterns=None, probeInterval=30.0, pollInterval=1.0):
+        threading.Thread.__init__(self, name="PortWatcher")
+        self.daemon = True
+
+        if patterns == None:
+            patterns = DEFAULT_PORT_PATTERNS
+
+        self.probe = probe
+        self.patterns = list(patterns)
+        self.probeInterval = probeInterval
+        self.pollInterval = pollInterval
+
+        self._ports = []
+        self._probedPorts = []
+        self._busyPorts = []
+        self._lastProbeTime = None
+        self._forceProbe = False
+        self._portsLock = threading.Lock()
+        self._events = Queue.Queue()
+        self._notifyCallbacks = []
+        self._done = threading.Event()
+
+        self._inotifyFd = None
+        self._libc = None
+        self._wakeRead = None
+        self._wakeWrite = None
+
+        # Populate the cache right away so that callers can use getPorts()
+        #   without waiting for the thread to get scheduled.
+        self._probe(time.time())
+        self._rescan()
+
+    # Returns a snapshot of the currently known ports.
+    def getPorts(self):
+        self._portsLock.acquire()
+        try:
+            return list(self._ports)
+        finally:
+            self._portsLock.release()
+
+    def hasPort(self, port):
+        self._portsLock.acquire()
+        try:
+            return port in self._ports
+        finally:
+            self._portsLock.release()
+
+    # Returns the least recent (eventType, port) pair, or None if nothing has
+    #   happened since the last call.
+    def popEvent(self):
+        try:
+            return self._events.get_nowait()
+        except Queue.Empty:
+            return None
+
+    # Registers func() to be called from the watcher thread whenever new
+    #   events are queued.  The callback should not block.
+    def addNotifyCallback(self, func):
+        self._notifyCallbacks.append(func)
+
+    # Ports that we hold open can't be reopened by the probe, so they would
+    #   look like they vanished.  Mark them busy to keep them in the cache
+    #   for as long as they're in use.
+    def markBusy(self, port, busy=True):
+        self._portsLock.acquire()
+        try:
+            if busy and port not in self._busyPorts:
+                self._busyPorts.append(port)
+            elif not busy and port in self._busyPorts:
+                self._busyPorts.remove(port)
+        finally:
+            self._portsLock.release()
+
+    # Forces a full rescan, including the expensive probe, on the next pass.
+    def refresh(self):
+        self._forceProbe = True
+        self._wake()
+
+    def run(self):
+        self._done.clear()
+
+        if platform.system() != 'Windows':
+            (self._wakeRead, self._wakeWrite) = os.pipe()
+            (self._inotifyFd, self._libc) = _openInotify()
+            if self._inotifyFd != None:
+                self._addWatches()
+
+        try:
+            while not self._done.isSet():
+                now = time.time()
+                self._probe(now)
+                self._rescan()
+                self._sleep(self._timeUntilNextPass(time.time()))
+        finally:
+            for fd in (self._inotifyFd, self._wakeRead, self._wakeWrite):
+                if fd != None:
+                    os.close(fd)
+            self._inotifyFd = None
+            self._wakeRead = None
+            self._wakeWrite = None
+
+    def kill(self):
+        self._done.set()
+        self._wake()
+
+    def _addWatches(self):
+        dirs = []
+        for pattern in self.patterns:
+            d = os.path.dirname(pattern)
+            if d not in dirs:
+                dirs.append(d)
+
+        nWatches = 0
+        for d in dirs:
+            if self._libc.inotify_add_watch(self._inotifyFd, d, _IN_WATCH_MASK) >= 0:
+                nWatches += 1
+
+        if nWatches == 0:
+            # Nothing to watch; we'll just have to poll.
+            os.close(self._inotifyFd)
+            self._inotifyFd = None
+
+    def _timeUntilNextPass(self, now):
+        if self.probe != None:
+            untilProbe = max(0.0, self._lastProbeTime + self.probeInterval - now)
+        else:
+            untilProbe = None
+
+        if self._inotifyFd != None:
+            # inotify tells us when to rescan the patterns, so only the probe
+            #   needs a timer.
+            return untilProbe
+        elif untilProbe == None:
+            return self.pollInterval
+        else:
+            return min(untilProbe, self.pollInterval)
+
+    # Blocks until the timeout expires, a device node changes, or kill() is
+    #   called.  A timeout of None waits indefinitely.
+    def _sleep(self, timeout):
+        if self._wakeRead == None:
+            if timeout == None:
+                timeout = self.pollInterval
+            self._done.wait(timeout)
+            return
+
+        fds = [self._wakeRead]
+        if self._inotifyFd != None:
+            fds.append(self._inotifyFd)
+
+        try:
+            (readable, dummy, dummy) = select.select(fds, [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for fd in readable:
+            # The contents don't matter; any change means "rescan".
+            os.read(fd, 4096)
+
+        if self._inotifyFd in readable:
+            # udev tends to create the node and then fix up its permissions
+            #   and symlinks a moment later.  Let it settle and then drain
+            #   whatever else it did so we only rescan once.
+            time.sleep(0.05)
+            while select.select([self._inotifyFd], [], [], 0)[0]:
+                os.read(self._inotifyFd, 4096)
+
+    def _wake(self):
+        if self._wakeWrite != None:
+            try:
+                os.write(self._wakeWrite, 'x')
+            except OSError:
+                pass
+
+    def _probe(self, now):
+        if self.probe == None:
+            return
+
+        if ( not self._forceProbe and self._lastProbeTime != None and
+             now < self._lastProbeTime + self.probeInterval ):
+            return
+
+        self._forceProbe = False
+        self._lastProbeTime = now
+        probed = self.probe()
+
+        self._portsLock.acquire()
+        try:
+            for p in self._busyPorts:
+                if p not in probed:
+                    probed.append(p)
+        finally:
+            self._portsLock.release()
+
+        self._probedPorts = probed
+
+    def _rescan(self):
+        found = []
+        for pattern in self.patterns:
+            for p in sorted(glob.glob(pattern)):
+                if p not in found:
+                    found.append(p)
+
+        for p in self._probedPorts:
+            if p not in found:
+                found.append(p)
+
+        self._portsLock.acquire()
+        try:
+            oldPorts = self._ports
+            self._ports = found
+        finally:
+            self._portsLock.release()
+
+        changed = False
+        for p in oldPorts:
+            if p not in found:
+                self._events.put((PORT_REMOVED, p))
+                changed = True
+
+        for p in found:
+            if p not in oldPorts:
+                self._events.put((PORT_ADDED, p))
+                changed = True
+
+        if changed:
+            for func in self._notifyCallbacks:
+                func()
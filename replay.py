@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Plays recorded files back through the same callbacks the Zeo's Parser uses.
+#
+# The raw, spectrogram, hypnogram and events files that ZeoToCSV writes (CSV
+#   or .bin, compressed or not) are merged by timestamp and turned back into
+#   slices and events.  Raw and spectrogram rows with the same timestamp become
+#   one slice, and each hypnogram row becomes a slice of its own with just the
+#   sleep stage, which is how they were recorded.  Feeding those to a
+#   SliceDispatcher runs SleepContext, NapTrainer and ZeoToCSV without a
+#   headband.
+#
+# speed sets the pace: 1.0 plays back in real time, 10.0 ten times as fast,
+#   and REPLAY_MAX_SPEED (0) as fast as the consumers can keep up, which is
+#   what to use for regression runs and throughput measurements.
+#
+# ReplayLink looks enough like ToughLink (connected, portStr, connect and
+#   disconnect callbacks) that the encabulator can treat it as one.
+#
+# ZeoToCSV writes a replay's rows to the config file's output paths, which
+#   for a recent recording are usually the very files being replayed.  The
+#   encabulator's --replay-output and --replay-no-output options send the
+#   rows elsewhere or nowhere, and it won't start a replay whose output
+#   paths include one of its input files (see recordedSpan()).
+
+import os
+import csv
+import time
+import heapq
+import threading
+import traceback
+
+from common import *
+from binformat import BIN_EXTENSION, BinFormatError, parseHeader
+from compressedio import codecForPath, stripCodecExtension, readBlocks
+from timeindex import IndexFormatError, indexPath, loadIndex, readTimeRange, zeoTime
+
+REPLAY_MAX_SPEED = 0.0
+
+# Order of rows that have the same timestamp.
+_ORDER = { DATA_RAW : 0, DATA_SGRAM : 0, DATA_HGRAM : 1, DATA_EVENTS : 2 }
+
+_ALL_TIME = (-(1 << 62), 1 << 62)
+
+class ReplayError(ValueError):
+    ''' A file can't be replayed. '''
+    pass
+
+# Works out what kind of data a recorded file holds, from its column header or
+#   its .bin header.
+def replayDataType(path):
+    codec = codecForPath(path)
+    if codec != None:
+        head = b''
+        for (end, data) in readBlocks(path, codec):
+            head = data
+            break
+    else:
+        fileObj = open(path, 'rb')
+        try:
+            head = fileObj.read(4096)
+        finally:
+            fileObj.close()
+
+    if stripCodecExtension(path).endswith(BIN_EXTENSION):
+        return parseHeader(head).dataType
+
+    lines = head.splitlines()
+    if len(lines) > 0:
+        firstRow = csv.reader(lines[:1]).next()
+        for dataType in (DATA_RAW, DATA_SGRAM, DATA_HGRAM, DATA_EVENTS):
+            if firstRow == getHeader(dataType):
+                return dataType
+
+    raise ReplayError(path+" is not a recorded raw, spectrogram, hypnogram "+
+        "or events file.")
+
+# Yields (epoch time, order, file number, data type, row) for every row of a
+#   file from startTime on, with rows normalized to what ZeoToCSV writes.
+def _fileRows(path, fileNumber, startTime=_ALL_TIME[0]):
+    dataType = replayDataType(path)
+    order = _ORDER[dataType]
+    isBin = stripCodecExtension(path).endswith(BIN_EXTENSION)
+    for row in readTimeRange(path, startTime, _ALL_TIME[1]):
+        if isBin:
+            (epochTime, version, sqi, impedance, badSignal, values) = row
+            row = [time.strftime(ZEO_TIMESTAMP_FORMAT, time.gmtime(epochTime)),
+                   version, _binOptional(sqi), _binOptional(impedance),
+                   badSignal and 'Y' or 'N'] + list(values)
+        else:
+            epochTime = zeoTime(row[0])
+        yield (epochTime, order, fileNumber, dataType, row)
+
+def _binOptional(value):
+    if value < 0:
+        return '--'
+    return value
+
+def _optionalNumber(text, convert):
+    if text == '--' or text == '':
+        return None
+    return convert(text)
+
+def _newSlice(row):
+    (timestamp, version, sqi, impedance, badSignal) = row[:5]
+    return {
+        'ZeoTimestamp'  : timestamp,
+        'Version'       : int(version),
+        'SQI'           : _optionalNumber(sqi, int),
+        'Impedance'     : _optionalNumber(impedance, float),
+        'BadSignal'     : badSignal == 'Y',
+        'SleepStage'    : None,
+        'Waveform'      : [],
+        'FrequencyBins' : {},
+        }
+
+# Returns (first, last), the epoch times of the earliest and latest rows in
+#   a recorded file, or None if it has no rows.
+# The first entry of a timestamp index is the first row, so for indexed files
+#   only the rows after the last entry are read.  Hypnogram and events files
+#   are small enough to read whole.
+def recordedSpan(path):
+    try:
+        entries = []
+        if os.path.isfile(indexPath(path)):
+            entries = loadIndex(indexPath(path))
+
+        first = None
+        last = None
+        startTime = _ALL_TIME[0]
+        if len(entries) > 0:
+            (first, last) = (entries[0][0], entries[-1][0])
+            startTime = last
+        for item in _fileRows(path, 0, startTime):
+            if first == None or item[0] < first:
+                first = item[0]
+            if last == None or item[0] > last:
+                last = item[0]
+    except (IndexFormatError, BinFormatError) as e:
+        raise ReplayError(path+": "+str(e))
+
+    if first == None:
+        return None
+    return (first, last)
+
+# Merges the rows of the given files into ('slice', epoch time, slice) and
+#   ('event', epoch time, (timestamp, version, event)) items, in time order.
+def replayItems(paths):
+    streams = [_fileRows(path, i) for (i, path) in enumerate(paths)]
+    pending = None # (epoch time, slice) of raw/spectrogram data.
+
+    for (epochTime, order, fileNumber, dataType, row) in heapq.merge(*streams):
+        if dataType == DATA_RAW or dataType == DATA_SGRAM:
+            key = 'Waveform'
+            if dataType == DATA_SGRAM:
+                key = 'FrequencyBins'
+
+            if pending != None and ( pending[0] != epochTime or
+                                     len(pending[1][key]) > 0 ):
+                yield ('slice', pending[0], pending[1])
+                pending = None
+            if pending == None:
+                pending = (epochTime, _newSlice(row))
+
+            values = [float(value) for value in row[5:]]
+            if dataType == DATA_RAW:
+                pending[1]['Waveform'] = values
+            else:
+                pending[1]['FrequencyBins'] = dict(zip(FREQUENCY_BINS, values))
+            continue
+
+        if pending != None:
+            yield ('slice', pending[0], pending[1])
+            pending = None
+
+        if dataType == DATA_HGRAM:
+            stageSlice = _newSlice(row)
+            stageSlice['SleepStage'] = row[6]
+            yield ('slice', epochTime, stageSlice)
+        else:
+            (timestamp, version, event) = row
+            yield ('event', epochTime, (timestamp, int(version), event))
+
+    if pending != None:
+        yield ('slice', pending[0], pending[1])
+
+class ReplayLink ( threading.Thread ):
+
+    def __init__(self, paths, speed=REPLAY_MAX_SPEED):
+        threading.Thread.__init__(self, name="ReplayLink")
+        self.daemon = True
+        self.paths = paths
+        self.speed = speed
+        self.portStr = "replay"
+        self.connected = False
+        self.connectCallbacks = []
+        self.disconnectCallbacks = []
+        self.sliceCallbacks = []
+        self.eventCallbacks = []
+        self.ioLock = None
+        self._killed = threading.Event()
+
+        # Statistics, for working out throughput.
+        self.slicesSent = 0
+        self.eventsSent = 0
+        self.startTime = None
+        self.endTime = None
+
+    # Parser callback interface.
+    def addSliceCallback(self, func):
+        self.sliceCallbacks.append(func)
+
+    def addEventCallback(self, func):
+        self.eventCallbacks.append(func)
+
+    # Stops the replay after the current slice.
+    def kill(self):
+        self._killed.set()
+
+    # Wall clock seconds the replay has run for.
+    def elapsed(self):
+        if self.startTime == None:
+            return 0.0
+        if self.endTime == None:
+            return time.time() - self.startTime
+        return self.endTime - self.startTime
+
+    def slicesPerSecond(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0.0:
+            return 0.0
+        return self.slicesSent / elapsed
+
+    def run(self):
+        self.connected = True
+        for func in self.connectCallbacks:
+            func(self)
+
+        self.startTime = time.time()
+        try:
+            self._replay()
+        except Exception:
+            if ( self.ioLock != None ): self.ioLock.acquire()
+            print "Replay failed:"
+            traceback.print_exc()
+            if ( self.ioLock != None ): self.ioLock.release()
+        self.endTime = time.time()
+
+        self.connected = False
+        for func in self.disconnectCallbacks:
+            func(self)
+
+    def _replay(self):
+        firstTime = None
+        for (kind, epochTime, item) in replayItems(self.paths):
+            if self._killed.isSet():
+                break
+
+            if self.speed > 0.0:
+                if firstTime == None:
+                    firstTime = epochTime
+                due = self.startTime + (epochTime - firstTime) / self.speed
+                delay = due - time.time()
+                if delay > 0.0:
+                    self._killed.wait(delay)
+                    if self._killed.isSet():
+                        break
+
+            if kind == 'slice':
+                for func in self.sliceCallbacks:
+                    func(item)
+                self.slicesSent += 1
+            else:
+                for func in self.eventCallbacks:
+                    func(*item)
+                self.eventsSent += 1
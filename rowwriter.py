@@ -0,0 +1,467 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Writes recorded rows to disk on a thread of its own.
+#
+# The serial link's thread only has to put rows on a bounded queue.  This
+#   thread takes them off, keeps one open file (and one csv.writer) per
+#   destination, and flushes according to the recording section of the config
+#   file: after some number of rows, after some amount of time, and/or at the
+#   end of every 30 second epoch.
+#
+# Files whose names end in a compression extension (.gz, .bz2, ...) are
+#   written in compressed blocks; see compressedio.py.  Those only write a
+#   block when a flush finds enough data waiting, or data that has waited
+#   long enough, since small blocks compress badly.
+#
+# Raw and spectrogram files also get a timestamp index, written next to them
+#   as rows are added; see timeindex.py.
+#
+# If the disk stalls for long enough that the queue fills up, the link's
+#   thread waits a little while for room and then gives up on the row, which
+#   is counted in rowsDropped.  Losing a row is better than backing up the
+#   serial port and losing the packets after it.
+
+import os
+import csv
+import time
+import struct
+import threading
+import traceback
+import Queue
+
+from common import *
+from binformat import BinHeader, BinFormatError, BIN_EXTENSION, \
+    readHeader, parseHeader, recordFormat, packRecord
+from compressedio import BlockCompressedFile, codecForPath, stripCodecExtension
+from timeindex import TimeIndexWriter, INDEXED_DATA_TYPES, indexPath
+from stats import pipelineStats, clock
+from termcolor import colored
+
+# Size of the userspace buffer for each open file.  Rows pile up here between
+#   flushes.
+FILE_BUFFER_SIZE = 64 * 1024
+
+# Opens a compressed file for appending, with block sizes from the policy.
+def _openCompressed(path, codec, policy):
+    return BlockCompressedFile(path, codec, policy.compressBlockKb * 1024,
+        policy.compressBlockMs / 1000.0)
+
+def _flushStream(fstream, sync):
+    if isinstance(fstream, BlockCompressedFile):
+        fstream.flush(sync)
+        return
+    fstream.flush()
+    if sync:
+        os.fsync(fstream.fileno())
+
+# How many bytes have been written to fstream, counting those that haven't
+#   been flushed yet, but not data waiting to be compressed.
+def _streamSize(fstream):
+    if isinstance(fstream, BlockCompressedFile):
+        return fstream.compressedSize
+    return fstream.tell()
+
+# Where the next row written to fstream will start, as (offset, skip); see
+#   timeindex.py.
+def _streamPosition(fstream):
+    if isinstance(fstream, BlockCompressedFile):
+        return fstream.blockPosition()
+    return (fstream.tell(), 0)
+
+# Opens the index for a data file that has just been opened, or returns None
+#   if it doesn't get one.
+def _openIndex(path, dataType, policy):
+    if policy.indexSeconds <= 0 or dataType not in INDEXED_DATA_TYPES:
+        return None
+    dataSize = 0
+    if os.path.isfile(path):
+        dataSize = os.path.getsize(path)
+    return TimeIndexWriter(indexPath(path), dataSize, policy.indexSeconds)
+
+# Writes rows as CSV text to a plain or compressed file.
+class CsvSink:
+    def __init__(self, path, dataType, policy):
+        self.path = path
+        self.droppedBytes = 0
+        codec = codecForPath(path)
+        if codec != None:
+            self.fstream = _openCompressed(path, codec, policy)
+            self.droppedBytes = self.fstream.droppedBytes
+            needHeader = self.fstream.lastBlock == None
+        else:
+            needHeader = not os.path.isfile(path) or os.path.getsize(path) == 0
+            self.fstream = open(path, 'ab', FILE_BUFFER_SIZE)
+            # tell() isn't right for appended files until something moves
+            #   the position.
+            self.fstream.seek(0, os.SEEK_END)
+        self.writer = csv.writer(self.fstream, delimiter=',', quotechar='"',
+            quoting=csv.QUOTE_MINIMAL)
+        if needHeader:
+            self.writer.writerow(getHeader(dataType))
+        self.index = _openIndex(path, dataType, policy)
+
+    def write(self, row, epochTime):
+        if self.index != None and self.index.wants(epochTime):
+            (offset, skip) = _streamPosition(self.fstream)
+            self.index.add(epochTime, offset, skip)
+        self.writer.writerow(row)
+
+    def flush(self, sync=False):
+        _flushStream(self.fstream, sync)
+        if self.index != None:
+            self.index.flush(sync)
+
+    def size(self):
+        return _streamSize(self.fstream)
+
+    def close(self):
+        self.fstream.close()
+        if self.index != None:
+            self.index.close()
+
+# Writes rows as fixed-size binary records, to a plain or compressed file;
+#   see binformat.py.
+class BinSink:
+    def __init__(self, path, dataType, policy):
+        self.path = path
+        self.dataType = dataType
+        self.header = None
+        self.fstream = None
+        self.droppedBytes = 0
+        self._packer = None
+
+        codec = codecForPath(path)
+        if codec != None:
+            self.fstream = _openCompressed(path, codec, policy)
+            self.droppedBytes = self.fstream.droppedBytes
+            if self.fstream.lastBlock != None:
+                self._openExisting(parseHeader, self.fstream.head, None)
+        elif os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.fstream = open(path, 'r+b', FILE_BUFFER_SIZE)
+            self._openExisting(readHeader, self.fstream, os.path.getsize(path))
+
+        self.index = _openIndex(path, dataType, policy)
+
+    # size is the size of a plain file.  Compressed files have their last
+    #   block checked instead.
+    def _openExisting(self, headerReader, source, size):
+        try:
+            header = headerReader(source)
+            if header.dataType != self.dataType:
+                raise BinFormatError(self.path+" holds "+
+                    dataTypeConstToString(header.dataType)+" data, not "+
+                    dataTypeConstToString(self.dataType)+" data.")
+
+            if isinstance(self.fstream, BlockCompressedFile):
+                # Blocks always end between records, so if the last one does
+                #   then they all do.
+                (blockStart, blockSize) = self.fstream.lastBlock
+                if blockStart == 0:
+                    blockSize -= header.headerSize
+                if blockSize % header.recordSize != 0:
+                    raise BinFormatError(self.path+" ends partway through a record.")
+            else:
+                nRecords = (size - header.headerSize) // header.recordSize
+                end = header.headerSize + nRecords * header.recordSize
+                # Drop any partial record left over from a crash, so that
+                #   appended records line up.
+                self.droppedBytes = size - end
+                self.fstream.truncate(end)
+                self.fstream.seek(end)
+        except:
+            self.fstream.close()
+            raise
+
+        self.header = header
+        self._packer = struct.Struct(recordFormat(header))
+
+    def write(self, row, epochTime):
+        if self.header == None:
+            # A new file.  How many values there are isn't known until the
+            #   first row shows up.
+            self.header = BinHeader(self.dataType, len(row) - 5)
+            self._packer = struct.Struct(recordFormat(self.header))
+            if self.fstream == None:
+                self.fstream = open(self.path, 'wb', FILE_BUFFER_SIZE)
+            self.fstream.write(self.header.pack())
+
+        if self.index != None and self.index.wants(epochTime):
+            (offset, skip) = _streamPosition(self.fstream)
+            self.index.add(epochTime, offset, skip)
+        self.fstream.write(packRecord(self.header, self._packer, row, epochTime))
+
+    def flush(self, sync=False):
+        if self.fstream != None:
+            _flushStream(self.fstream, sync)
+        if self.index != None:
+            self.index.flush(sync)
+
+    def size(self):
+        if self.fstream == None:
+            return 0
+        return _streamSize(self.fstream)
+
+    def close(self):
+        if self.fstream != None:
+            self.fstream.close()
+        if self.index != None:
+            self.index.close()
+
+# Picks a sink implementation based on the destination's file name.
+# policy is the RecordingSection, which has the compressed block sizes.
+def openSink(path, dataType, policy):
+    newDir = os.path.dirname(path)
+    if not os.path.isdir(newDir):
+        os.makedirs(newDir)
+
+    if stripCodecExtension(path).endswith(BIN_EXTENSION):
+        sink = BinSink(path, dataType, policy)
+    else:
+        sink = CsvSink(path, dataType, policy)
+
+    if sink.droppedBytes > 0:
+        print ""
+        print "The end of "+colored(path, 'yellow', attrs=['bold'])+\
+            " was damaged, probably by a crash."
+        print "Cut off "+str(sink.droppedBytes)+" bytes and carried on from there."
+
+    return sink
+
+# Per-destination bookkeeping for the writer thread.
+class _Destination:
+    def __init__(self, sink):
+        self.sink = sink
+        self.pendingRows = 0
+        self.firstPendingTime = None
+        self.flushedSize = sink.size()
+
+# Queue commands.
+_CMD_ROW       = 0
+_CMD_CLOSE_ALL = 1
+_CMD_STOP      = 2
+
+class RowWriter ( threading.Thread ):
+
+    # policy is a RecordingSection from the config file.
+    def __init__(self, policy):
+        threading.Thread.__init__(self, name="RowWriter")
+        self.daemon = True
+        self.policy = policy
+
+        self._queue = Queue.Queue(policy.queueRows)
+        self._destinations = {}
+
+        # If True, put() waits for room as long as it takes instead of
+        #   dropping rows.  Replays set this, since they have no serial port
+        #   to keep up with.
+        self.blockWhenFull = False
+
+        # Statistics.  These are only ever incremented, and only by one
+        #   thread each, so they can be read without locking.
+        self.rowsQueued = 0
+        self.rowsDropped = 0
+        self.rowsWritten = 0
+        self.flushes = 0
+
+        self._writeStage = pipelineStats.stage('writer: write row')
+        self._flushStage = pipelineStats.stage('writer: flush')
+
+    # Queues a row to be written.  key identifies the destination (an output
+    #   table and a data type); when the path for a key changes, the old file
+    #   is closed and the new one opened.
+    # epochTime is the row's Zeo time in epoch seconds.
+    # If epochEnd is True then this row completes an epoch, which flushes
+    #   everything if the policy asks for that.
+    # Returns False if the row had to be dropped.
+    def put(self, key, path, dataType, row, epochTime, epochEnd=False):
+        item = (_CMD_ROW, key, path, dataType, row, epochTime, epochEnd)
+        timeout = self.policy.queueBlockMs / 1000.0
+        if self.blockWhenFull:
+            timeout = None
+        try:
+            self._queue.put(item, True, timeout)
+        except Queue.Full:
+            self.rowsDropped += 1
+            pipelineStats.count('rows dropped')
+            return False
+
+        self.rowsQueued += 1
+        return True
+
+    # Number of rows waiting to be written.
+    def queueDepth(self):
+        return self._queue.qsize()
+
+    # Closes every open file.  Files will be reopened as rows arrive.
+    def closeAll(self):
+        self._queue.put((_CMD_CLOSE_ALL,))
+
+    # Writes out everything that's queued, closes the files, and ends the
+    #   thread.
+    def close(self):
+        self._queue.put((_CMD_STOP,))
+        self.join()
+
+    def run(self):
+        running = True
+        while running:
+            item = self._get()
+
+            # Take everything that's already waiting before checking the
+            #   timers, so that rows get batched up per file.
+            while item != None:
+                if not self._handle(item):
+                    running = False
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    item = None
+
+            self._flushDue(time.time())
+
+        self._closeAll()
+
+    # Waits for the next queue item, or until a timed flush is due.
+    # Returns None in the latter case.
+    def _get(self):
+        timeout = self._timeUntilFlushDue()
+        try:
+            if timeout == None:
+                return self._queue.get()
+            else:
+                return self._queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    # Returns False when the thread should stop.
+    def _handle(self, item):
+        cmd = item[0]
+        if cmd == _CMD_STOP:
+            return False
+        elif cmd == _CMD_CLOSE_ALL:
+            self._closeAll()
+            return True
+
+        (cmd, key, path, dataType, row, epochTime, epochEnd) = item
+
+        try:
+            dest = self._destinations.get(key)
+            if dest == None or dest.sink.path != path:
+                if dest != None:
+                    self._closeDestination(key)
+                dest = _Destination(openSink(path, dataType, self.policy))
+                self._destinations[key] = dest
+
+            start = clock()
+            dest.sink.write(row, epochTime)
+            self._writeStage.record(clock() - start)
+            self.rowsWritten += 1
+            pipelineStats.count('rows written')
+
+            if dest.pendingRows == 0:
+                dest.firstPendingTime = time.time()
+            dest.pendingRows += 1
+
+            if self.policy.flushRows > 0 and dest.pendingRows >= self.policy.flushRows:
+                self._flush(dest)
+        except Exception as e:
+            print ""
+            print "Could not write data with timestamp "+colored(row[0], 'yellow', attrs=['bold'])
+            print "The destination file was "+colored(path, 'yellow', attrs=['bold'])
+            print "The following exception was given:"
+            traceback.print_exc()
+
+        if epochEnd and self.policy.flushOnEpoch:
+            for dest in self._destinations.itervalues():
+                self._flush(dest)
+
+        return True
+
+    # Returns the seconds until the oldest unflushed row needs flushing, or
+    #   None if nothing is waiting on a timer.
+    def _timeUntilFlushDue(self):
+        if self.policy.flushMs <= 0:
+            return None
+
+        oldest = None
+        for dest in self._destinations.itervalues():
+            if dest.pendingRows > 0:
+                if oldest == None or dest.firstPendingTime < oldest:
+                    oldest = dest.firstPendingTime
+
+        if oldest == None:
+            return None
+
+        return max(0.0, oldest + (self.policy.flushMs / 1000.0) - time.time())
+
+    def _flushDue(self, now):
+        if self.policy.flushMs <= 0:
+            return
+
+        for dest in self._destinations.itervalues():
+            if ( dest.pendingRows > 0 and
+                 now >= dest.firstPendingTime + (self.policy.flushMs / 1000.0) ):
+                self._flush(dest)
+
+    def _flush(self, dest):
+        if dest.pendingRows == 0:
+            return
+
+        try:
+            start = clock()
+            dest.sink.flush(self.policy.fsync)
+            self._flushStage.record(clock() - start)
+            size = dest.sink.size()
+            pipelineStats.count('bytes written', size - dest.flushedSize)
+            dest.flushedSize = size
+        except Exception:
+            print ""
+            print "Could not flush "+colored(dest.sink.path, 'yellow', attrs=['bold'])
+            traceback.print_exc()
+
+        dest.pendingRows = 0
+        dest.firstPendingTime = None
+        self.flushes += 1
+
+    def _closeDestination(self, key):
+        dest = self._destinations.pop(key)
+        try:
+            self._flush(dest)
+            dest.sink.close()
+        except Exception:
+            print ""
+            print "Could not close "+colored(dest.sink.path, 'yellow', attrs=['bold'])
+            traceback.print_exc()
+
+    def _closeAll(self):
+        for key in self._destinations.keys():
+            self._closeDestination(key)
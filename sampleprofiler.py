@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# A sampling profiler for long runs, and a report tool for what it saves.
+#
+# Started with encabulator.pyw --profile DIR, a thread wakes up every few
+#   milliseconds and looks at what every other thread is doing
+#   (sys._current_frames()).  Each thread's stack is counted, and every so
+#   often the counts are written to DIR as a gzipped JSON snapshot and started
+#   over, so a whole night's worth is kept in small pieces and a crash only
+#   loses the last few minutes.
+#
+# The samples are of wall clock time: a thread that is waiting on the serial
+#   port is counted in the function that is waiting.  Samples come a little
+#   further apart than the interval, since taking one takes time too, so each
+#   snapshot also keeps the wall clock time its samples actually covered, and
+#   the report spreads that over them.  Looking at one thread
+#   at a time (--thread) keeps that from hiding where the busy threads go.
+#
+# To see the results:
+#
+#   python sampleprofiler.py DIR [--top 30] [--thread ToughLink]
+#
+# which merges the snapshots and lists functions by the time they were at the
+#   top of a stack (self) and anywhere on it (cumulative).  --folded writes
+#   the stacks in the "folded" format that flame graph tools read.
+
+import os
+import sys
+import glob
+import gzip
+import json
+import time
+import threading
+from optparse import OptionParser
+
+SNAPSHOT_PREFIX = "profile-"
+SNAPSHOT_EXTENSION = ".json.gz"
+
+# Deeper stacks are cut off at the outermost end.
+MAX_STACK_DEPTH = 64
+
+# Returns a name for the function that frame is running.
+def _frameLabel(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+class SamplingProfiler ( threading.Thread ):
+
+    # interval is the seconds between samples, and rotateSeconds the seconds
+    #   between snapshots.
+    def __init__(self, directory, interval=0.01, rotateSeconds=600.0):
+        threading.Thread.__init__(self, name="SamplingProfiler")
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.rotateSeconds = rotateSeconds
+        self._done = threading.Event()
+        self._labels = {} # code object -> label
+        self._reset(time.time())
+
+    def _reset(self, now):
+        self.startTime = now
+        self.samples = 0
+        self.sampledSeconds = 0.0 # Sum of the time between samples.
+        self.stacks = {} # (thread name, stack tuple) -> count
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def run(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        myId = threading.current_thread().ident
+        nextRotation = time.time() + self.rotateSeconds
+        lastSample = time.time()
+        while not self._done.wait(self.interval):
+            # Each sample stands for the time since the one before it.
+            now = time.time()
+            self.sampledSeconds += max(0.0, now - lastSample)
+            lastSample = now
+            self._sample(myId)
+            if now >= nextRotation:
+                self._save(now)
+                nextRotation = now + self.rotateSeconds
+
+        self._save(time.time())
+
+    def _sample(self, myId):
+        names = {}
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+
+        labels = self._labels
+        stacks = self.stacks
+        for (threadId, frame) in sys._current_frames().items():
+            if threadId == myId:
+                continue
+            stack = []
+            while frame != None and len(stack) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                label = labels.get(code)
+                if label == None:
+                    label = _frameLabel(frame)
+                    labels[code] = label
+                stack.append(label)
+                frame = frame.f_back
+            stack.reverse()
+
+            key = (names.get(threadId, str(threadId)), tuple(stack))
+            stacks[key] = stacks.get(key, 0) + 1
+        self.samples += 1
+
+    def _save(self, now):
+        if self.samples == 0:
+            return
+        snapshot = {
+            'start'    : self.startTime,
+            'end'      : now,
+            'interval' : self.interval,
+            'samples'  : self.samples,
+            'seconds'  : self.sampledSeconds,
+            'stacks'   : [[name, list(stack), count] for ((name, stack), count)
+                          in self.stacks.iteritems()],
+            }
+        fileName = SNAPSHOT_PREFIX + time.strftime("%Y%m%d-%H%M%S",
+            time.localtime(self.startTime)) + SNAPSHOT_EXTENSION
+        path = os.path.join(self.directory, fileName)
+        try:
+            # Written under another name first, so the report tool never
+            #   sees half a file.
+            snapshotFile = gzip.open(path + ".part", 'wb')
+            try:
+                json.dump(snapshot, snapshotFile)
+            finally:
+                snapshotFile.close()
+            os.rename(path + ".part", path)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Could not save profile snapshot "+path+": "+str(e)+"\n")
+        self._reset(now)
+
+def loadSnapshot(path):
+    snapshotFile = gzip.open(path, 'rb')
+    try:
+        return json.load(snapshotFile)
+    finally:
+        snapshotFile.close()
+
+# Returns the snapshot files among paths, which may be files or directories.
+def snapshotPaths(paths):
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(sorted(glob.glob(os.path.join(path,
+                SNAPSHOT_PREFIX + "*" + SNAPSHOT_EXTENSION))))
+        else:
+            found.append(path)
+    return found
+
+# Adds up snapshots.  Returns (seconds sampled, {thread name : seconds},
+#   {function : self seconds}, {function : cumulative seconds},
+#   {folded stack : seconds}).  Only threads whose names start with
+#   threadPrefix are counted, if it is given.
+def mergeSnapshots(snapshots, threadPrefix=None):
+    sampled = 0.0
+    threads = {}
+    selfTime = {}
+    cumulative = {}
+    folded = {}
+    for snapshot in snapshots:
+        if snapshot['samples'] == 0:
+            continue
+        # What one sample stands for.  Older snapshots only have the interval
+        #   they asked for.
+        covered = snapshot.get('seconds')
+        if covered == None:
+            covered = snapshot['samples'] * snapshot['interval']
+        interval = covered / snapshot['samples']
+        sampled += covered
+        for (name, stack, count) in snapshot['stacks']:
+            if threadPrefix != None and not name.startswith(threadPrefix):
+                continue
+            seconds = count * interval
+            threads[name] = threads.get(name, 0.0) + seconds
+            if len(stack) == 0:
+                continue
+            selfTime[stack[-1]] = selfTime.get(stack[-1], 0.0) + seconds
+            # Recursive functions only count once per stack.
+            for label in set(stack):
+                cumulative[label] = cumulative.get(label, 0.0) + seconds
+            key = ";".join([name] + stack)
+            folded[key] = folded.get(key, 0.0) + seconds
+    return (sampled, threads, selfTime, cumulative, folded)
+
+def _printTable(title, times, total, top):
+    print ""
+    print "%10s %7s  %s" % ("seconds", "%", title)
+    ranked = sorted(times.iteritems(), key=lambda item: item[1], reverse=True)
+    for (label, seconds) in ranked[:top]:
+        share = 0.0
+        if total > 0:
+            share = 100.0 * seconds / total
+        print "%10.1f %6.1f%%  %s" % (seconds, share, label)
+
+def main(argv):
+    parser = OptionParser(usage="%prog [options] DIR_OR_SNAPSHOT...")
+    parser.add_option("--top", type="int", default=30,
+        help="How many functions to list.")
+    parser.add_option("--thread", metavar="NAME",
+        help="Only count threads whose names start with NAME.")
+    parser.add_option("--folded", metavar="FILE",
+        help="Also write the merged stacks in folded format to FILE.")
+    (options, args) = parser.parse_args(argv)
+    if len(args) == 0:
+        parser.error("Give the --profile directory or some snapshot files.")
+
+    paths = snapshotPaths(args)
+    if len(paths) == 0:
+        parser.error("No profile snapshots found.")
+    snapshots = [loadSnapshot(path) for path in paths]
+
+    (sampled, threads, selfTime, cumulative, folded) = \
+        mergeSnapshots(snapshots, options.thread)
+    start = min(snapshot['start'] for snapshot in snapshots)
+    end = max(snapshot['end'] for snapshot in snapshots)
+
+    print str(len(paths))+" snapshots from "+\
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start))+" to "+\
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(end))+\
+        (", %.0f seconds sampled." % sampled)
+    threadTotal = sum(threads.values())
+    _printTable("thread", threads, threadTotal, options.top)
+    _printTable("function (self)", selfTime, threadTotal, options.top)
+    _printTable("function (cumulative)", cumulative, threadTotal, options.top)
+
+    if options.folded != None:
+        foldedFile = open(options.folded, 'w')
+        for (key, seconds) in sorted(folded.iteritems()):
+            foldedFile.write("%s %d\n" % (key, int(round(seconds * 1000))))
+        foldedFile.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Shares the latest waveforms and spectrograms with other processes through
+#   memory-mapped ring buffers.
+#
+# Analysis programs running on the same computer can map the ring files and
+#   read slices as they arrive, without going through the CSV files or the
+#   disk at all.  Put the files in /dev/shm (or another tmpfs) on Linux so
+#   they are only ever in memory.
+#
+# There is one ring file for raw waveforms and one for spectrograms, named
+#   after the configured path with RING_EXTENSIONS added.  Each is a header
+#   followed by a fixed number of slots, and slice n (counting from 1) goes
+#   in slot (n - 1) % slots, overwriting whatever was there.
+#
+# Header, HEADER_SIZE bytes:
+#   8s  magic
+#   I   format version
+#   I   data type (DATA_RAW or DATA_SGRAM from common.py)
+#   I   values per slot
+#   I   number of slots
+#   I   slot size in bytes
+#   I   header size in bytes (the offset of the first slot)
+#   q   session: when the writer set the ring up, in microseconds.  If this
+#       changes, the ring was set up again and readers should open the path
+#       again and start over.
+#   Q   written: how many slices have been written to the ring so far.  This
+#       is updated after each slot is complete.
+#   the rest is zeros.
+#
+# Slot:
+#   Q   sequence: which slice (n) the slot holds, or 0 while it is being
+#       written.
+#   then a record in the .bin file layout (see binformat.py).
+#
+# Nothing is locked.  A reader copies a slot and then checks that its
+#   sequence number is still the one it wanted; if not, the writer lapped
+#   it, and the copy is thrown away.  RingReader does this.  With numpy, the
+#   slots can be looked at in place:
+#
+#   header = readRingHeader(path)
+#   ring = numpy.memmap(path, dtype=numpy.dtype(slotDtype(header)), mode='r',
+#                       offset=header.headerSize, shape=(header.slots,))
+#
+#   after which ring['values'] is a (slots, values per slot) array and
+#   ring['sequence'] says which slice each row holds.  Check the sequence
+#   numbers again after using the rows.
+#
+# A ring file is never resized or cleared while it might be mapped.  When the
+#   writer starts, it sets up a new file under another name and renames it
+#   over the old one, then writes the new session into the old file's header
+#   so that the old file's readers open the path again.  Opening a ring
+#   raises RingFormatError (or EnvironmentError) if there is no ring at the
+#   path yet or it isn't one; readers should wait a moment and try again.
+#   RingReader.read() opens the file again itself the next time it is called.
+
+import os
+import mmap
+import time
+import struct
+import calendar
+import platform
+
+from common import *
+from binformat import RECORD_PREFIX_FORMAT, recordDtype
+
+RING_MAGIC   = b'PERING\0\0'
+RING_VERSION = 1
+HEADER_FORMAT = '<8sIIIIIIqQ'
+HEADER_SIZE = 64
+
+# Where the session and the written count are in the header.
+SESSION_OFFSET = struct.calcsize(HEADER_FORMAT) - 16
+SESSION_FORMAT = '<q'
+WRITTEN_OFFSET = struct.calcsize(HEADER_FORMAT) - 8
+
+SEQUENCE_FORMAT = '<Q'
+SEQUENCE_SIZE = struct.calcsize(SEQUENCE_FORMAT)
+
+# The file name endings for each ring.
+RING_EXTENSIONS = {
+    DATA_RAW   : ".raw.ring",
+    DATA_SGRAM : ".spectrogram.ring",
+    }
+
+# Values per slot for each ring.
+RING_VALUES = {
+    DATA_RAW   : 128,
+    DATA_SGRAM : 7,
+    }
+
+DEFAULT_SLOTS = 4096
+
+class RingFormatError(ValueError):
+    ''' A file is not a ring, or is one this code can't read. '''
+    pass
+
+class RingHeader:
+    def __init__(self, dataType, nValues, slots, session=0):
+        self.dataType = dataType
+        self.nValues = nValues
+        self.slots = slots
+        self.session = session
+        self.slotSize = SEQUENCE_SIZE + struct.calcsize(_slotRecordFormat(nValues))
+        self.headerSize = HEADER_SIZE
+
+    def pack(self, written=0):
+        header = struct.pack(HEADER_FORMAT, RING_MAGIC, RING_VERSION,
+            self.dataType, self.nValues, self.slots, self.slotSize,
+            self.headerSize, self.session, written)
+        return header + b'\0' * (HEADER_SIZE - len(header))
+
+    def fileSize(self):
+        return self.headerSize + self.slots * self.slotSize
+
+def _slotRecordFormat(nValues):
+    return RECORD_PREFIX_FORMAT + str(nValues) + 'f'
+
+def ringPath(basePath, dataType):
+    return basePath + RING_EXTENSIONS[dataType]
+
+# Reads the header from the first bytes of a ring.  Returns (header, written).
+def parseRingHeader(data):
+    size = struct.calcsize(HEADER_FORMAT)
+    if len(data) < size:
+        raise RingFormatError("File is too short to be a ring.")
+
+    (magic, version, dataType, nValues, slots, slotSize, headerSize, session,
+        written) = struct.unpack(HEADER_FORMAT, data[:size])
+    if magic != RING_MAGIC:
+        raise RingFormatError("Not a ring file, or it is still being set up.")
+    if version != RING_VERSION:
+        raise RingFormatError("Unsupported ring version: "+str(version))
+
+    header = RingHeader(dataType, nValues, slots, session)
+    if header.slotSize != slotSize or headerSize < HEADER_SIZE or slots < 1:
+        raise RingFormatError("Corrupt ring header.")
+    header.headerSize = headerSize
+    return (header, written)
+
+def readRingHeader(path):
+    ringFile = open(path, 'rb')
+    try:
+        return parseRingHeader(ringFile.read(HEADER_SIZE))[0]
+    finally:
+        ringFile.close()
+
+# A numpy dtype description of a slot.  Pass it to numpy.dtype().
+def slotDtype(header):
+    return [('sequence', '<u8')] + recordDtype(header)
+
+# Writes slices into a ring file.
+class RingWriter:
+    def __init__(self, path, dataType, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.header = RingHeader(dataType, RING_VALUES[dataType], slots,
+            int(time.time() * 1000000))
+        self.written = 0
+        self._packer = struct.Struct(_slotRecordFormat(self.header.nValues))
+
+        # Set up under another name, so that nothing a reader has mapped
+        #   changes size.  A new file is all zeros, so every slot starts out
+        #   empty.
+        partPath = path + ".part"
+        size = self.header.fileSize()
+        fd = os.open(partPath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        finally:
+            os.close(fd)
+        self.map[:HEADER_SIZE] = self.header.pack()
+
+        oldFd = None
+        try:
+            if platform.system() == 'Windows':
+                # rename() won't replace a file there.
+                if os.path.exists(path):
+                    os.remove(path)
+            elif os.path.isfile(path):
+                oldFd = os.open(path, os.O_RDWR)
+            os.rename(partPath, path)
+            if oldFd != None:
+                _retireRing(oldFd, self.header.session)
+        except:
+            self.close()
+            raise
+        finally:
+            if oldFd != None:
+                os.close(oldFd)
+
+    def _slotOffset(self, slot):
+        return self.header.headerSize + slot * self.header.slotSize
+
+    def write(self, epochTime, version, sqi, impedance, badSignal, values):
+        if self.map == None:
+            return
+        sequence = self.written + 1
+        offset = self._slotOffset((sequence - 1) % self.header.slots)
+        struct.pack_into(SEQUENCE_FORMAT, self.map, offset, 0)
+        self._packer.pack_into(self.map, offset + SEQUENCE_SIZE, epochTime,
+            version, sqi, impedance, badSignal, *values)
+        struct.pack_into(SEQUENCE_FORMAT, self.map, offset, sequence)
+        struct.pack_into(SEQUENCE_FORMAT, self.map, WRITTEN_OFFSET, sequence)
+        self.written = sequence
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+
+# Tells the readers of a ring file that has been replaced to open the path
+#   again, by giving it the new ring's session.  Leaves files that aren't
+#   rings alone.
+def _retireRing(fd, session):
+    try:
+        parseRingHeader(os.read(fd, HEADER_SIZE))
+    except RingFormatError:
+        return
+    os.lseek(fd, SESSION_OFFSET, os.SEEK_SET)
+    os.write(fd, struct.pack(SESSION_FORMAT, session))
+
+# Reads the slices that have been written to a ring since the last read().
+class RingReader:
+
+    # If fromOldest is True, the first read() returns everything still in the
+    #   ring; otherwise it starts with what is written after this.
+    def __init__(self, path, fromOldest=False):
+        self.path = path
+        self.fromOldest = fromOldest
+        self.lost = 0 # Slices overwritten before they could be read.
+        self.map = None
+        self._open()
+
+    def _open(self):
+        self.close()
+        ringFile = open(self.path, 'rb')
+        try:
+            size = os.fstat(ringFile.fileno()).st_size
+            self.map = mmap.mmap(ringFile.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            ringFile.close()
+        try:
+            (self.header, written) = parseRingHeader(self.map[:HEADER_SIZE])
+            if size < self.header.fileSize():
+                raise RingFormatError("Ring file is shorter than its header says.")
+        except RingFormatError:
+            # So that the next read() tries again.
+            self.close()
+            raise
+        self._unpacker = struct.Struct(_slotRecordFormat(self.header.nValues))
+        if self.fromOldest:
+            self.nextSequence = max(1, written - self.header.slots + 1)
+        else:
+            self.nextSequence = written + 1
+
+    # Returns a list of (sequence, epoch time, version, sqi, impedance,
+    #   bad signal, (values...)) for the slices written since the last call.
+    #   Starts over if the writer set the ring up again.
+    # Raises RingFormatError or EnvironmentError if the ring has to be opened
+    #   again and can't be yet; call it again later.
+    def read(self):
+        if self.map == None:
+            self._open()
+        (header, written) = parseRingHeader(self.map[:HEADER_SIZE])
+        if header.session != self.header.session:
+            self.fromOldest = True
+            self._open()
+            (header, written) = parseRingHeader(self.map[:HEADER_SIZE])
+
+        slots = self.header.slots
+        if written - self.nextSequence + 1 > slots:
+            skipTo = written - slots + 1
+            self.lost += skipTo - self.nextSequence
+            self.nextSequence = skipTo
+
+        records = []
+        while self.nextSequence <= written:
+            sequence = self.nextSequence
+            offset = self.header.headerSize + \
+                ((sequence - 1) % slots) * self.header.slotSize
+            data = self.map[offset : offset + self.header.slotSize]
+            (seen,) = struct.unpack_from(SEQUENCE_FORMAT, data)
+            (after,) = struct.unpack_from(SEQUENCE_FORMAT, self.map, offset)
+            self.nextSequence += 1
+            if seen != sequence or after != sequence:
+                self.lost += 1
+                continue
+            fields = self._unpacker.unpack_from(data, SEQUENCE_SIZE)
+            records.append((sequence,) + fields[:5] + (fields[5:],))
+        return records
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+
+def _intOr(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+# A slice consumer that writes waveforms and spectrograms to their rings.
+class RingExporter:
+
+    # basePath is the ring file path without RING_EXTENSIONS.
+    def __init__(self, basePath, slots=DEFAULT_SLOTS):
+        self.basePath = basePath
+        self.rings = {}
+        for dataType in RING_EXTENSIONS:
+            self.rings[dataType] = RingWriter(ringPath(basePath, dataType),
+                dataType, slots)
+
+    def updateSlice(self, slice):
+        epochTime = slice.epochTime
+        if epochTime == None:
+            epochTime = calendar.timegm(time.localtime())
+        version = _intOr(slice['Version'], 0)
+        sqi = _intOr(slice['SQI'], -1)
+        impedance = _intOr(slice['Impedance'], -1)
+        badSignal = int(bool(slice['BadSignal']))
+
+        waveform = slice['Waveform']
+        if len(waveform) == RING_VALUES[DATA_RAW]:
+            self.rings[DATA_RAW].write(epochTime, version, sqi, impedance,
+                badSignal, waveform)
+
+        bins = slice['FrequencyBins']
+        if len(bins) == len(FREQUENCY_BINS):
+            self.rings[DATA_SGRAM].write(epochTime, version, sqi, impedance,
+                badSignal, [bins[name] for name in FREQUENCY_BINS])
+
+    def updateEvent(self, timestamp, version, event):
+        pass
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
@@ -29,6 +29,10 @@
 '''
 
 from common import *
+from sleeppattern import SleepPatternError, parseSleepPattern
+from binformat import BIN_EXTENSION, BIN_DATA_TYPES
+from compressedio import CODECS, stripCodecExtension
+from streamserver import parseAddress, StreamAddressError
 
 import os
 import re
@@ -44,6 +48,9 @@ identifierRegex = re.compile(identifier)
 pathRegex = re.compile('"(?P<path>([^"]|"")*)"', re.U)
 pathTimespanRegex = re.compile("%NAME\{(?P<spanNames>"+identifier+"(?:,"+identifier+")*)\}", re.U)
 commaSplitter = re.compile("\s*(?P<value>"+identifier+")\s*,?")
+strftimeDirective = re.compile("%(.)", re.S)
+integerRegex = re.compile("(?P<value>[0-9]+)\s*(#.*)?$")
+booleanRegex = re.compile("(?P<value>yes|no|true|false|on|off)\s*(#.*)?$", re.I)
 
 def timeLiteralFunc(uid):
     #strTimeSeconds = "(?P<seconds"+uid+">[0-9][0-9]?)"
@@ -71,9 +78,82 @@ class WakeSection:
             "all"   : 0
             }
 
+# strftime directives that change more often than once per minute.
+SUB_MINUTE_DIRECTIVES = "ScTXr+"
+
+# Settings for how recorded data is written to disk.
+class RecordingSection:
+    def __init__(self):
+        # Flush a file once this many rows are waiting in its buffer.
+        # 0 disables flushing by row count.
+        self.flushRows = 256
+        
+        # Flush a file once its oldest unflushed row is this old.
+        # 0 disables flushing by time.
+        self.flushMs = 1000
+        
+        # Flush everything at the end of each 30 second epoch.
+        self.flushOnEpoch = True
+        
+        # Ask the OS to commit flushed data all the way to the disk.
+        self.fsync = False
+        
+        # How many rows may wait for the writer thread before new ones are
+        #   dropped, and how long to wait for room before dropping one.
+        self.queueRows = 4096
+        self.queueBlockMs = 100
+        
+        # Compressed files are written in blocks of about this many KB of
+        #   uncompressed data.  A flush writes out a smaller block once its
+        #   oldest data is compressBlockMs old.
+        self.compressBlockKb = 256
+        self.compressBlockMs = 60000
+        
+        # Raw and spectrogram files get an index entry every this many
+        #   seconds of recording.  0 turns the indexes off.
+        self.indexSeconds = 60
+        
+        # Where to keep the sleep history between runs.  None means the
+        #   default: HISTORY_FILE_NAME in the first output table's top
+        #   directory.
+        self.historyFile = None
+        
+        # Pipeline statistics are appended to this file every statsSeconds
+        #   seconds, one JSON object per line.  None turns that off.
+        self.statsFile = None
+        self.statsSeconds = 60
+        
+        # Live slices are streamed to subscribers on this address (see
+        #   streamserver.py), each of which may fall streamBufferKb behind
+        #   before messages are dropped.  None turns the server off.
+        self.streamAddress = None
+        self.streamBufferKb = 1024
+        
+        # Waveforms and spectrograms are shared through ring buffer files
+        #   named after ringPath (see shmring.py), each holding the last
+        #   ringSlots slices.  None turns this off.
+        self.ringPath = None
+        self.ringSlots = 4096
+
+# An action_trigger section: named sleep patterns and the command to run when
+#   one of them matches.
+class TriggerSection:
+    def __init__(self):
+        # (name, SleepPattern) pairs, in the order given.
+        self.patterns = []
+        
+        # Command line to run, or None to only print that it matched.
+        self.alarm = None
+        
+        self.srcLine = 0
+
+# Name of the sleep history file when the config doesn't give one.
+HISTORY_FILE_NAME = "sleep_history.dat"
+
 class Timespan:
     def __init__(self):
         self.originSourceLine = 0
+        self.sectionIndex = 0 # Which timespan_names section this came from.
         self.startSecond = 0
         self.endSecond = -1
     
@@ -112,6 +192,54 @@ class Timespan:
         
         return secToLit(self.startSecond) + " - " + secToLit(self.endSecond)
 
+MINUTES_PER_DAY = 1440
+
+# Precomputed answers to "which timespans contain this time of day?"
+# Timespans always start and end on whole minutes, so a table with one entry
+#   per minute of the day covers every possible question.  Minutes that have
+#   the same set of names share one frozenset.
+class TimespanIndex:
+    def __init__(self, timespanTable):
+        self.names = frozenset(timespanTable.keys())
+        
+        sets = [None] * MINUTES_PER_DAY
+        for name, tspans in timespanTable.iteritems():
+            for tspan in tspans:
+                for minute in _spanMinutes(tspan):
+                    if sets[minute] == None:
+                        sets[minute] = set()
+                    sets[minute].add(name)
+        
+        interned = {}
+        empty = frozenset()
+        self.minuteTable = []
+        for names in sets:
+            if names == None:
+                self.minuteTable.append(empty)
+                continue
+            names = frozenset(names)
+            self.minuteTable.append(interned.setdefault(names, names))
+    
+    # Returns the set of names whose timespans contain the given second.
+    def namesAt(self, secondOfDay):
+        return self.minuteTable[(secondOfDay // 60) % MINUTES_PER_DAY]
+    
+    # True if the name was defined in any timespan_names section.
+    def __contains__(self, name):
+        return name in self.names
+
+# Returns the minutes of the day covered by a timespan, in order.
+def _spanMinutes(tspan):
+    tspan.checkValidity()
+    start = tspan.startSecond // 60
+    end = tspan.endSecond // 60
+    if end <= start:
+        end += MINUTES_PER_DAY # Wraps past midnight.
+    return [minute % MINUTES_PER_DAY for minute in xrange(start, end)]
+
+def _minuteToLiteral(minute):
+    return "%d:%02d" % (minute // 60, minute % 60)
+
 class SpanNameNotFoundError(Exception):
     ''' A nonexistent timespan was referenced. '''
     pass
@@ -138,61 +266,144 @@ class OutputSection:
             DATA_EVENTS : None
         }
         
-    # If timespanTable is passed a value of None, then this will not try to
-    #   look up any %NAME elements and instead do syntax-checking only.
-    def calculatePath(self, dataType, timeStruct, timespanTable):
+        # dataType -> (source path, parts, changesEverySecond)
+        # See _compilePath() for what the parts are.
+        self._templates = {}
         
+        # dataType -> (timespanIndex, time key, resolved path)
+        # The time key holds the fields of the time struct that the path can
+        #   depend on, so a cached path stays good until that key changes.
+        self._pathCache = {}
+    
+    # Splits a path from the config file into a list of parts.  Each part is
+    #   either literal text or a list of span names from a %NAME{} element.
+    # Also returns True if the path uses strftime directives that change more
+    #   than once per minute.  Otherwise the resolved path can only change at
+    #   minute boundaries, since timespans are given in whole minutes.
+    def _compilePath(self, path):
+        parts = []
+        literalText = ""
+        pos = 0
+        for match in pathTimespanRegex.finditer(path):
+            literal = string.replace(path[pos:match.start()],'""','"')
+            parts.append(literal)
+            literalText += literal
+            
+            spanNames = match.groupdict()["spanNames"]
+            names = []
+            for spanMatch in commaSplitter.finditer(spanNames):
+                names.append(spanMatch.groupdict()["value"])
+            parts.append(names)
+            
+            pos = match.end()
+        
+        literal = string.replace(path[pos:],'""','"')
+        parts.append(literal)
+        literalText += literal
+        
+        changesEverySecond = False
+        for directive in strftimeDirective.finditer(literalText):
+            if directive.group(1) in SUB_MINUTE_DIRECTIVES:
+                changesEverySecond = True
+        
+        return (parts, changesEverySecond)
+    
+    # Returns the deepest directory that every path for this data type will
+    #   be in, no matter what the date or time is.
+    def staticDirectory(self, dataType):
+        (source, parts, changesEverySecond) = self._getTemplate(dataType)
+        
+        # Everything before the first strftime directive or %NAME{} element
+        #   is fixed.
+        fixed = parts[0]
+        directive = strftimeDirective.search(fixed)
+        if directive != None:
+            fixed = fixed[:directive.start()]
+        
+        if len(parts) == 1 and directive == None:
+            # The whole path is fixed; use the directory the file is in.
+            return os.path.dirname(os.path.abspath(fixed))
+        
+        return os.path.abspath(os.path.dirname(fixed) or ".")
+    
+    def _getTemplate(self, dataType):
         path = self.filePaths[dataType]
         if path == None:
             path = dataTypeConstToString(dataType) + ".csv"
         
+        template = self._templates.get(dataType)
+        if template == None or template[0] != path:
+            (parts, changesEverySecond) = self._compilePath(path)
+            template = (path, parts, changesEverySecond)
+            self._templates[dataType] = template
+        
+        return template
+        
+    # timespanIndex is the config's TimespanIndex.
+    # If timespanIndex is passed a value of None, then this will not try to
+    #   look up any %NAME elements and instead do syntax-checking only.
+    def calculatePath(self, dataType, timeStruct, timespanIndex):
+        
+        (source, parts, changesEverySecond) = self._getTemplate(dataType)
+        
+        if changesEverySecond:
+            timeKey = tuple(timeStruct[0:6])
+        else:
+            timeKey = tuple(timeStruct[0:5])
+        
+        if timespanIndex != None:
+            cached = self._pathCache.get(dataType)
+            if ( cached != None and cached[0] is timespanIndex and
+                 cached[1] == timeKey ):
+                return cached[2]
+        
         secondOfDay = \
               (timeStruct.tm_hour * 3600) \
             + (timeStruct.tm_min * 60) \
             + (timeStruct.tm_sec)
         
-        pos = 0
-        while True:
-            match = pathTimespanRegex.search(path,pos)
-            if match == None:
-                break
+        if timespanIndex != None:
+            activeNames = timespanIndex.namesAt(secondOfDay)
+        
+        pieces = []
+        for part in parts:
+            if not isinstance(part, list):
+                pieces.append(part)
+                continue
+            
+            if timespanIndex == None:
+                # Syntax checking only; leave the element as it was.
+                pieces.append("%NAME{"+",".join(part)+"}")
+                continue
             
-            spanNames = match.groupdict()["spanNames"]
             spanNameToUse = None
-
-            for spanMatch in commaSplitter.finditer(spanNames):
-                pname = spanMatch.groupdict()["value"]
-                if ( timespanTable != None and pname in timespanTable ):
-                    tspans = timespanTable[pname]
-                    for tspan in tspans:
-                        if tspan.contains(secondOfDay):
-                            spanNameToUse = pname
-                            break
-                    
-                    if spanNameToUse != None:
+            for pname in part:
+                if pname in timespanIndex:
+                    if pname in activeNames:
+                        spanNameToUse = pname
                         break
 
-                elif (timespanTable != None):
+                else:
                     raise SpanNameNotFoundError("config.cfg, "+str(self.srcLines[dataType])+
                         ": Span name "+pname+" given in %NAME{} was not found in the timespan tables.")
                 #if
             #for
             
-            if ( timespanTable != None and spanNameToUse == None ):
+            if ( spanNameToUse == None ):
                 raise SecondHasNoSpanError("Span corresponding to the second of day "+
-                    str(currentSecond)+" was not found.")
-            #    spanNameToUse = "error_no_span_for_second_"+str(currentSecond)
+                    str(secondOfDay)+" was not found.")
             
-            if ( spanNameToUse != None ):
-                path = path[:match.start()] + spanNameToUse + path[match.end():]
-
-            pos = match.start() + 1
-        #while
+            pieces.append(spanNameToUse)
+        #for
 
-        path = string.replace(path,'""','"')
+        path = "".join(pieces)
         #path = string.replace(path,'%%','%')
         path = time.strftime(path,timeStruct)
         path = os.path.abspath(path)
+        
+        if timespanIndex != None:
+            self._pathCache[dataType] = (timespanIndex, timeKey, path)
+        
         return path
         
 class SleepConfig:
@@ -204,10 +415,15 @@ class SleepConfig:
         self.currentLine = ""
         self.currentLineNumber = 0
         self.nErrors = 0
+        self.nWarnings = 0
         
         self.wakeTables = []
         self.timespanTable = {}
+        self.nTimespanSections = 0
+        self.timespanIndex = None # Built once the whole file has been read.
         self.outputTables = []
+        self.triggerTables = []
+        self.recording = RecordingSection()
         
         self.fileName = configFileName
         self.fileStream = open(configFileName,"r")
@@ -221,6 +437,14 @@ class SleepConfig:
         self.nErrors = self.nErrors + 1
         print self.fileName+", "+str(self.currentLineNumber)+": "+msg
     
+    # Like err(), but for things that are probably mistakes and yet still
+    #   have a well-defined meaning.
+    def warn(self,msg,lineNumber=None):
+        self.nWarnings = self.nWarnings + 1
+        if lineNumber == None:
+            lineNumber = self.currentLineNumber
+        print self.fileName+", "+str(lineNumber)+": warning: "+msg
+    
     def _atSectionEnd(self):
         
         match = singleKeyword.match(self.currentLine)
@@ -290,6 +514,7 @@ class SleepConfig:
         
         span = Timespan()
         span.originSourceLine = self.currentLineNumber
+        span.sectionIndex = self.nTimespanSections
         span.startSecond = self._parseTimeLiteral(lit1)
         if ( lit2 != None ):
             span.endSecond = self._parseTimeLiteral(lit2)
@@ -315,6 +540,8 @@ class SleepConfig:
                 self.timespanTable[name] = [curSpan]
         #-----------
 
+        self.nTimespanSections += 1
+        
         firstSpan = None
         curSpan = None
         curName = ""
@@ -393,6 +620,18 @@ class SleepConfig:
                 self.err("Entry is defined more than once: "+lhs)
                 continue
             
+            ext = os.path.splitext(fullPath)[1].lower()
+            if ext in (".xz", ".lzma") and ext not in CODECS:
+                self.err("Writing "+ext+" files needs the lzma module, which "+
+                    "isn't installed: "+lhs)
+                continue
+            
+            if ( stripCodecExtension(fullPath).endswith(BIN_EXTENSION) and
+                 dataType not in BIN_DATA_TYPES ):
+                self.err("Only raw and spectrogram data can be written to "+
+                    BIN_EXTENSION+" files: "+lhs)
+                continue
+            
             outputSec.filePaths[dataType] = fullPath
             outputSec.srcLines[dataType] = self.currentLineNumber
             
@@ -409,6 +648,170 @@ class SleepConfig:
         
         self.outputTables.append(outputSec)
     
+    def _parseTriggerSection(self):
+        self.debug("_parseTriggerSection")
+        section = TriggerSection()
+        section.srcLine = self.currentLineNumber
+        
+        while self._nextline():
+            
+            if ( self._atSectionEnd() ):
+                break
+            
+            match = assignment.match(self.currentLine)
+            if match == None:
+                self.err("Unexpected line in config file: \n"+self.currentLine)
+                continue
+            
+            lhs = match.groupdict()["lhs"]
+            rhs = match.groupdict()["rhs"]
+            
+            if lhs == "alarm":
+                if section.alarm != None:
+                    self.err("Entry is defined more than once: alarm")
+                    continue
+                section.alarm = self._parsePath(rhs)
+                continue
+            
+            match = identifierRegex.match(lhs)
+            if match == None or match.end() != len(lhs):
+                self.err("Not a valid trigger name: "+lhs+"\n"
+                    + identifierDefinition("Trigger names"))
+                continue
+            
+            try:
+                (pattern, end) = parseSleepPattern(rhs)
+            except SleepPatternError as e:
+                self.err("Invalid sleep pattern for "+lhs+": "+str(e))
+                continue
+            
+            leftovers = rhs[end:]
+            if emptyLine.match(leftovers) == None:
+                self.err("Unexpected text after sleep pattern: "+leftovers)
+            
+            if pattern.matchesEmpty:
+                self.warn("The pattern for "+lhs+" matches even zero epochs, "+
+                    "so it will only ever fire once.")
+            
+            section.patterns.append((lhs, pattern))
+        
+        if section.alarm == None and len(section.patterns) > 0:
+            self.warn("This action_trigger section has no alarm command.  "+
+                "Its triggers will only be printed.", section.srcLine)
+        
+        self.triggerTables.append(section)
+    
+    def _parseInteger(self, text):
+        match = integerRegex.match(text)
+        if match == None:
+            self.err("Expected a whole number: "+text)
+            return None
+        return int(match.groupdict()["value"])
+    
+    def _parseBoolean(self, text):
+        match = booleanRegex.match(text)
+        if match == None:
+            self.err("Expected yes or no: "+text)
+            return None
+        return match.groupdict()["value"].lower() in ("yes","true","on")
+    
+    def _parsePath(self, text):
+        match = pathRegex.match(text)
+        if match == None:
+            self.err("Invalid path given: "+text)
+            return None
+        
+        leftovers = text[match.end():]
+        if emptyLine.match(leftovers) == None:
+            self.err("Unexpected text after path: "+leftovers)
+        
+        return string.replace(match.groupdict()["path"],'""','"')
+    
+    # Returns where the sleep history should be kept, or None if there's
+    #   nowhere sensible to put it.
+    def historyPath(self):
+        if self.recording.historyFile != None:
+            return os.path.abspath(self.recording.historyFile)
+        
+        if len(self.outputTables) == 0:
+            return None
+        
+        directory = self.outputTables[0].staticDirectory(DATA_HGRAM)
+        return os.path.join(directory, HISTORY_FILE_NAME)
+    
+    def _parseRecordingSection(self):
+        self.debug("_parseRecordingSection")
+        rec = self.recording
+        
+        # Maps each setting name onto (attribute name, value parser).
+        settings = {
+            "flush_rows"     : ("flushRows",    self._parseInteger),
+            "flush_ms"       : ("flushMs",      self._parseInteger),
+            "flush_on_epoch" : ("flushOnEpoch", self._parseBoolean),
+            "fsync"          : ("fsync",        self._parseBoolean),
+            "queue_rows"     : ("queueRows",    self._parseInteger),
+            "queue_block_ms" : ("queueBlockMs", self._parseInteger),
+            "history_file"   : ("historyFile",  self._parsePath),
+            "stats_file"     : ("statsFile",    self._parsePath),
+            "stats_seconds"  : ("statsSeconds", self._parseInteger),
+            "compress_block_kb" : ("compressBlockKb", self._parseInteger),
+            "compress_block_ms" : ("compressBlockMs", self._parseInteger),
+            "index_seconds"  : ("indexSeconds", self._parseInteger),
+            "stream_address"   : ("streamAddress",  self._parsePath),
+            "stream_buffer_kb" : ("streamBufferKb", self._parseInteger),
+            "ring_path"      : ("ringPath",     self._parsePath),
+            "ring_slots"     : ("ringSlots",    self._parseInteger),
+        }
+        
+        while self._nextline():
+            
+            if ( self._atSectionEnd() ):
+                break
+            
+            match = assignment.match(self.currentLine)
+            if match == None:
+                self.err("Unexpected line in config file: \n"+self.currentLine)
+                continue
+            
+            lhs = match.groupdict()["lhs"]
+            rhs = match.groupdict()["rhs"]
+            
+            if lhs not in settings:
+                self.err("Invalid entry in recording section: "+lhs)
+                continue
+            
+            (attrName, parseFunc) = settings[lhs]
+            value = parseFunc(rhs)
+            if value != None:
+                setattr(rec, attrName, value)
+        
+        if rec.queueRows < 1:
+            self.err("queue_rows must be at least 1.")
+            rec.queueRows = 1
+        
+        if rec.statsSeconds < 1:
+            self.err("stats_seconds must be at least 1.")
+            rec.statsSeconds = 1
+        
+        if rec.compressBlockKb < 1:
+            self.err("compress_block_kb must be at least 1.")
+            rec.compressBlockKb = 1
+        
+        if rec.streamAddress != None:
+            try:
+                parseAddress(rec.streamAddress)
+            except StreamAddressError as e:
+                self.err("Invalid stream_address: "+str(e))
+                rec.streamAddress = None
+        
+        if rec.streamBufferKb < 1:
+            self.err("stream_buffer_kb must be at least 1.")
+            rec.streamBufferKb = 1
+        
+        if rec.ringSlots < 1:
+            self.err("ring_slots must be at least 1.")
+            rec.ringSlots = 1
+    
     def _parseConfig(self):
         self.debug("_parseConfig()")
         while self._nextline():
@@ -425,8 +828,77 @@ class SleepConfig:
                 self._parseTimespanSection()
             elif sectionType == "output":
                 self._parseOutputSection()
+            elif sectionType == "recording":
+                self._parseRecordingSection()
+            elif sectionType == "action_trigger":
+                self._parseTriggerSection()
             else:
                 self.err("Invalid section type: "+sectionType)
+        
+        self._compileTimespans()
+    
+    # Builds the timespan lookup table.  Each timespan_names section is meant
+    #   to divide up the day, so this also points out any time that one of
+    #   them covers twice or not at all.
+    def _compileTimespans(self):
+        self.debug("_compileTimespans()")
+        
+        # Per-section lists of (name, span) covering each minute.
+        coverage = []
+        firstLines = []
+        for i in xrange(self.nTimespanSections):
+            coverage.append([[] for minute in xrange(MINUTES_PER_DAY)])
+            firstLines.append(None)
+        
+        for name, tspans in self.timespanTable.iteritems():
+            for tspan in tspans:
+                try:
+                    minutes = _spanMinutes(tspan)
+                except Exception:
+                    self.err("Timespan "+name+" = "+tspan.toString()+" is invalid.")
+                    continue
+                
+                section = tspan.sectionIndex - 1
+                line = firstLines[section]
+                if line == None or tspan.originSourceLine < line:
+                    firstLines[section] = tspan.originSourceLine
+                
+                for minute in minutes:
+                    coverage[section][minute].append((name, tspan))
+        
+        for section in xrange(self.nTimespanSections):
+            self._checkSectionCoverage(coverage[section], firstLines[section])
+        
+        self.timespanIndex = TimespanIndex(self.timespanTable)
+    
+    def _checkSectionCoverage(self, minutes, sectionLine):
+        # Group neighboring minutes that have the same problem so that each
+        #   problem is reported once.
+        minute = 0
+        while minute < MINUTES_PER_DAY:
+            covering = minutes[minute]
+            names = sorted(set([name for (name, tspan) in covering]))
+            if len(covering) == 1 or (len(covering) > 1 and len(names) == 1):
+                minute += 1
+                continue
+            
+            end = minute + 1
+            while end < MINUTES_PER_DAY and \
+                  sorted(set([name for (name, tspan) in minutes[end]])) == names and \
+                  (len(minutes[end]) == 0) == (len(covering) == 0):
+                end += 1
+            
+            timeRange = _minuteToLiteral(minute)+" - "+_minuteToLiteral(end % MINUTES_PER_DAY)
+            if len(covering) == 0:
+                self.warn("No timespan in this timespan_names section covers "+
+                    timeRange+".", sectionLine)
+            else:
+                lines = sorted(set([tspan.originSourceLine for (name, tspan) in covering]))
+                self.warn("Timespans "+", ".join(names)+" (lines "+
+                    ", ".join([str(l) for l in lines])+") overlap from "+
+                    timeRange+".", lines[-1])
+            
+            minute = end
     
     def _nextline(self):
         result = False
@@ -470,3 +942,39 @@ class SleepConfig:
                 if path != None:
                     print '\t'+dataTypeConstToString(dtype)+' = "'+path+'"'
             print "end"
+        
+        for table in self.triggerTables:
+            print "action_trigger"
+            for (name, pattern) in table.patterns:
+                print "\t"+name+" = "+pattern.source
+            if table.alarm != None:
+                print '\talarm = "'+string.replace(table.alarm,'"','""')+'"'
+            print "end"
+        
+        def yesNo(value):
+            if value: return "yes"
+            else:     return "no"
+        
+        rec = self.recording
+        print "recording"
+        print "\tflush_rows = "+str(rec.flushRows)
+        print "\tflush_ms = "+str(rec.flushMs)
+        print "\tflush_on_epoch = "+yesNo(rec.flushOnEpoch)
+        print "\tfsync = "+yesNo(rec.fsync)
+        print "\tqueue_rows = "+str(rec.queueRows)
+        print "\tqueue_block_ms = "+str(rec.queueBlockMs)
+        print "\tcompress_block_kb = "+str(rec.compressBlockKb)
+        print "\tcompress_block_ms = "+str(rec.compressBlockMs)
+        print "\tindex_seconds = "+str(rec.indexSeconds)
+        if rec.historyFile != None:
+            print '\thistory_file = "'+string.replace(rec.historyFile,'"','""')+'"'
+        if rec.statsFile != None:
+            print '\tstats_file = "'+string.replace(rec.statsFile,'"','""')+'"'
+        print "\tstats_seconds = "+str(rec.statsSeconds)
+        if rec.streamAddress != None:
+            print '\tstream_address = "'+string.replace(rec.streamAddress,'"','""')+'"'
+        print "\tstream_buffer_kb = "+str(rec.streamBufferKb)
+        if rec.ringPath != None:
+            print '\tring_path = "'+string.replace(rec.ringPath,'"','""')+'"'
+        print "\tring_slots = "+str(rec.ringSlots)
+        print "end"
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Sleep history: one character per 30 second epoch, oldest first.
+#
+# The characters are the ones described in the config file's notes on sleep
+#   regular expressions.  Uppercase letters are readings with a good signal and
+#   lowercase letters are readings with a bad signal.
+#
+# The history is a fixed-size ring, so appending never copies anything and the
+#   oldest epochs simply fall off the front once it is full.  Every character
+#   is written twice, once in each half of a buffer that is twice the ring's
+#   size.  That way the most recent n epochs are always contiguous in memory,
+#   and view() can hand them to the re module without copying.
+#
+# Epochs are placed by time.  record() works out the epoch's number from its
+#   Zeo timestamp (seconds // 30), and any epochs that were never received
+#   are filled in with the unrecorded marker (a space) in one go.  So the
+#   newest character is always the epoch at lastEpochTime, the one before it
+#   is 30 seconds earlier, and so on, and atTime() can find the epoch for
+#   any time without searching.
+#
+# The ring lives in a memory map.  Given a file name, the map is backed by that
+#   file and the history survives restarts: reopening the file picks up where
+#   the last run left off without reading anything.  Without a file name, the
+#   map is anonymous memory.
+#
+# File layout (little endian):
+#   header, HEADER_SIZE bytes:
+#     8s  magic
+#     I   format version
+#     I   capacity (in epochs)
+#     I   cursor; where the next epoch goes
+#     I   number of epochs held
+#     q   Zeo time (epoch seconds) of the newest epoch, or -1
+#   followed by 2 * capacity bytes of mirrored ring.
+
+import os
+import re
+import mmap
+import array
+import bisect
+import struct
+
+try:
+    _bufferView = buffer
+except NameError:
+    def _bufferView(obj, offset, size):
+        return memoryview(obj)[offset:offset+size]
+
+HISTORY_MAGIC   = b'PEHIST\0\0'
+HISTORY_VERSION = 1
+HEADER_FORMAT   = '<8sIIIIq'
+HEADER_SIZE     = 64
+
+# Offset of the mutable part of the header (cursor, length, last time).
+_STATE_OFFSET   = struct.calcsize('<8sII')
+_STATE_FORMAT   = '<IIq'
+
+SECONDS_PER_EPOCH = 30
+
+# The marker for epochs that have no data.
+UNRECORDED = ' '
+
+# A jump forward in time longer than this (one week) is taken to be the
+#   Zeo's clock being changed rather than a gap in the data.  The history
+#   carries on from the new time without filling anything in.
+MAX_GAP_EPOCHS = 7 * 24 * 60 * 2
+
+# A jump backward in time longer than this (two minutes) is taken to be the
+#   clock being changed too, say for daylight saving time or after the Zeo's
+#   clock was reset, rather than a late reading.  The history carries on from
+#   the new time instead of writing over the epochs it already holds.
+# A late reading for one of the epochs within it replaces that epoch.  When
+#   that changes the epoch, record() returns minus the number of epochs from
+#   it to the newest, and the trigger engine goes back over them with
+#   TriggerEngine.revise().  So a late reading that completes a pattern still
+#   fires its trigger.
+MAX_REWRITE_EPOCHS = 4
+
+# How many runs a RunLengthHistory keeps before dropping the oldest.
+MAX_RUNS = 65536
+
+class SleepHistory:
+
+    # If path is given, the history is stored in that file.  A file made with
+    #   a different capacity is converted, keeping the newest epochs.
+    def __init__(self, capacity, path=None):
+        if capacity < 1:
+            raise ValueError("Sleep history capacity must be at least 1.")
+
+        self.capacity = capacity
+        self.path = path
+        self._cursor = 0 # Where the next epoch goes; always < capacity.
+        self._length = 0
+        self.lastEpochTime = None
+        self._file = None
+
+        size = HEADER_SIZE + (2 * capacity)
+        if path == None:
+            self._buf = mmap.mmap(-1, size)
+            self._initialize()
+        else:
+            self._openFile(path, size)
+
+    def _openFile(self, path, size):
+        old = None
+        if os.path.isfile(path):
+            old = _readOldHistory(path, self.capacity)
+
+        if old == None:
+            # Either a new file or the one we can reuse as it is.
+            self._file = open(path, 'a+b')
+            self._file.close()
+            self._file = open(path, 'r+b')
+            reuse = os.path.getsize(path) == size and _headerMatches(self._file, self.capacity)
+            if not reuse:
+                self._file.truncate(size)
+            self._buf = mmap.mmap(self._file.fileno(), size)
+            if reuse:
+                (self._cursor, self._length, lastTime) = \
+                    struct.unpack_from(_STATE_FORMAT, self._buf, _STATE_OFFSET)
+                if lastTime >= 0:
+                    self.lastEpochTime = lastTime
+            else:
+                self._initialize()
+            return
+
+        # Different capacity: start over and copy in what fits.
+        (epochs, lastTime) = old
+        self._file = open(path, 'r+b')
+        self._file.truncate(size)
+        self._buf = mmap.mmap(self._file.fileno(), size)
+        self._initialize()
+        for ch in epochs[-self.capacity:]:
+            self.append(ch)
+        if lastTime >= 0:
+            self.lastEpochTime = lastTime
+            self._writeState()
+
+    def _initialize(self):
+        self._buf[HEADER_SIZE:] = b' ' * (2 * self.capacity)
+        struct.pack_into(HEADER_FORMAT, self._buf, 0, HISTORY_MAGIC,
+            HISTORY_VERSION, self.capacity, 0, 0, -1)
+        self._cursor = 0
+        self._length = 0
+        self.lastEpochTime = None
+
+    def _writeState(self):
+        lastTime = self.lastEpochTime
+        if lastTime == None:
+            lastTime = -1
+        struct.pack_into(_STATE_FORMAT, self._buf, _STATE_OFFSET,
+            self._cursor, self._length, lastTime)
+
+    def __len__(self):
+        return self._length
+
+    # Adds an epoch.  epochTime, if given, is the Zeo time of that epoch in
+    #   epoch seconds and is kept as lastEpochTime.
+    def append(self, ch, epochTime=None):
+        cursor = self._cursor
+        pos = HEADER_SIZE + cursor
+        self._buf[pos : pos + 1] = ch
+        pos += self.capacity
+        self._buf[pos : pos + 1] = ch
+
+        cursor += 1
+        if cursor == self.capacity:
+            cursor = 0
+        self._cursor = cursor
+
+        if self._length < self.capacity:
+            self._length += 1
+
+        if epochTime != None:
+            self.lastEpochTime = epochTime
+
+        # The ring is written before the header, so a crash in between loses
+        #   at most this epoch.
+        self._writeState()
+
+    # Adds the epoch that started at epochTime, filling in any epochs since
+    #   the last one with UNRECORDED.  One of the last few epochs in the
+    #   history is overwritten; anything older is a clock change and is
+    #   appended.
+    # Returns the number of epochs added, counting the filled-in ones.  If an
+    #   existing epoch was changed instead, returns minus the number of
+    #   epochs from it to the newest: -1 for the newest, -2 for the one before
+    #   it, and so on.  Returns 0 if nothing changed.
+    def record(self, ch, epochTime):
+        if self.lastEpochTime == None or self._length == 0:
+            self.append(ch, epochTime)
+            return 1
+
+        epoch = epochTime // SECONDS_PER_EPOCH
+        lastEpoch = self.lastEpochTime // SECONDS_PER_EPOCH
+        gap = epoch - lastEpoch - 1
+
+        if gap < 0 and -1 - gap <= MAX_REWRITE_EPOCHS:
+            # Already have this one; replace it.
+            age = -1 - gap
+            changed = 0
+            if age < self._length:
+                pos = self._start(age + 1)
+                if self._buf[pos : pos + 1] != ch:
+                    twin = pos + self._mirrorOffset(pos)
+                    self._buf[pos : pos + 1] = ch
+                    self._buf[twin : twin + 1] = ch
+                    changed = -1 - age
+            if age == 0:
+                self.lastEpochTime = epochTime
+                self._writeState()
+            return changed
+
+        if gap > MAX_GAP_EPOCHS or gap < 0:
+            gap = 0
+
+        if gap > 0:
+            self._fill(UNRECORDED, gap)
+        self.append(ch, epochTime)
+        return gap + 1
+
+    # Returns the epoch covering epochTime, or None if it isn't in the
+    #   history.
+    def atTime(self, epochTime):
+        if self.lastEpochTime == None:
+            return None
+
+        age = (self.lastEpochTime // SECONDS_PER_EPOCH) - (epochTime // SECONDS_PER_EPOCH)
+        if age < 0 or age >= self._length:
+            return None
+
+        pos = self._start(age + 1)
+        return self._buf[pos : pos + 1]
+
+    # The Zeo time of the oldest epoch held, or None if there are none.
+    def firstEpochTime(self):
+        if self.lastEpochTime == None or self._length == 0:
+            return None
+        return self.lastEpochTime - SECONDS_PER_EPOCH * (self._length - 1)
+
+    # Appends count copies of ch at once.
+    def _fill(self, ch, count):
+        count = min(count, self.capacity)
+        self._length = min(self.capacity, self._length + count)
+        while count > 0:
+            n = min(count, self.capacity - self._cursor)
+            pos = HEADER_SIZE + self._cursor
+            self._buf[pos : pos + n] = ch * n
+            pos += self.capacity
+            self._buf[pos : pos + n] = ch * n
+            self._cursor = (self._cursor + n) % self.capacity
+            count -= n
+        self._writeState()
+
+    # Offset from a position in the buffer to its twin in the other half.
+    def _mirrorOffset(self, pos):
+        if pos - HEADER_SIZE < self.capacity:
+            return self.capacity
+        return -self.capacity
+
+    # Returns a read-only, zero-copy view of the most recent n epochs (or all
+    #   of them if n is None).  The view is only good until the next append().
+    def view(self, n=None):
+        n = self._clampCount(n)
+        return _bufferView(self._buf, self._start(n), n)
+
+    # Returns the most recent n epochs as a string.
+    def tail(self, n=None):
+        n = self._clampCount(n)
+        start = self._start(n)
+        return self._buf[start : start + n]
+
+    # history[0] is the oldest epoch held and history[-1] the newest.
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("sleep history index out of range")
+
+        pos = self._start(self._length) + index
+        return self._buf[pos : pos + 1]
+
+    def __str__(self):
+        return self.tail()
+
+    # Writes everything out and releases the memory map.
+    def close(self):
+        if self._buf == None:
+            return
+        self._buf.flush()
+        self._buf.close()
+        self._buf = None
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+    # Offset in the buffer of the first of the newest n epochs.
+    def _start(self, n):
+        return HEADER_SIZE + self._cursor + self.capacity - n
+
+    def _clampCount(self, n):
+        if n == None or n > self._length:
+            return self._length
+        if n < 0:
+            return 0
+        return n
+
+# The same history, stored as runs of identical epochs.
+#
+# Sleep comes in long runs of the same stage, so this takes a few bytes per
+#   run instead of one per epoch: weeks of history fit in kilobytes.  Each run
+#   is its stage character and the number of the epoch it started on (epoch
+#   seconds // 30); its length is implied by where the next run starts.
+#   Queries walk backwards a run at a time rather than an epoch at a time.
+#
+# Epoch times given to and returned from here are the starts of the epochs,
+#   so they are multiples of 30.
+class RunLengthHistory:
+
+    # Once there are more than maxRuns runs, the oldest ones are dropped.
+    def __init__(self, maxRuns=MAX_RUNS):
+        self.maxRuns = maxRuns
+        self._stages = bytearray()
+        self._starts = array.array('l')
+        self._nextEpoch = None # Number of the epoch after the newest one.
+
+    # Builds a RunLengthHistory from a SleepHistory.
+    @staticmethod
+    def fromHistory(history, maxRuns=MAX_RUNS):
+        runs = RunLengthHistory(maxRuns)
+        first = history.firstEpochTime()
+        if first == None:
+            return runs
+
+        firstEpoch = first // SECONDS_PER_EPOCH
+        for match in _runRegex.finditer(history.view()):
+            runs._stages.append(match.group(1))
+            runs._starts.append(firstEpoch + match.start())
+        runs._nextEpoch = firstEpoch + len(history)
+        runs._trim()
+        return runs
+
+    # Number of runs held.
+    def __len__(self):
+        return len(self._starts)
+
+    # Number of epochs held.
+    def epochs(self):
+        if len(self._starts) == 0:
+            return 0
+        return self._nextEpoch - self._starts[0]
+
+    # Takes the same arguments as SleepHistory.record() and keeps this in
+    #   step with it: one of the last MAX_REWRITE_EPOCHS + 1 epochs is
+    #   overwritten, and an epoch older than that is a clock change.
+    def record(self, ch, epochTime):
+        epoch = epochTime // SECONDS_PER_EPOCH
+        if self._nextEpoch == None:
+            self._appendRun(ch, epoch)
+            self._nextEpoch = epoch + 1
+            return
+
+        gap = epoch - self._nextEpoch
+        if gap < 0 and -1 - gap <= MAX_REWRITE_EPOCHS:
+            self._replaceAt(ch, epoch)
+            return
+
+        if gap > MAX_GAP_EPOCHS or gap < 0:
+            # A clock change.  Carry on as if there was no gap, the way
+            #   SleepHistory does.
+            self._shift(gap)
+        elif gap > 0:
+            self._extend(UNRECORDED, gap)
+        self._extend(ch, 1)
+
+    # Returns (stage, start time, length in epochs) for the newest run, or
+    #   None if there are no runs.
+    # If stages is given, consecutive runs whose stages are all in it count
+    #   as one run.  For example, stages="Ll" ignores the signal quality.
+    def currentRun(self, stages=None):
+        n = len(self._starts)
+        if n == 0:
+            return None
+
+        i = n - 1
+        stage = chr(self._stages[i])
+        if stages != None and stage in stages:
+            while i > 0 and chr(self._stages[i-1]) in stages:
+                i -= 1
+
+        start = self._starts[i]
+        return (stage, start * SECONDS_PER_EPOCH, self._nextEpoch - start)
+
+    # Seconds since the newest run started; see currentRun().
+    def currentRunSeconds(self, stages=None):
+        run = self.currentRun(stages)
+        if run == None:
+            return 0
+        return run[2] * SECONDS_PER_EPOCH
+
+    # Returns how many seconds of the epochs from sinceEpochTime on were in
+    #   any of the given stages (history characters, like "Ll").
+    def secondsInStages(self, stages, sinceEpochTime):
+        sinceEpoch = sinceEpochTime // SECONDS_PER_EPOCH
+        total = 0
+        end = self._nextEpoch
+        i = len(self._starts) - 1
+        while i >= 0 and end > sinceEpoch:
+            start = self._starts[i]
+            if chr(self._stages[i]) in stages:
+                total += end - max(start, sinceEpoch)
+            end = start
+            i -= 1
+        return total * SECONDS_PER_EPOCH
+
+    # Returns the last n changes of stage as (time, old stage, new stage)
+    #   tuples, oldest first.
+    def lastTransitions(self, n):
+        first = max(1, len(self._starts) - n)
+        result = []
+        for i in xrange(first, len(self._starts)):
+            result.append((self._starts[i] * SECONDS_PER_EPOCH,
+                chr(self._stages[i-1]), chr(self._stages[i])))
+        return result
+
+    def _extend(self, ch, count):
+        if len(self._stages) > 0 and chr(self._stages[-1]) == ch:
+            self._nextEpoch += count
+            return
+        self._appendRun(ch, self._nextEpoch)
+        self._nextEpoch += count
+
+    # Changes the stage of an epoch that is already held.  Its run is split
+    #   around it, and then it joins the runs on either side if they have the
+    #   same stage.
+    def _replaceAt(self, ch, epoch):
+        i = bisect.bisect_right(self._starts, epoch) - 1
+        if i < 0 or chr(self._stages[i]) == ch:
+            return
+
+        stage = self._stages[i]
+        start = self._starts[i]
+        if i + 1 < len(self._starts):
+            end = self._starts[i+1]
+        else:
+            end = self._nextEpoch
+
+        stages = bytearray()
+        starts = array.array('l')
+        if start < epoch:
+            stages.append(stage)
+            starts.append(start)
+        stages.append(ch)
+        starts.append(epoch)
+        if epoch + 1 < end:
+            stages.append(stage)
+            starts.append(epoch + 1)
+        self._stages[i:i+1] = stages
+        self._starts[i:i+1] = starts
+
+        # The run holding just this epoch.
+        if start < epoch:
+            i += 1
+        if i + 1 < len(self._starts) and chr(self._stages[i+1]) == ch:
+            del self._stages[i+1]
+            del self._starts[i+1]
+        if i > 0 and chr(self._stages[i-1]) == ch:
+            del self._stages[i]
+            del self._starts[i]
+        self._trim()
+
+    # Moves everything held forward in time by the given number of epochs.
+    def _shift(self, epochs):
+        for i in xrange(len(self._starts)):
+            self._starts[i] += epochs
+        self._nextEpoch += epochs
+
+    def _appendRun(self, ch, epoch):
+        self._stages.append(ch)
+        self._starts.append(epoch)
+        self._trim()
+
+    # Drops the oldest runs once there are too many.  A quarter of them go at
+    #   once so that the cost of moving the rest down is spread out.
+    def _trim(self):
+        if len(self._starts) <= self.maxRuns:
+            return
+        excess = len(self._starts) - self.maxRuns + self.maxRuns // 4
+        del self._stages[:excess]
+        del self._starts[:excess]
+
+_runRegex = re.compile(b'(.)\\1*', re.S)
+
+def _headerMatches(fileObj, capacity):
+    fileObj.seek(0)
+    header = fileObj.read(struct.calcsize(HEADER_FORMAT))
+    if len(header) != struct.calcsize(HEADER_FORMAT):
+        return False
+    (magic, version, fileCapacity, cursor, length, lastTime) = \
+        struct.unpack(HEADER_FORMAT, header)
+    return ( magic == HISTORY_MAGIC and version == HISTORY_VERSION and
+             fileCapacity == capacity and cursor < capacity and
+             length <= capacity )
+
+# If path holds a valid history of some other capacity, returns its
+#   (epochs, last epoch time).  Returns None otherwise.
+def _readOldHistory(path, capacity):
+    fileObj = open(path, 'rb')
+    try:
+        header = fileObj.read(struct.calcsize(HEADER_FORMAT))
+        if len(header) != struct.calcsize(HEADER_FORMAT):
+            return None
+        (magic, version, fileCapacity, cursor, length, lastTime) = \
+            struct.unpack(HEADER_FORMAT, header)
+        if ( magic != HISTORY_MAGIC or version != HISTORY_VERSION or
+             fileCapacity == capacity or cursor >= fileCapacity or
+             length > fileCapacity ):
+            return None
+        if os.path.getsize(path) != HEADER_SIZE + (2 * fileCapacity):
+            return None
+        fileObj.seek(HEADER_SIZE + cursor + fileCapacity - length)
+        return (fileObj.read(length), lastTime)
+    finally:
+        fileObj.close()
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Sleep patterns: the regular expressions used in action_trigger sections.
+#
+# The config file's notes on sleep regular expressions describe the syntax.
+#   All of the configured patterns are compiled together, into one Thompson
+#   NFA whose states each consume one epoch and which has a separate match
+#   state for each pattern.  Matching never rescans the history.  Instead a
+#   SetMatcher is fed one epoch at a time and answers "which patterns match
+#   the epochs that end with this one?" as a bit mask.  It does this by
+#   tracking the set of NFA states that are alive, and it caches the
+#   set-to-set transitions as it goes (a lazily built DFA), so after the first
+#   few epochs each new epoch costs one table lookup no matter how long the
+#   history is or how many patterns there are.
+#
+# Epochs are fed in as symbols rather than characters.  Unrecorded epochs
+#   match whatever the epoch before them matched, so a gap gets a symbol of
+#   its own for each stage that can precede it.
+#
+# Units other than epochs are handled at compile time: each run of identical
+#   sleep state characters is converted to a repetition count in epochs.  A
+#   run of n units of U epochs each becomes {n*U - U/2, n*U} epochs, so m/r/
+#   is the same as e/rr?/.  Inside a repeated group the runs are exactly n*U
+#   epochs, since rounding each repetition would let them drift apart and run
+#   together: m/s{4}+/ is e/(s{8})+/, not e/(s{7,8})+/.
+
+import re
+
+# Epochs per pattern unit.
+UNIT_EPOCHS = {
+    'e' : 1,
+    'm' : 2,
+    'h' : 120,
+    }
+
+# Characters stored in the sleep history.  Uppercase is a good signal.
+STAGE_LETTERS = "ARLDUarldu"
+N_STAGES = len(STAGE_LETTERS)
+
+# Symbol numbering: 0 .. N_STAGES-1 are the stages above, in that order.
+#   GAP_SYMBOL_BASE + i is an unrecorded epoch following stage i (possibly
+#   through other unrecorded epochs), and GAP_AT_START is an unrecorded epoch
+#   with nothing recorded before it.
+GAP_SYMBOL_BASE = N_STAGES
+GAP_AT_START = 2 * N_STAGES
+N_SYMBOLS = GAP_AT_START + 1
+
+ALL_SYMBOLS_MASK = (1 << N_SYMBOLS) - 1
+GAP_SYMBOLS_MASK = ALL_SYMBOLS_MASK & ~((1 << GAP_SYMBOL_BASE) - 1)
+
+# The stages matched by each pattern letter.  Lowercase letters accept either
+#   signal quality; uppercase letters only accept a good signal.
+_LETTER_STAGES = {
+    'a' : "Aa", 'A' : "A",
+    'r' : "Rr", 'R' : "R",
+    'l' : "Ll", 'L' : "L",
+    'd' : "Dd", 'D' : "D",
+    'u' : "Uu", 'U' : "U",
+    'w' : "AaUu",   'W' : "AU",
+    's' : "RrLlDd", 'S' : "RLD",
+    }
+
+# The most NFA states a single pattern may compile to.  Counted repetitions
+#   are expanded, so this mostly limits large counts in hours.
+MAX_NFA_STATES = 100000
+
+# How many DFA states a SetMatcher caches before starting over.
+MAX_DFA_STATES = 8192
+
+class SleepPatternError(ValueError):
+    ''' A sleep pattern could not be compiled. '''
+    pass
+
+# Returns the symbol for an epoch, given its history character and the symbol
+#   of the epoch before it (None for the first epoch).
+def epochSymbol(ch, previous):
+    stage = STAGE_LETTERS.find(ch)
+    if stage >= 0:
+        return stage
+
+    # Anything else is an unrecorded epoch.
+    if previous == None:
+        return GAP_AT_START
+    if previous < GAP_SYMBOL_BASE:
+        return GAP_SYMBOL_BASE + previous
+    return previous
+
+# Returns the symbol mask for a set of stages.  Gaps that follow one of the
+#   stages match too, and if matchesGap is True then every gap matches.
+def _stageMask(stages, matchesGap=False):
+    mask = 0
+    for ch in stages:
+        stage = STAGE_LETTERS.index(ch)
+        mask |= (1 << stage) | (1 << (GAP_SYMBOL_BASE + stage))
+    if matchesGap:
+        mask |= GAP_SYMBOLS_MASK
+    return mask
+
+_countRegex = re.compile("\{([0-9]*)(,([0-9]*))?\}")
+
+# Syntax tree nodes are tuples:
+#   ('set', mask)            one epoch whose symbol is in mask
+#   ('cat', [nodes])         each node in turn
+#   ('alt', [nodes])         any one of the nodes
+#   ('rep', node, lo, hi)    node lo to hi times; hi is None for no limit
+class _Parser:
+    def __init__(self, body):
+        self.body = body
+        self.pos = 0
+
+    def error(self, msg):
+        raise SleepPatternError(msg+" (at character "+str(self.pos+1)+" of "+
+            repr(self.body)+")")
+
+    def peek(self):
+        if self.pos < len(self.body):
+            return self.body[self.pos]
+        return None
+
+    def parse(self):
+        node = self.parseAlternation()
+
+        # Matching is always done against the end of the history, so a
+        #   trailing $ is allowed but means nothing.
+        if self.peek() == '$':
+            self.pos += 1
+
+        if self.pos < len(self.body):
+            if self.peek() == ')':
+                self.error("Unmatched )")
+            self.error("Unexpected "+repr(self.peek()))
+
+        if node == ('cat', []):
+            self.error("Empty pattern")
+
+        return node
+
+    def parseAlternation(self):
+        choices = [self.parseConcatenation()]
+        while self.peek() == '|':
+            self.pos += 1
+            choices.append(self.parseConcatenation())
+
+        if len(choices) == 1:
+            return choices[0]
+        return ('alt', choices)
+
+    def parseConcatenation(self):
+        items = []
+        while True:
+            ch = self.peek()
+            if ch == None or ch == '|' or ch == ')':
+                break
+            if ch == '$' and self.pos == len(self.body) - 1:
+                break
+            items.append(self.parseRepeat())
+        return ('cat', items)
+
+    # Quantifiers stack: each one repeats everything before it, so r{30}?
+    #   is an optional run of 30 and s{4}+ is any multiple of 4.
+    # The exception is a ? right after + or *, which is the Perl lazy marker:
+    #   s{4}+? is s{4}+, not (s{4}+)?.  Patterns only match at the end of the
+    #   history, so laziness changes nothing.
+    def parseRepeat(self):
+        node = self.parseAtom()
+        while True:
+            count = self.parseQuantifier()
+            if count == None:
+                return node
+            (lo, hi) = count
+            node = ('rep', node, lo, hi)
+            if hi == None and self.body[self.pos - 1] in '+*' and \
+                    self.peek() == '?':
+                self.pos += 1
+
+    def parseQuantifier(self):
+        ch = self.peek()
+        if ch == '*':
+            self.pos += 1
+            return (0, None)
+        elif ch == '+':
+            self.pos += 1
+            return (1, None)
+        elif ch == '?':
+            self.pos += 1
+            return (0, 1)
+        elif ch != '{':
+            return None
+
+        match = _countRegex.match(self.body, self.pos)
+        if match == None:
+            self.error("Malformed repetition count")
+
+        (loText, comma, hiText) = match.groups()
+        if loText == "" and (comma == None or hiText == ""):
+            self.error("Empty repetition count")
+
+        lo = 0
+        if loText != "":
+            lo = int(loText)
+
+        if comma == None:
+            hi = lo
+        elif hiText == "":
+            hi = None
+        else:
+            hi = int(hiText)
+
+        if hi != None and hi < lo:
+            self.error("Repetition count is backwards")
+
+        self.pos = match.end()
+        return (lo, hi)
+
+    def parseAtom(self):
+        ch = self.peek()
+        if ch == '(':
+            self.pos += 1
+            if self.body.startswith("?:", self.pos):
+                self.pos += 2
+            node = self.parseAlternation()
+            if self.peek() != ')':
+                self.error("Missing )")
+            self.pos += 1
+            return node
+        elif ch == '[':
+            return self.parseClass()
+        elif ch == '.':
+            self.pos += 1
+            return ('set', ALL_SYMBOLS_MASK)
+        elif ch == ' ':
+            self.pos += 1
+            return ('set', GAP_SYMBOLS_MASK)
+        elif ch in _LETTER_STAGES:
+            self.pos += 1
+            return ('set', _stageMask(_LETTER_STAGES[ch]))
+        elif ch in "*+?{":
+            self.error("Nothing to repeat")
+        elif ch == '^':
+            self.error("^ is not supported; patterns always match the most recent epochs")
+        elif ch == '\\':
+            self.error("Escapes are not supported")
+
+        self.error("Not a sleep state: "+repr(ch))
+
+    # [...] and [^...].  Ranges (a-z) are not supported.
+    def parseClass(self):
+        self.pos += 1
+        negated = False
+        if self.peek() == '^':
+            negated = True
+            self.pos += 1
+
+        stages = ""
+        matchesGap = False
+        while True:
+            ch = self.peek()
+            if ch == None:
+                self.error("Missing ]")
+            self.pos += 1
+            if ch == ']':
+                break
+            elif ch == ' ':
+                matchesGap = True
+            elif ch in _LETTER_STAGES:
+                stages += _LETTER_STAGES[ch]
+            elif ch == '-':
+                self.error("Character ranges are not supported")
+            else:
+                self.error("Not a sleep state: "+repr(ch))
+
+        if negated:
+            # Negation is over the recorded stages.  Gaps still match like
+            #   the epoch before them did.
+            stages = "".join([ch for ch in STAGE_LETTERS if ch not in stages])
+            matchesGap = False
+
+        return ('set', _stageMask(stages, matchesGap))
+
+# Returns (mask, lo, hi) if node is a run of a single sleep state set, or None.
+def _asRun(node):
+    if node[0] == 'set':
+        return (node[1], 1, 1)
+    if node[0] == 'rep' and node[1][0] == 'set':
+        return (node[1][1], node[2], node[3])
+    return None
+
+# Converts a syntax tree in units of unitEpochs into one in epochs.
+# If exact is True, runs are not rounded.
+def _scale(node, unitEpochs, exact=False):
+    kind = node[0]
+    if kind == 'alt':
+        return ('alt', [_scale(child, unitEpochs, exact) for child in node[1]])
+    elif kind == 'rep' and _asRun(node) == None:
+        # Repeats a group; the count is a number of times, not a duration.
+        return ('rep', _scale(node[1], unitEpochs, True), node[2], node[3])
+    elif kind != 'cat':
+        node = ('cat', [node])
+
+    # Merge neighboring runs of the same state, so that m/rr/ means two
+    #   minutes of REM rather than two separately rounded minutes.
+    items = []
+    pending = None
+    for child in node[1]:
+        run = _asRun(child)
+        if run != None and pending != None and pending[0] == run[0]:
+            (mask, lo, hi) = pending
+            if hi == None or run[2] == None:
+                hi = None
+            else:
+                hi = hi + run[2]
+            pending = (mask, lo + run[1], hi)
+            continue
+
+        if pending != None:
+            items.append(_scaleRun(pending, unitEpochs, exact))
+        pending = run
+        if run == None:
+            items.append(_scale(child, unitEpochs, exact))
+
+    if pending != None:
+        items.append(_scaleRun(pending, unitEpochs, exact))
+
+    return ('cat', items)
+
+def _scaleRun(run, unitEpochs, exact=False):
+    (mask, lo, hi) = run
+    if exact:
+        lo = lo * unitEpochs
+    elif lo > 0:
+        lo = lo * unitEpochs - unitEpochs // 2
+    if hi != None:
+        hi = hi * unitEpochs
+    if lo == 1 and hi == 1:
+        return ('set', mask)
+    return ('rep', ('set', mask), lo, hi)
+
+# NFA state kinds.
+_SYM   = 0  # Consumes an epoch in mask, then goes to targets[0].
+_SPLIT = 1  # Goes to all of targets without consuming anything.
+_MATCH = 2  # Pattern matched; mask is the pattern's bit.
+
+class _Nfa:
+    def __init__(self, maxStates=MAX_NFA_STATES):
+        self.maxStates = maxStates
+        self.kinds = []
+        self.masks = []
+        self.targets = []
+
+    def add(self, kind, mask=0, targets=None):
+        if len(self.kinds) >= self.maxStates:
+            raise SleepPatternError("Pattern is too large; try smaller repetition counts")
+        self.kinds.append(kind)
+        self.masks.append(mask)
+        self.targets.append(targets or [])
+        return len(self.kinds) - 1
+
+    # Adds states that match node and then continue to state next.
+    # Returns the state to start at.
+    def build(self, node, next):
+        kind = node[0]
+        if kind == 'set':
+            return self.add(_SYM, node[1], [next])
+        elif kind == 'cat':
+            for child in reversed(node[1]):
+                next = self.build(child, next)
+            return next
+        elif kind == 'alt':
+            starts = [self.build(child, next) for child in node[1]]
+            return self.add(_SPLIT, 0, starts)
+
+        (kind, child, lo, hi) = node
+        start = next
+        if hi == None:
+            loop = self.add(_SPLIT)
+            self.targets[loop] = [self.build(child, loop), next]
+            start = loop
+        else:
+            for i in xrange(hi - lo):
+                start = self.add(_SPLIT, 0, [self.build(child, start), next])
+
+        for i in xrange(lo):
+            start = self.build(child, start)
+
+        return start
+
+    # Returns the SYM and MATCH states reachable from states without
+    #   consuming an epoch.
+    def closure(self, states):
+        kinds = self.kinds
+        targets = self.targets
+        result = []
+        seen = set()
+        stack = list(states)
+        while len(stack) > 0:
+            state = stack.pop()
+            if state in seen:
+                continue
+            seen.add(state)
+            if kinds[state] == _SPLIT:
+                stack.extend(targets[state])
+            else:
+                result.append(state)
+        return frozenset(result)
+
+class SleepPattern:
+
+    # source is the whole pattern as written, unit character and delimiters
+    #   included.  body is the part between the delimiters.
+    def __init__(self, source, unit, body):
+        if unit not in UNIT_EPOCHS:
+            raise SleepPatternError("Unknown unit "+repr(unit)+
+                "; expected e (epochs), m (minutes), or h (hours)")
+
+        self.source = source
+        self.unit = unit
+        self.body = body
+
+        # The syntax tree, in epochs.
+        self.tree = _Parser(body).parse()
+        if unit != 'e':
+            self.tree = _scale(self.tree, UNIT_EPOCHS[unit])
+
+        # Compile it on its own once, to find out whether it's too big and
+        #   whether it matches before any epochs have been seen at all.
+        nfa = _Nfa()
+        matchState = nfa.add(_MATCH, 1)
+        start = nfa.build(self.tree, matchState)
+        self.matchesEmpty = matchState in nfa.closure([start])
+
+# Parses a pattern such as e/ll/ from the front of text.
+# Returns (pattern, index of the first character after it).
+def parseSleepPattern(text):
+    if len(text) < 3:
+        raise SleepPatternError("Expected a sleep pattern like e/ll/: "+repr(text))
+
+    unit = text[0]
+    delimiter = text[1]
+    # Letters are allowed, as the example config shows, even though they
+    #   can't appear in the pattern then.
+    if delimiter.isspace() or delimiter in "()[]{}\\*+.?|^$":
+        raise SleepPatternError("Can't use "+repr(delimiter)+" as a delimiter")
+
+    end = text.find(delimiter, 2)
+    if end < 0:
+        raise SleepPatternError("Missing closing "+delimiter)
+
+    pattern = SleepPattern(text[:end+1], unit, text[2:end])
+    return (pattern, end + 1)
+
+# Several patterns compiled into a single NFA.  The match state for
+#   patterns[i] has the mask 1 << i.
+class PatternSet:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.nfa = _Nfa(MAX_NFA_STATES * max(1, len(self.patterns)))
+
+        starts = []
+        for i in xrange(len(self.patterns)):
+            matchState = self.nfa.add(_MATCH, 1 << i)
+            starts.append(self.nfa.build(self.patterns[i].tree, matchState))
+        self.startSet = self.nfa.closure(starts)
+
+# Matches a PatternSet against a stream of epochs.
+class SetMatcher:
+    def __init__(self, patternSet):
+        self.patternSet = patternSet
+        self.resets = 0 # Times the cache was thrown away.
+        self._reset()
+        self.state = self._initialState
+
+    # Advances by one epoch symbol.  Returns the mask of the patterns that
+    #   match the epochs ending with this one.
+    def feed(self, symbol):
+        next = self._table[self.state][symbol]
+        if next == None:
+            next = self._step(self.state, symbol)
+        self.state = next
+        return self._accepts[next]
+
+    def matching(self):
+        return self._accepts[self.state]
+
+    # Where the matcher is, in a form that stays good when the cache of
+    #   states is thrown away.  seek() goes back there.
+    def position(self):
+        return self._sets[self.state]
+
+    def seek(self, position):
+        self.state = self._stateFor(position)
+
+    def _reset(self):
+        self._sets = []
+        self._ids = {}
+        self._table = []
+        self._accepts = []
+        self._initialState = self._stateFor(self.patternSet.startSet)
+
+    def _stateFor(self, nfaStates):
+        id = self._ids.get(nfaStates)
+        if id == None:
+            nfa = self.patternSet.nfa
+            accepts = 0
+            for s in nfaStates:
+                if nfa.kinds[s] == _MATCH:
+                    accepts |= nfa.masks[s]
+
+            id = len(self._sets)
+            self._sets.append(nfaStates)
+            self._ids[nfaStates] = id
+            self._table.append([None] * N_SYMBOLS)
+            self._accepts.append(accepts)
+        return id
+
+    def _step(self, state, symbol):
+        nfa = self.patternSet.nfa
+        bit = 1 << symbol
+        moved = [nfa.targets[s][0] for s in self._sets[state]
+                 if nfa.kinds[s] == _SYM and nfa.masks[s] & bit]
+
+        # A match may start at any epoch.
+        nfaStates = nfa.closure(moved) | self.patternSet.startSet
+
+        if len(self._sets) >= MAX_DFA_STATES:
+            # Forget everything but where we are now.
+            self.resets += 1
+            self._reset()
+            return self._stateFor(nfaStates)
+
+        next = self._stateFor(nfaStates)
+        self._table[state][symbol] = next
+        return next
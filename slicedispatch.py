@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Decode once, deliver many times.
+#
+# A single Parser is attached to the link and its callbacks go to a
+#   SliceDispatcher.  The dispatcher freezes each decoded slice so that no
+#   consumer can change what the others see, and then hands the same object to
+#   every registered consumer in the order they were added.
+#
+# The slice's Zeo timestamp is decoded here as well, once, and stored on the
+#   slice as epochTime (integer seconds) and timeStruct.  Both are None if the
+#   timestamp couldn't be decoded.
+#
+# Consumers are objects with these two methods, the same ones Parser calls:
+#   updateSlice(slice)
+#   updateEvent(timestamp, version, event)
+#
+# The time each consumer takes over a slice is recorded in pipelineStats as
+#   the stage "slice: <class name>".
+#
+# A consumer that raises doesn't stop the others, or the link thread that
+#   called the dispatcher.  The traceback is printed (holding ioLock, if one
+#   was given) and the slice still goes to the rest of the consumers.
+
+import traceback
+
+from common import zeoTimeDecoder
+from stats import pipelineStats, clock
+
+class ImmutableError(TypeError):
+    ''' Something tried to modify a slice that is shared between consumers. '''
+    pass
+
+class FrozenDict(dict):
+
+    def _readOnly(self, *args, **kwargs):
+        raise ImmutableError("Slices are shared between consumers and may not be modified.")
+
+    __setitem__ = _readOnly
+    __delitem__ = _readOnly
+    clear       = _readOnly
+    pop         = _readOnly
+    popitem     = _readOnly
+    setdefault  = _readOnly
+    update      = _readOnly
+
+# A decoded slice.  It reads just like the dictionaries that Parser produces,
+#   except that it can't be modified, the 'Waveform' list is a tuple, and the
+#   'FrequencyBins' dictionary is frozen too.
+class ZeoSlice(FrozenDict):
+    epochTime = None
+    timeStruct = None
+
+def freezeSlice(slice, decoder=zeoTimeDecoder):
+    if isinstance(slice, ZeoSlice):
+        return slice
+
+    items = {}
+    for key, value in slice.iteritems():
+        if isinstance(value, list):
+            value = tuple(value)
+        elif isinstance(value, dict):
+            value = FrozenDict(value)
+        items[key] = value
+
+    frozen = ZeoSlice(items)
+    try:
+        (frozen.epochTime, frozen.timeStruct) = decoder.decode(slice['ZeoTimestamp'])
+    except (ValueError, TypeError, KeyError):
+        pass
+
+    return frozen
+
+class SliceDispatcher:
+
+    def __init__(self):
+        self.consumers = []
+        self.ioLock = None
+        self.closed = False
+
+    def addConsumer(self, consumer):
+        stage = pipelineStats.stage("slice: " + consumer.__class__.__name__)
+        self.consumers.append((consumer, stage))
+
+    def removeConsumer(self, consumer):
+        self.consumers = [entry for entry in self.consumers if entry[0] is not consumer]
+
+    # Stops delivering anything, for when the link feeding this dispatcher is
+    #   abandoned.  A slice that is already being dispatched goes no further
+    #   than the consumer it is at.
+    def close(self):
+        self.closed = True
+        self.consumers = []
+
+    # Parser slice callback.
+    def updateSlice(self, slice):
+        frozen = freezeSlice(slice)
+        for (consumer, stage) in self.consumers:
+            if self.closed:
+                return
+            start = clock()
+            try:
+                consumer.updateSlice(frozen)
+            except Exception:
+                self._consumerFailed(consumer)
+            stage.record(clock() - start)
+        pipelineStats.count('slices')
+
+    # Parser event callback.
+    def updateEvent(self, timestamp, version, event):
+        for (consumer, stage) in self.consumers:
+            if self.closed:
+                return
+            try:
+                consumer.updateEvent(timestamp, version, event)
+            except Exception:
+                self._consumerFailed(consumer)
+        pipelineStats.count('events')
+
+    # Called from inside an except block.
+    def _consumerFailed(self, consumer):
+        pipelineStats.count('consumer errors')
+        if ( self.ioLock != None ): self.ioLock.acquire()
+        print consumer.__class__.__name__ + " failed:"
+        traceback.print_exc()
+        if ( self.ioLock != None ): self.ioLock.release()
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Counters and latency histograms for the recording pipeline.
+#
+# Each stage of the pipeline (reading a packet, each slice consumer, path
+#   lookups, queueing rows, writing and flushing them, printing) records how
+#   long it took in a LatencyHistogram, and things like rows and bytes are
+#   counted.  Recording a time is a few integer operations, so this is left
+#   on all the time.
+#
+# Stages are named by role, not by thread, so one can be updated from more
+#   than one thread: while a link is being replaced, the old link's thread and
+#   the new one both record "link: packet".  Histograms and counters take a
+#   lock for each update, which costs far less than the operations they time.
+#
+# snapshot() copies everything out.  Two snapshots give rates and latency
+#   percentiles for the time between them, which is what formatReport() and
+#   the encabulator's stats hotkey and dump file show.
+
+import time
+import threading
+from timeit import default_timer as clock
+
+# Histogram buckets hold whole microseconds.  Below 2 * SUB_BUCKETS
+#   microseconds each has a bucket of its own; above that, each power of two
+#   is split into SUB_BUCKETS buckets of equal width, so a percentile read
+#   from the buckets is within 1/SUB_BUCKETS of the real time.  The last
+#   bucket also holds everything longer, which is over half an hour.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+N_BUCKETS = SUB_BUCKETS * 29
+
+# Returns the bucket for a time in whole microseconds.
+def bucketFor(us):
+    bits = us.bit_length()
+    if bits <= SUB_BUCKET_BITS + 1:
+        return us
+    shift = bits - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (us >> shift)
+
+# Returns the number of microseconds that bucket i goes up to, but doesn't
+#   include.
+def bucketLimit(i):
+    if i < 2 * SUB_BUCKETS:
+        return i + 1
+    shift = i // SUB_BUCKETS - 1
+    return (i % SUB_BUCKETS + SUB_BUCKETS + 1) << shift
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * N_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    # seconds is how long one operation took.
+    def record(self, seconds):
+        bucket = bucketFor(int(seconds * 1000000.0))
+        if bucket >= N_BUCKETS:
+            bucket = N_BUCKETS - 1
+        self.lock.acquire()
+        try:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+        finally:
+            self.lock.release()
+
+    # Returns (buckets, count, total, max), all from the same moment.
+    def copy(self):
+        self.lock.acquire()
+        try:
+            return (list(self.buckets), self.count, self.total, self.max)
+        finally:
+            self.lock.release()
+
+# Returns the upper bound in microseconds of the bucket that holds the
+#   q'th quantile (0 to 1) of buckets, or 0 if they are empty.
+def bucketPercentile(buckets, q):
+    count = sum(buckets)
+    if count == 0:
+        return 0.0
+    wanted = q * count
+    seen = 0
+    for (i, n) in enumerate(buckets):
+        seen += n
+        if seen >= wanted and n > 0:
+            return float(bucketLimit(i))
+    return float(bucketLimit(len(buckets) - 1))
+
+class PipelineStats:
+    def __init__(self):
+        self.startTime = time.time()
+        self.counters = {}
+        self.stages = {}
+        self.gauges = {}
+        self._lock = threading.Lock() # Guards counters and stages.
+
+    def count(self, name, n=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self._lock.release()
+
+    # Returns the histogram for a stage, creating it if needed.  Hot paths
+    #   should look theirs up once and keep it.
+    def stage(self, name):
+        self._lock.acquire()
+        try:
+            histogram = self.stages.get(name)
+            if histogram == None:
+                histogram = LatencyHistogram()
+                self.stages[name] = histogram
+            return histogram
+        finally:
+            self._lock.release()
+
+    # func() gives the current value of something that isn't counted, like
+    #   a queue depth.  It is called by snapshot().
+    def addGauge(self, name, func):
+        self.gauges[name] = func
+
+    def snapshot(self):
+        now = time.time()
+        gauges = {}
+        for (name, func) in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        self._lock.acquire()
+        try:
+            counters = dict(self.counters)
+            histograms = self.stages.items()
+        finally:
+            self._lock.release()
+        stages = {}
+        for (name, histogram) in histograms:
+            stages[name] = histogram.copy()
+        return {
+            'time'     : now,
+            'uptime'   : now - self.startTime,
+            'counters' : counters,
+            'gauges'   : gauges,
+            'stages'   : stages,
+            }
+
+# Sums up what happened between two snapshots (or since the start, if
+#   previous is None).  Returns a dictionary that can be written out as JSON.
+def summarize(snapshot, previous=None):
+    if previous == None:
+        previous = {'time' : snapshot['time'] - snapshot['uptime'],
+                    'counters' : {}, 'stages' : {}}
+    seconds = snapshot['time'] - previous['time']
+
+    counters = {}
+    for (name, value) in snapshot['counters'].items():
+        delta = value - previous['counters'].get(name, 0)
+        perSecond = 0.0
+        if seconds > 0:
+            perSecond = delta / seconds
+        counters[name] = {'total' : value, 'delta' : delta, 'perSecond' : perSecond}
+
+    stages = {}
+    for (name, (buckets, count, total, maximum)) in snapshot['stages'].items():
+        old = previous['stages'].get(name)
+        if old != None:
+            buckets = [a - b for (a, b) in zip(buckets, old[0])]
+            count -= old[1]
+            total -= old[2]
+        meanUs = 0.0
+        if count > 0:
+            meanUs = total / count * 1000000.0
+        # The maximum is only known for the whole run, but it still caps the
+        #   bucket bounds.
+        maxUs = maximum * 1000000.0
+        stages[name] = {
+            'count'  : count,
+            'meanUs' : meanUs,
+            'p50Us'  : min(maxUs, bucketPercentile(buckets, 0.50)),
+            'p99Us'  : min(maxUs, bucketPercentile(buckets, 0.99)),
+            'maxUs'  : maxUs,
+            }
+
+    return {
+        'time'     : time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot['time'])),
+        'seconds'  : seconds,
+        'uptime'   : snapshot['uptime'],
+        'counters' : counters,
+        'gauges'   : snapshot['gauges'],
+        'stages'   : stages,
+        }
+
+# Returns a summary as lines of text for the terminal.
+def formatReport(summary):
+    lines = []
+    lines.append("Pipeline statistics for the last %.0f seconds (up %.0f seconds):" %
+        (summary['seconds'], summary['uptime']))
+
+    lines.append("  %-24s %12s %10s" % ("counter", "total", "per second"))
+    for name in sorted(summary['counters'].keys()):
+        counter = summary['counters'][name]
+        lines.append("  %-24s %12d %10.1f" % (name, counter['total'], counter['perSecond']))
+
+    for name in sorted(summary['gauges'].keys()):
+        lines.append("  %-24s %12s" % (name, str(summary['gauges'][name])))
+
+    lines.append("  %-24s %10s %10s %10s %10s %10s" % ("stage", "count",
+        "mean us", "p50 us", "p99 us", "max us"))
+    for name in sorted(summary['stages'].keys()):
+        stage = summary['stages'][name]
+        lines.append("  %-24s %10d %10.1f %10.0f %10.0f %10.0f" % (name,
+            stage['count'], stage['meanUs'], stage['p50Us'], stage['p99Us'],
+            stage['maxUs']))
+    return lines
+
+# Counts the frame errors that the Zeo Raw Data Library prints.  It has no
+#   other way of reporting them.  This wraps sys.stdout and passes everything
+#   through.
+class FrameErrorCounter:
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def write(self, text):
+        if text.startswith("Capture error"):
+            if "checksum" in text:
+                self.stats.count('frame errors: checksum')
+            elif "length" in text:
+                self.stats.count('frame errors: length')
+            else:
+                self.stats.count('frame errors: other')
+        self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# Shared statistics for code that doesn't want its own.
+pipelineStats = PipelineStats()
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Streams live slices to other programs over a local socket.
+#
+# The server is a slice consumer like ZeoToCSV.  It turns each slice into a
+#   few small binary messages and hands them to every connected subscriber,
+#   so other tools can follow along as the data arrives instead of tailing
+#   the CSV files.  It listens on a Unix domain socket, or on a TCP port
+#   that only accepts connections from this computer (see parseAddress()).
+#
+# The slice's thread (the serial link) only ever appends messages to each
+#   subscriber's queue; a thread of the server's own does the sending.  Each
+#   queue holds at most bufferSize bytes.  If a subscriber falls that far
+#   behind, its oldest messages are thrown away to make room, and it can
+#   tell from the gap in the sequence numbers.  A slow subscriber never
+#   holds up the link or the other subscribers.
+#
+# Subscribers don't send anything.  Each message is a frame header followed
+#   by a body, all little endian:
+#
+# Frame header, FRAME_HEADER_SIZE bytes:
+#   I   body size in bytes
+#   B   message type (MSG_* below)
+#   3x  padding
+#   I   sequence number.  It counts up by one for every message the server
+#       sends, to any subscriber, so a jump means messages were dropped.
+#
+# Bodies:
+#   MSG_HELLO, the first message on every connection:
+#       I   protocol version (STREAM_VERSION)
+#       then the frequency bin names, in the order MSG_SPECTROGRAM uses,
+#       separated by commas.
+#   MSG_RAW and MSG_SPECTROGRAM: a record in the .bin file layout (see
+#       binformat.py), with as many values as fit in the body.  Raw
+#       waveforms are 128 samples (uV) and spectrograms are 7 bins.
+#   MSG_STAGE, for each 30 second epoch: the same record prefix, then
+#       B   the stage as a height, as in SLEEP_STATE_TO_HEIGHT.
+#   MSG_EVENT:
+#       q   Zeo time, in epoch seconds
+#       i   Zeo version
+#       then the event's text in UTF-8.
+#
+# readMessages() reads the stream back, and running this file prints what
+#   a server sends:
+#
+#   python streamserver.py unix:/tmp/encabulator.sock
+
+import os
+import sys
+import stat
+import time
+import errno
+import socket
+import struct
+import select
+import calendar
+import platform
+import threading
+import collections
+
+if ( platform.system() != 'Windows'):
+    import fcntl
+
+from common import *
+from binformat import RECORD_PREFIX_FORMAT, RECORD_PREFIX_SIZE
+from stats import pipelineStats
+
+STREAM_VERSION = 1
+
+FRAME_HEADER_FORMAT = '<IB3xI'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+
+MSG_HELLO       = 0
+MSG_RAW         = 1
+MSG_SPECTROGRAM = 2
+MSG_STAGE       = 3
+MSG_EVENT       = 4
+
+EVENT_PREFIX_FORMAT = '<qi'
+EVENT_PREFIX_SIZE = struct.calcsize(EVENT_PREFIX_FORMAT)
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Frames are sent in batches of up to this many bytes.
+_SEND_SIZE = 64 * 1024
+
+# How often to check for new messages on Windows, where select() can't wait
+#   on a pipe.
+WINDOWS_POLL_INTERVAL = 0.05
+
+class StreamAddressError(ValueError):
+    ''' A stream address isn't one that parseAddress() understands. '''
+    pass
+
+# Turns "unix:PATH" or "tcp:PORT" into (socket family, address).  TCP
+#   servers only listen on the loopback address.
+def parseAddress(text):
+    (kind, sep, rest) = text.partition(':')
+    if sep == '' or rest == '':
+        raise StreamAddressError("Expected unix:PATH or tcp:PORT, got "+text)
+    kind = kind.lower()
+    if kind == 'unix':
+        if not hasattr(socket, 'AF_UNIX'):
+            raise StreamAddressError("Unix domain sockets aren't available here; use tcp:PORT.")
+        return (socket.AF_UNIX, rest)
+    elif kind == 'tcp':
+        try:
+            port = int(rest)
+        except ValueError:
+            raise StreamAddressError("Expected a port number: "+rest)
+        if port < 1 or port > 65535:
+            raise StreamAddressError("Port number out of range: "+rest)
+        return (socket.AF_INET, ('127.0.0.1', port))
+    raise StreamAddressError("Expected unix:PATH or tcp:PORT, got "+text)
+
+def _intOr(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+# One connected subscriber.
+class _Subscriber:
+    def __init__(self, sock):
+        self.sock = sock
+        self.frames = collections.deque() # Whole frames waiting to be sent.
+        self.queuedBytes = 0
+        self.sending = b''                # Part of a batch that's been sent.
+        self.dropped = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+class SliceStreamServer ( threading.Thread ):
+
+    # address is as parseAddress() takes it.  bufferSize is the most bytes
+    #   of messages that may wait for any one subscriber.
+    def __init__(self, address, bufferSize=DEFAULT_BUFFER_SIZE):
+        threading.Thread.__init__(self, name="SliceStreamServer")
+        self.daemon = True
+        self.address = address
+        (self.family, self.sockAddress) = parseAddress(address)
+        self.bufferSize = bufferSize
+
+        self.subscribers = []
+        self._lock = threading.Lock() # Guards subscribers and their queues.
+        self._sequence = 0
+        self._done = threading.Event()
+        self._packers = {} # Number of values -> struct.Struct
+
+        self.listener = self._listen()
+
+        if ( platform.system() == 'Windows'):
+            self._wakeRead = None
+            self._wakeWrite = None
+        else:
+            (self._wakeRead, self._wakeWrite) = os.pipe()
+            for fd in (self._wakeRead, self._wakeWrite):
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        pipelineStats.addGauge('stream subscribers', lambda: len(self.subscribers))
+
+    def _listen(self):
+        if self.family == socket.AF_UNIX and os.path.exists(self.sockAddress):
+            # Left behind by a run that didn't get to clean up.  Anything
+            #   that isn't a socket is left alone, and bind() complains.
+            if stat.S_ISSOCK(os.stat(self.sockAddress).st_mode):
+                os.unlink(self.sockAddress)
+
+        listener = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family == socket.AF_INET:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.sockAddress)
+        listener.listen(5)
+        listener.setblocking(0)
+        return listener
+
+    def kill(self):
+        self._done.set()
+        self._wake()
+
+    # Slice consumer method.
+    def updateSlice(self, slice):
+        epochTime = slice.epochTime
+        if epochTime == None:
+            epochTime = calendar.timegm(time.localtime())
+
+        if len(slice['Waveform']) > 0:
+            self.publish(MSG_RAW, self._record(slice, epochTime, slice['Waveform']))
+
+        bins = slice['FrequencyBins']
+        if len(bins) == len(FREQUENCY_BINS):
+            self.publish(MSG_SPECTROGRAM, self._record(slice, epochTime,
+                [bins[name] for name in FREQUENCY_BINS]))
+
+        stage = slice['SleepStage']
+        if stage != None:
+            self.publish(MSG_STAGE, self._record(slice, epochTime, ()) +
+                struct.pack('<B', SLEEP_STATE_TO_HEIGHT.get(stage, 0)))
+
+    # Slice consumer method.
+    def updateEvent(self, timestamp, version, event):
+        try:
+            (epochTime, timeStruct) = zeoTimeDecoder.decode(timestamp)
+        except (ValueError, TypeError):
+            epochTime = calendar.timegm(time.localtime())
+        text = event
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.publish(MSG_EVENT, struct.pack(EVENT_PREFIX_FORMAT, epochTime,
+            _intOr(version, 0)) + str(text))
+
+    def _record(self, slice, epochTime, values):
+        packer = self._packers.get(len(values))
+        if packer == None:
+            packer = struct.Struct(RECORD_PREFIX_FORMAT + str(len(values)) + 'f')
+            self._packers[len(values)] = packer
+        return packer.pack(epochTime, _intOr(slice['Version'], 0),
+            _intOr(slice['SQI'], -1), _intOr(slice['Impedance'], -1),
+            int(bool(slice['BadSignal'])), *values)
+
+    # Queues a message for every subscriber.  This may be called from any
+    #   thread, and never waits on the subscribers.
+    def publish(self, messageType, body):
+        self._lock.acquire()
+        try:
+            if len(self.subscribers) == 0:
+                return
+            self._sequence = (self._sequence + 1) & 0xFFFFFFFF
+            frame = struct.pack(FRAME_HEADER_FORMAT, len(body), messageType,
+                self._sequence) + body
+            for subscriber in self.subscribers:
+                subscriber.frames.append(frame)
+                subscriber.queuedBytes += len(frame)
+                while subscriber.queuedBytes > self.bufferSize:
+                    oldest = subscriber.frames.popleft()
+                    subscriber.queuedBytes -= len(oldest)
+                    subscriber.dropped += 1
+                    pipelineStats.count('stream messages dropped')
+        finally:
+            self._lock.release()
+        self._wake()
+
+    def run(self):
+        try:
+            while not self._done.is_set():
+                self._serveOnce()
+        finally:
+            self._close()
+
+    def _serveOnce(self):
+        readable = [self.listener] + self.subscribers
+        timeout = None
+        if self._wakeRead != None:
+            readable.append(self._wakeRead)
+        else:
+            timeout = WINDOWS_POLL_INTERVAL
+
+        self._lock.acquire()
+        try:
+            writable = [s for s in self.subscribers if s.sending or s.frames]
+        finally:
+            self._lock.release()
+
+        try:
+            (readable, writable, dummy) = select.select(readable, writable, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for ready in readable:
+            if ready is self.listener:
+                self._accept()
+            elif ready is self._wakeRead:
+                self._drainWakeups()
+            elif ready in self.subscribers:
+                self._readFrom(ready)
+
+        for subscriber in writable:
+            if subscriber in self.subscribers:
+                self._sendTo(subscriber)
+
+    def _accept(self):
+        try:
+            (sock, peer) = self.listener.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(0)
+        subscriber = _Subscriber(sock)
+        hello = struct.pack('<I', STREAM_VERSION) + ','.join(FREQUENCY_BINS)
+        subscriber.sending = struct.pack(FRAME_HEADER_FORMAT, len(hello),
+            MSG_HELLO, 0) + hello
+
+        self._lock.acquire()
+        try:
+            self.subscribers.append(subscriber)
+        finally:
+            self._lock.release()
+
+    # Subscribers aren't supposed to send anything, so this only notices when
+    #   they hang up.
+    def _readFrom(self, subscriber):
+        try:
+            data = subscriber.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b''
+        if not data:
+            self._drop(subscriber)
+
+    def _sendTo(self, subscriber):
+        if not subscriber.sending:
+            batch = []
+            size = 0
+            self._lock.acquire()
+            try:
+                while subscriber.frames and size < _SEND_SIZE:
+                    frame = subscriber.frames.popleft()
+                    subscriber.queuedBytes -= len(frame)
+                    batch.append(frame)
+                    size += len(frame)
+            finally:
+                self._lock.release()
+            subscriber.sending = b''.join(batch)
+            if not subscriber.sending:
+                return
+
+        try:
+            sent = subscriber.sock.send(subscriber.sending)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._drop(subscriber)
+            return
+        subscriber.sending = subscriber.sending[sent:]
+
+    def _drop(self, subscriber):
+        self._lock.acquire()
+        try:
+            self.subscribers.remove(subscriber)
+        finally:
+            self._lock.release()
+        subscriber.sock.close()
+
+    def _drainWakeups(self):
+        try:
+            while os.read(self._wakeRead, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _wake(self):
+        if self._wakeWrite == None:
+            return
+        try:
+            os.write(self._wakeWrite, 'x')
+        except OSError as e:
+            # A full pipe means the server already has a wakeup pending.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _close(self):
+        for subscriber in list(self.subscribers):
+            self._drop(subscriber)
+        self.listener.close()
+        if self.family == socket.AF_UNIX:
+            try:
+                os.unlink(self.sockAddress)
+            except OSError:
+                pass
+        for fd in (self._wakeRead, self._wakeWrite):
+            if fd != None:
+                os.close(fd)
+        self._wakeRead = None
+        self._wakeWrite = None
+
+# Connects to a server.  address is as parseAddress() takes it.
+def connect(address):
+    (family, sockAddress) = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(sockAddress)
+    return sock
+
+def _recvExactly(sock, size):
+    chunks = []
+    while size > 0:
+        data = sock.recv(size)
+        if not data:
+            return None
+        chunks.append(data)
+        size -= len(data)
+    return b''.join(chunks)
+
+# Reads messages from a connected socket until the server hangs up.  Yields
+#   (message type, sequence number, fields), where fields are:
+#   MSG_HELLO:       (protocol version, (frequency bin names...))
+#   MSG_RAW, MSG_SPECTROGRAM:
+#                    (epoch time, version, sqi, impedance, bad signal, (values...))
+#   MSG_STAGE:       (epoch time, version, sqi, impedance, bad signal, height)
+#   MSG_EVENT:       (epoch time, version, text)
+#   Messages of other types are yielded with the body as is.
+def readMessages(sock):
+    while True:
+        header = _recvExactly(sock, FRAME_HEADER_SIZE)
+        if header == None:
+            return
+        (size, messageType, sequence) = struct.unpack(FRAME_HEADER_FORMAT, header)
+        body = b''
+        if size > 0:
+            body = _recvExactly(sock, size)
+            if body == None:
+                return
+
+        if messageType == MSG_HELLO:
+            (version,) = struct.unpack('<I', body[:4])
+            fields = (version, tuple(body[4:].split(',')))
+        elif messageType in (MSG_RAW, MSG_SPECTROGRAM):
+            nValues = (size - RECORD_PREFIX_SIZE) // 4
+            values = struct.unpack(RECORD_PREFIX_FORMAT + str(nValues) + 'f', body)
+            fields = values[:5] + (values[5:],)
+        elif messageType == MSG_STAGE:
+            fields = struct.unpack(RECORD_PREFIX_FORMAT + 'B', body)
+        elif messageType == MSG_EVENT:
+            fields = struct.unpack(EVENT_PREFIX_FORMAT, body[:EVENT_PREFIX_SIZE]) + \
+                (body[EVENT_PREFIX_SIZE:].decode('utf-8'),)
+        else:
+            fields = body
+        yield (messageType, sequence, fields)
+
+_MESSAGE_NAMES = {MSG_HELLO : "hello", MSG_RAW : "raw", MSG_SPECTROGRAM :
+    "spectrogram", MSG_STAGE : "stage", MSG_EVENT : "event"}
+
+def main(argv):
+    if len(argv) != 1:
+        print "Usage: python streamserver.py unix:PATH|tcp:PORT"
+        sys.exit(2)
+
+    sock = connect(argv[0])
+    lastSequence = None
+    try:
+        for (messageType, sequence, fields) in readMessages(sock):
+            if lastSequence != None and messageType != MSG_HELLO and \
+               sequence != (lastSequence + 1) & 0xFFFFFFFF:
+                print "(dropped "+str((sequence - lastSequence - 1) & 0xFFFFFFFF)+" messages)"
+            if messageType != MSG_HELLO:
+                lastSequence = sequence
+
+            name = _MESSAGE_NAMES.get(messageType, str(messageType))
+            if messageType == MSG_RAW:
+                fields = fields[:5] + (str(len(fields[5]))+" samples",)
+            print name, sequence, fields
+    except KeyboardInterrupt:
+        pass
+    sock.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
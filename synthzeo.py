@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Made-up Zeo data, for benchmarks and tests that can't use a headband.
+#
+# SyntheticZeo produces slices shaped like the ones the Zeo Raw Data
+#   Library's Parser hands to its callbacks: one per second with a raw
+#   waveform and frequency bins, and one every 30 seconds with the sleep stage.
+#   The sleep stages follow a simple Markov chain, the waveform is made of the
+#   rhythms that go with the current stage plus noise, and the signal goes bad
+#   now and then for a few epochs at a time.  The same seed always gives the
+#   same data.
+
+import math
+import time
+import random
+
+from common import *
+
+SAMPLES_PER_SLICE = 128 # 128 Hz
+SECONDS_PER_EPOCH = 30
+
+# Midnight, 2011-03-13, in the Zeo's epoch seconds.
+DEFAULT_START_TIME = 1299974400
+
+# (frequency Hz, amplitude uV) rhythms and noise amplitude for each stage.
+_RHYTHMS = {
+    SLEEP_STATE_UNDEFINED : ([], 30.0),
+    SLEEP_STATE_AWAKE     : ([(10.0, 15.0), (20.0, 8.0)], 10.0),
+    SLEEP_STATE_LIGHT     : ([(6.0, 20.0), (13.0, 8.0)], 8.0),
+    SLEEP_STATE_DEEP      : ([(1.5, 60.0), (3.0, 20.0)], 5.0),
+    SLEEP_STATE_REM       : ([(5.0, 15.0), (8.0, 6.0)], 10.0),
+}
+
+# Relative power in each frequency bin for each stage.
+_BIN_PROFILES = {
+    SLEEP_STATE_UNDEFINED : [0.15, 0.15, 0.15, 0.15, 0.15, 0.15, 0.10],
+    SLEEP_STATE_AWAKE     : [0.10, 0.12, 0.30, 0.15, 0.15, 0.10, 0.08],
+    SLEEP_STATE_LIGHT     : [0.20, 0.30, 0.15, 0.15, 0.10, 0.06, 0.04],
+    SLEEP_STATE_DEEP      : [0.55, 0.20, 0.08, 0.07, 0.05, 0.03, 0.02],
+    SLEEP_STATE_REM       : [0.20, 0.32, 0.18, 0.10, 0.09, 0.07, 0.04],
+}
+
+# Chance of moving from one stage to another at the end of an epoch.
+_TRANSITIONS = {
+    SLEEP_STATE_UNDEFINED : [(SLEEP_STATE_AWAKE, 0.5)],
+    SLEEP_STATE_AWAKE     : [(SLEEP_STATE_LIGHT, 0.10)],
+    SLEEP_STATE_LIGHT     : [(SLEEP_STATE_DEEP, 0.05), (SLEEP_STATE_REM, 0.03),
+                             (SLEEP_STATE_AWAKE, 0.02)],
+    SLEEP_STATE_DEEP      : [(SLEEP_STATE_LIGHT, 0.06)],
+    SLEEP_STATE_REM       : [(SLEEP_STATE_LIGHT, 0.06), (SLEEP_STATE_AWAKE, 0.02)],
+}
+
+class SyntheticZeo:
+
+    # badSignalRate is roughly the fraction of epochs with a bad signal.
+    def __init__(self, seed=1, badSignalRate=0.05, startTime=DEFAULT_START_TIME):
+        self.random = random.Random(seed)
+        self.badSignalRate = badSignalRate
+        self.epochTime = startTime
+        self.stage = SLEEP_STATE_UNDEFINED
+        self.badEpochsLeft = 0
+        self.phase = 0.0
+        self.endedStage = None # Goes in the next slice.
+
+    # Yields count seconds worth of slices, one a second.  As from the Zeo,
+    #   the stage for an epoch comes in the first slice after it, not in a
+    #   slice of its own.
+    def slices(self, count):
+        for i in xrange(count):
+            badSignal = self.badEpochsLeft > 0
+            slice = self._dataSlice(badSignal)
+            slice['SleepStage'] = self.endedStage
+            self.endedStage = None
+            yield slice
+            self.epochTime += 1
+            if self.epochTime % SECONDS_PER_EPOCH == 0:
+                self.endedStage = self.stage
+                self._nextEpoch()
+
+    def timestamp(self):
+        return time.strftime(ZEO_TIMESTAMP_FORMAT, time.gmtime(self.epochTime))
+
+    def _nextEpoch(self):
+        if self.badEpochsLeft > 0:
+            self.badEpochsLeft -= 1
+        elif self.random.random() < self.badSignalRate / 3.0:
+            # Bad signal comes in stretches of about three epochs.
+            self.badEpochsLeft = self.random.randint(1, 5)
+
+        roll = self.random.random()
+        for (stage, chance) in _TRANSITIONS[self.stage]:
+            if roll < chance:
+                self.stage = stage
+                break
+            roll -= chance
+
+    def _common(self, badSignal):
+        rnd = self.random
+        impedance = rnd.uniform(300.0, 800.0)
+        if rnd.random() < 0.01:
+            impedance = None
+        if badSignal:
+            sqi = rnd.randint(0, 10)
+        else:
+            sqi = rnd.randint(25, 30)
+        return {
+            'ZeoTimestamp'  : self.timestamp(),
+            'Version'       : 3,
+            'SQI'           : sqi,
+            'Impedance'     : impedance,
+            'BadSignal'     : badSignal,
+            'SleepStage'    : None,
+            'Waveform'      : [],
+            'FrequencyBins' : {},
+            }
+
+    def _dataSlice(self, badSignal):
+        rnd = self.random
+        slice = self._common(badSignal)
+        (rhythms, noise) = _RHYTHMS[self.stage]
+        if badSignal:
+            rhythms = []
+            noise = 200.0
+
+        waveform = []
+        step = 2.0 * math.pi / SAMPLES_PER_SLICE
+        for n in xrange(SAMPLES_PER_SLICE):
+            t = self.phase + n * step
+            value = rnd.gauss(0.0, noise)
+            for (frequency, amplitude) in rhythms:
+                value += amplitude * math.sin(frequency * t)
+            waveform.append(round(value, 2))
+        self.phase += 2.0 * math.pi
+        slice['Waveform'] = waveform
+
+        bins = [power * rnd.uniform(0.8, 1.2) for power in _BIN_PROFILES[self.stage]]
+        total = sum(bins)
+        slice['FrequencyBins'] = dict(zip(FREQUENCY_BINS,
+            [round(power / total, 4) for power in bins]))
+        return slice
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from bandpower import SpectralAnalyzer, RawChunk, BANDS, SAMPLE_RATE, \
+    SAMPLES_PER_SLICE
+
+T0 = 1300000000
+
+# A RawChunk of slices at the given times, holding amplitude * sin(2 pi f t)
+#   with t counted from T0, so the sine carries on across slices and chunks.
+def sineChunk(times, frequency, amplitude):
+    times = numpy.array(times, dtype=numpy.int64)
+    t = (times[:, numpy.newaxis] - T0) + \
+        numpy.arange(SAMPLES_PER_SLICE)[numpy.newaxis, :] / float(SAMPLE_RATE)
+    n = len(times)
+    return RawChunk(times, numpy.ones(n, dtype=int), numpy.ones(n, dtype=int) * 30,
+        numpy.ones(n, dtype=int) * -1, numpy.zeros(n, dtype=bool),
+        amplitude * numpy.sin(2.0 * numpy.pi * frequency * t))
+
+def bandIndex(frequency):
+    return [b for (b, (low, high)) in enumerate(BANDS) if low <= frequency < high]
+
+# (frequency, shortest window).  Each frequency is an FFT frequency for that
+#   window and the ones after it, at least one step inside its band, so that
+#   what the Hann window spreads to either side stays in the band.
+SINES = [(6.0, 1), (15.0, 1), (40.0, 1), (3.0, 2), (9.5, 2), (19.5, 2)]
+
+@pytest.mark.parametrize('frequency,shortestWindow', SINES)
+@pytest.mark.parametrize('windowSlices', [1, 2, 4])
+def test_pure_sine_lands_in_its_band(frequency, shortestWindow, windowSlices):
+    if windowSlices < shortestWindow:
+        return
+    amplitude = 20.0
+    analyzer = SpectralAnalyzer(windowSlices)
+    result = analyzer.process(sineChunk(range(T0, T0 + 10), frequency, amplitude))
+    assert len(result) == 10 - windowSlices + 1
+
+    (b,) = bandIndex(frequency)
+    # A sine's power is half its amplitude squared.
+    numpy.testing.assert_allclose(result.bands[:, b], amplitude ** 2 / 2.0, rtol=0.01)
+    others = numpy.delete(result.bands, b, axis=1)
+    assert (others < amplitude ** 2 / 2.0 * 0.01).all()
+
+def test_relative_bands_sum_to_one():
+    analyzer = SpectralAnalyzer(2, relative=True)
+    chunk = sineChunk(range(T0, T0 + 5), 6.0, 5.0)
+    chunk.samples += sineChunk(range(T0, T0 + 5), 16.0, 10.0).samples
+    bands = analyzer.process(chunk).bands
+    numpy.testing.assert_allclose(bands.sum(axis=1), 1.0)
+    numpy.testing.assert_allclose(bands[:, bandIndex(6.0)[0]], 0.2, rtol=0.01)
+    numpy.testing.assert_allclose(bands[:, bandIndex(16.0)[0]], 0.8, rtol=0.01)
+
+# Gaps at 20..22 and 40.
+TIMES = range(T0, T0 + 20) + range(T0 + 23, T0 + 40) + range(T0 + 41, T0 + 60)
+
+@pytest.mark.parametrize('windowSlices', [1, 2, 3])
+def test_windows_span_chunks(windowSlices):
+    whole = SpectralAnalyzer(windowSlices, fineMaxHz=20.0).process(
+        sineChunk(TIMES, 6.0, 20.0))
+
+    # The same slices, in chunks shorter and longer than the window.
+    analyzer = SpectralAnalyzer(windowSlices, fineMaxHz=20.0)
+    times = []
+    bands = []
+    fine = []
+    start = 0
+    for size in [1, 2, 1, 5, 7, 1, 3, 30, 100]:
+        part = analyzer.process(sineChunk(TIMES[start : start + size], 6.0, 20.0))
+        times += part.epochTimes.tolist()
+        bands += part.bands.tolist()
+        fine += part.fine.tolist()
+        start += size
+    assert start >= len(TIMES)
+
+    assert times == whole.epochTimes.tolist()
+    numpy.testing.assert_allclose(bands, whole.bands)
+    numpy.testing.assert_allclose(fine, whole.fine)
+
+    # Windows run over back to back slices only, and end at their last.
+    expected = [t for t in TIMES
+                if all(t - k in TIMES for k in xrange(windowSlices))]
+    assert times == expected
+    numpy.testing.assert_allclose(numpy.array(bands)[:, bandIndex(6.0)[0]], 200.0,
+        rtol=0.01)
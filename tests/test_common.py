@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import time
+import random
+import calendar
+
+import pytest
+
+from common import ZeoTimeDecoder, ZEO_TIMESTAMP_FORMAT
+
+# What decode() should return for timestamp, or ValueError.
+def slowDecode(timestamp):
+    try:
+        timeStruct = time.strptime(timestamp, ZEO_TIMESTAMP_FORMAT)
+    except ValueError:
+        return ValueError
+    return (calendar.timegm(timeStruct), timeStruct)
+
+def decodeOrError(decoder, timestamp):
+    try:
+        return decoder.decode(timestamp)
+    except ValueError:
+        return ValueError
+
+EDGE_CASES = [
+    "02/29/2012 12:00:00", "02/29/2011 12:00:00", "02/28/2011 23:59:59",
+    "12/31/1999 23:59:59", "01/01/2000 00:00:00", "04/31/2011 00:00:00",
+    "00/10/2011 00:00:00", "13/10/2011 00:00:00", "03/00/2011 00:00:00",
+    "03/13/2011 24:00:00", "03/13/2011 23:60:00", "03/13/2011 23:59:60",
+    "03/13/2011 23:59:61", "03/13/2011 23:59:62", "3/13/2011 01:02:03",
+    "03/13/2011 1:02:03", "03/13/2011 +1:02:03", "03/13/2011 01: 2:03",
+    " 3/13/2011 01:02:03", "03/13/-011 01:02:03", "03-13-2011 01:02:03",
+    "03/13/2011T01:02:03", "03/13/2011 01:02:03 ", "", "garbage",
+    ]
+
+@pytest.mark.parametrize('timestamp', EDGE_CASES)
+def test_edge_cases_match_strptime(timestamp):
+    assert decodeOrError(ZeoTimeDecoder(), timestamp) == slowDecode(timestamp)
+
+def test_random_timestamps_match_strptime():
+    rnd = random.Random(8)
+    decoder = ZeoTimeDecoder()
+    epoch = calendar.timegm((2011, 3, 13, 0, 0, 0, 0, 0, 0))
+    for i in xrange(5000):
+        # Mostly consecutive seconds, as from the Zeo, with jumps.
+        if rnd.random() < 0.05:
+            epoch = rnd.randint(0, 2 ** 31 - 1)
+        else:
+            epoch += rnd.choice([0, 1, 1, 1, 30])
+        timestamp = time.strftime(ZEO_TIMESTAMP_FORMAT, time.gmtime(epoch))
+        result = decoder.decode(timestamp)
+        assert result == slowDecode(timestamp)
+        assert result[0] == epoch
+
+def test_cached_results_do_not_leak_between_timestamps():
+    decoder = ZeoTimeDecoder()
+    for timestamp in EDGE_CASES + EDGE_CASES[::-1]:
+        assert decodeOrError(decoder, timestamp) == slowDecode(timestamp)
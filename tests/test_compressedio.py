@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import os
+
+import pytest
+
+import compressedio
+from compressedio import CODECS, BlockCompressedFile, readBlocks
+
+BLOCK_SIZE = 1024
+
+def rowsText(first, count):
+    return b''.join(b'row %d,%d,%d\n' % (i, i * 7, i * i) for i in xrange(first, first + count))
+
+def writeFile(path, codec, text):
+    fileObj = BlockCompressedFile(path, codec, BLOCK_SIZE)
+    for line in text.splitlines(True):
+        fileObj.write(line)
+    fileObj.close()
+
+def readAll(path, codec):
+    return b''.join(data for (end, data) in readBlocks(path, codec))
+
+@pytest.fixture(params=sorted(CODECS))
+def codecPath(request, tmpdir):
+    return (CODECS[request.param], str(tmpdir.join('data.csv' + request.param)))
+
+def test_reopen_reads_only_first_and_last_blocks(codecPath, monkeypatch):
+    (codec, path) = codecPath
+    text = rowsText(0, 2000)
+    writeFile(path, codec, text)
+    nBlocks = len(list(readBlocks(path, codec)))
+    assert nBlocks > 10
+
+    decoded = []
+    def countingReadBlocks(path, codec=None, start=0):
+        for block in readBlocks(path, codec, start):
+            decoded.append(block)
+            yield block
+    monkeypatch.setattr(compressedio, 'readBlocks', countingReadBlocks)
+
+    fileObj = BlockCompressedFile(path, codec, BLOCK_SIZE)
+    fileObj.close()
+    assert len(decoded) <= 3
+    assert fileObj.droppedBytes == 0
+    assert fileObj.head == text[:len(fileObj.head)]
+    assert fileObj.lastBlock[1] == len(list(readBlocks(path, codec))[-1][1])
+
+def test_truncated_tail_is_cut_off_and_appended_to(codecPath):
+    (codec, path) = codecPath
+    text = rowsText(0, 2000)
+    writeFile(path, codec, text)
+    ends = [end for (end, data) in readBlocks(path, codec)]
+
+    # A crash partway through writing the last block.
+    fileObj = open(path, 'r+b')
+    fileObj.truncate(ends[-1] - 5)
+    fileObj.close()
+
+    kept = readAll(path, codec)
+    assert text.startswith(kept)
+
+    more = rowsText(2000, 500)
+    fileObj = BlockCompressedFile(path, codec, BLOCK_SIZE)
+    assert fileObj.droppedBytes == ends[-1] - 5 - ends[-2]
+    assert os.path.getsize(path) == ends[-2]
+    for line in more.splitlines(True):
+        fileObj.write(line)
+    fileObj.close()
+
+    assert readAll(path, codec) == kept + more
+
+def test_damaged_first_block_is_refused(codecPath):
+    (codec, path) = codecPath
+    fileObj = open(path, 'wb')
+    fileObj.write(b'not compressed at all\n')
+    fileObj.close()
+
+    with pytest.raises(compressedio.CompressedFileError):
+        BlockCompressedFile(path, codec, BLOCK_SIZE)
+    assert os.path.getsize(path) == len(b'not compressed at all\n')
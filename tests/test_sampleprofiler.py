@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+from sampleprofiler import mergeSnapshots
+
+def snapshot(samples, seconds, stacks):
+    result = {'start' : 0.0, 'end' : seconds, 'interval' : 0.01,
+              'samples' : samples, 'stacks' : stacks}
+    if seconds != None:
+        result['seconds'] = seconds
+    return result
+
+def test_samples_are_scaled_by_the_time_they_covered():
+    # 100 samples asked for every 10 ms that actually took 1.5 seconds.
+    stacks = [['Link', ['run', 'read'], 75], ['Link', ['run', 'parse'], 25]]
+    (sampled, threads, selfTime, cumulative, folded) = \
+        mergeSnapshots([snapshot(100, 1.5, stacks)])
+
+    assert sampled == 1.5
+    assert abs(threads['Link'] - 1.5) < 1e-9
+    assert abs(selfTime['read'] - 1.125) < 1e-9
+    assert abs(cumulative['run'] - 1.5) < 1e-9
+
+def test_snapshots_without_measured_time_use_the_interval():
+    stacks = [['Link', ['run'], 10]]
+    (sampled, threads, selfTime, cumulative, folded) = \
+        mergeSnapshots([snapshot(10, None, stacks), snapshot(0, 0.0, [])])
+    assert abs(sampled - 0.1) < 1e-9
+    assert abs(folded['Link;run'] - 0.1) < 1e-9
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import os
+import time
+import struct
+
+import pytest
+
+from common import DATA_SGRAM
+from shmring import RingWriter, RingReader, RingFormatError, SEQUENCE_FORMAT
+
+def write(writer, first, count):
+    for i in xrange(first, first + count):
+        writer.write(1300000000 + i, 1, 30, 100, 0, (i,) * 7)
+
+def values(records):
+    return [r[6][0] for r in records]
+
+@pytest.fixture
+def ringPath(tmpdir):
+    return str(tmpdir.join('test.sgram.ring'))
+
+def test_reader_keeps_up(ringPath):
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=8)
+    reader = RingReader(ringPath)
+    for first in xrange(0, 40, 5):
+        write(writer, first, 5)
+        assert values(reader.read()) == range(first, first + 5)
+    assert reader.lost == 0
+    assert reader.read() == []
+
+def test_lapped_reader_counts_what_it_lost(ringPath):
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=8)
+    reader = RingReader(ringPath)
+    write(writer, 0, 3)
+    assert values(reader.read()) == [0, 1, 2]
+    write(writer, 3, 20)
+    # Only the newest eight slices are still in the ring.
+    assert values(reader.read()) == range(15, 23)
+    assert reader.lost == 12
+    write(writer, 23, 8)
+    assert values(reader.read()) == range(23, 31)
+    assert reader.lost == 12
+
+def test_from_oldest_reads_what_is_left(ringPath):
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=8)
+    write(writer, 0, 11)
+    assert values(RingReader(ringPath, fromOldest=True).read()) == range(3, 11)
+    assert values(RingReader(ringPath).read()) == []
+
+def test_restart_with_fewer_slots_replaces_the_file(ringPath):
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=64)
+    reader = RingReader(ringPath)
+    write(writer, 0, 10)
+    assert values(reader.read()) == range(10)
+    oldSize = os.path.getsize(ringPath)
+    writer.close()
+
+    time.sleep(0.001) # For a new session.
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=4)
+    assert os.path.getsize(ringPath) < oldSize
+    assert not os.path.exists(ringPath + ".part")
+    write(writer, 100, 6)
+    # The reader's old mapping is still whole; it sees the new session and
+    #   opens the new file.
+    assert values(reader.read()) == range(102, 106)
+    write(writer, 106, 2)
+    assert values(reader.read()) == [106, 107]
+
+def test_missing_ring_can_be_retried(ringPath):
+    with pytest.raises(EnvironmentError):
+        RingReader(ringPath)
+    open(ringPath, 'wb').write('\0' * 64)
+    with pytest.raises(RingFormatError):
+        RingReader(ringPath)
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=8)
+    reader = RingReader(ringPath, fromOldest=True)
+    write(writer, 0, 2)
+    assert values(reader.read()) == [0, 1]
+
+def test_slot_being_written_is_skipped(ringPath):
+    writer = RingWriter(ringPath, DATA_SGRAM, slots=8)
+    reader = RingReader(ringPath)
+    write(writer, 0, 4)
+    # As if the writer were partway through slice 3.
+    offset = writer._slotOffset(2)
+    struct.pack_into(SEQUENCE_FORMAT, writer.map, offset, 0)
+    assert values(reader.read()) == [0, 1, 3]
+    assert reader.lost == 1
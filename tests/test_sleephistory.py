@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import random
+
+from sleephistory import SleepHistory, RunLengthHistory, \
+    SECONDS_PER_EPOCH, MAX_REWRITE_EPOCHS, MAX_GAP_EPOCHS
+
+T0 = 1300000000 - (1300000000 % SECONDS_PER_EPOCH)
+
+def runsOf(runs):
+    return (str(runs._stages), list(runs._starts), runs._nextEpoch)
+
+def recordBoth(history, runs, ch, epochTime):
+    added = history.record(ch, epochTime)
+    runs.record(ch, epochTime)
+    return added
+
+def test_rewrite_inside_gap_reaches_runs():
+    history = SleepHistory(100)
+    runs = RunLengthHistory()
+    for i in range(4):
+        recordBoth(history, runs, 'L', T0 + i * SECONDS_PER_EPOCH)
+    recordBoth(history, runs, 'D', T0 + 5 * SECONDS_PER_EPOCH)
+    recordBoth(history, runs, 'L', T0 + 4 * SECONDS_PER_EPOCH)
+
+    assert history.tail() == 'LLLLLD'
+    assert runsOf(runs) == runsOf(RunLengthHistory.fromHistory(history))
+    assert runs.currentRun('L') == ('D', T0 + 5 * SECONDS_PER_EPOCH, 1)
+
+def test_random_steps_keep_runs_in_step():
+    rng = random.Random(7)
+    history = SleepHistory(10000)
+    runs = RunLengthHistory()
+    epochTime = T0
+    for i in range(3000):
+        roll = rng.random()
+        if roll < 0.6:
+            epochTime += SECONDS_PER_EPOCH
+        elif roll < 0.7:
+            epochTime += SECONDS_PER_EPOCH * rng.randint(2, 5)
+        elif roll < 0.95:
+            epochTime -= SECONDS_PER_EPOCH * rng.randint(0, MAX_REWRITE_EPOCHS + 1)
+        else:
+            # A clock change.
+            epochTime -= SECONDS_PER_EPOCH * rng.randint(MAX_REWRITE_EPOCHS + 2, 200)
+        recordBoth(history, runs, rng.choice('ADLRdlr'), epochTime)
+
+        assert runsOf(runs) == runsOf(RunLengthHistory.fromHistory(history)), i
+
+# What SleepHistory should hold, kept as a plain list.
+class ModelHistory:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.epochs = []
+        self.lastEpochTime = None
+
+    def record(self, ch, epochTime):
+        if self.lastEpochTime == None:
+            return self._append([ch], epochTime)
+        gap = epochTime // SECONDS_PER_EPOCH - self.lastEpochTime // SECONDS_PER_EPOCH - 1
+        if gap < 0 and -1 - gap <= MAX_REWRITE_EPOCHS:
+            age = -1 - gap
+            if age == 0:
+                self.lastEpochTime = epochTime
+            if age >= len(self.epochs) or self.epochs[-1 - age] == ch:
+                return 0
+            self.epochs[-1 - age] = ch
+            return -1 - age
+        if gap > MAX_GAP_EPOCHS or gap < 0:
+            gap = 0
+        return self._append([' '] * gap + [ch], epochTime)
+
+    def _append(self, chars, epochTime):
+        self.epochs = (self.epochs + chars)[-self.capacity:]
+        self.lastEpochTime = epochTime
+        return len(chars)
+
+def assertSame(history, model):
+    expected = ''.join(model.epochs)
+    assert history.tail() == expected
+    assert len(history) == len(expected)
+    assert history.lastEpochTime == model.lastEpochTime
+    assert str(history.view()) == expected
+    for n in (0, 1, 3, len(expected)):
+        assert history.tail(n) == expected[max(0, len(expected) - n):]
+    for i in (0, -1, len(expected) // 2):
+        if expected:
+            assert history[i] == expected[i]
+
+def test_wraps_around_a_small_ring():
+    history = SleepHistory(7)
+    model = ModelHistory(7)
+    for i in xrange(40):
+        ch = 'ALDR'[i % 4]
+        epochTime = T0 + i * SECONDS_PER_EPOCH
+        assert history.record(ch, epochTime) == model.record(ch, epochTime)
+        assertSame(history, model)
+    assert history.firstEpochTime() == T0 + 33 * SECONDS_PER_EPOCH
+    assert history.atTime(T0 + 35 * SECONDS_PER_EPOCH + 29) == 'R'
+    assert history.atTime(T0 + 32 * SECONDS_PER_EPOCH) == None
+    assert history.atTime(T0 + 40 * SECONDS_PER_EPOCH) == None
+
+def test_gaps_are_filled_and_clock_changes_are_not():
+    history = SleepHistory(100)
+    assert history.record('L', T0) == 1
+    assert history.record('D', T0 + 4 * SECONDS_PER_EPOCH) == 4
+    assert history.tail() == 'L   D'
+    # A week and more forward is a clock change.
+    later = T0 + (6 + MAX_GAP_EPOCHS) * SECONDS_PER_EPOCH
+    assert history.record('R', later) == 1
+    assert history.tail() == 'L   DR'
+    # So is more than MAX_REWRITE_EPOCHS back.
+    earlier = later - (MAX_REWRITE_EPOCHS + 1) * SECONDS_PER_EPOCH
+    assert history.record('A', earlier) == 1
+    assert history.tail() == 'L   DRA'
+    assert history.lastEpochTime == earlier
+
+def test_gap_longer_than_the_ring():
+    history = SleepHistory(5)
+    history.record('L', T0)
+    assert history.record('D', T0 + 20 * SECONDS_PER_EPOCH) == 20
+    assert history.tail() == '    D'
+
+def test_rewrites_report_how_far_back():
+    history = SleepHistory(100)
+    for i in xrange(6):
+        history.record('L', T0 + i * SECONDS_PER_EPOCH)
+    last = history.lastEpochTime
+    assert history.record('L', T0 + 3 * SECONDS_PER_EPOCH) == 0
+    assert history.record('D', T0 + 3 * SECONDS_PER_EPOCH) == -3
+    assert history.record('R', T0 + 5 * SECONDS_PER_EPOCH + 10) == -1
+    assert history.tail() == 'LLLDLR'
+    assert history.lastEpochTime == T0 + 5 * SECONDS_PER_EPOCH + 10
+    # The oldest epoch that can be rewritten, and one that can't.
+    assert history.record('A', T0 + 1 * SECONDS_PER_EPOCH) == -5
+    assert history.record('A', T0) == 1
+    assert history.tail() == 'LALDLRA'
+
+def test_rewrite_older_than_history():
+    history = SleepHistory(100)
+    history.record('L', T0)
+    assert history.record('D', T0 - SECONDS_PER_EPOCH) == 0
+    assert history.tail() == 'L'
+
+def test_random_steps_match_model():
+    rng = random.Random(9)
+    for capacity in (1, 2, 13, 500):
+        history = SleepHistory(capacity)
+        model = ModelHistory(capacity)
+        epochTime = T0
+        for i in xrange(2000):
+            roll = rng.random()
+            if roll < 0.6:
+                epochTime += SECONDS_PER_EPOCH
+            elif roll < 0.7:
+                epochTime += SECONDS_PER_EPOCH * rng.randint(2, 2 * capacity)
+            elif roll < 0.95:
+                epochTime -= SECONDS_PER_EPOCH * rng.randint(0, MAX_REWRITE_EPOCHS + 1)
+            else:
+                epochTime -= SECONDS_PER_EPOCH * rng.randint(MAX_REWRITE_EPOCHS + 2, 200)
+            epochTime += rng.randint(-5, 5)
+            ch = rng.choice('ADLRdlr')
+            assert history.record(ch, epochTime) == model.record(ch, epochTime), i
+            assertSame(history, model)
+
+def test_file_keeps_history_and_converts_capacity(tmpdir):
+    path = str(tmpdir.join('sleep_history.dat'))
+    history = SleepHistory(10, path)
+    for i in xrange(14):
+        history.record('ALDR'[i % 4], T0 + i * SECONDS_PER_EPOCH)
+    history.close()
+
+    history = SleepHistory(10, path)
+    assert history.tail() == 'ALDRALDRAL'
+    assert history.lastEpochTime == T0 + 13 * SECONDS_PER_EPOCH
+    history.record('A', T0 + 15 * SECONDS_PER_EPOCH)
+    history.close()
+
+    history = SleepHistory(4, path)
+    assert history.tail() == 'AL A'
+    assert history.lastEpochTime == T0 + 15 * SECONDS_PER_EPOCH
+    history.close()
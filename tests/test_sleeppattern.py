@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import re
+import random
+
+import sleeppattern
+from sleeppattern import parseSleepPattern, PatternSet, SetMatcher, epochSymbol, \
+    STAGE_LETTERS, GAP_SYMBOL_BASE, GAP_AT_START, N_SYMBOLS
+
+def compile(text):
+    return parseSleepPattern(text)[0]
+
+# Returns the indexes of the epochs in history at which pattern matches.
+def matchesIn(pattern, history):
+    matcher = SetMatcher(PatternSet([pattern]))
+    symbol = None
+    result = []
+    for i in xrange(len(history)):
+        symbol = epochSymbol(history[i], symbol)
+        if matcher.feed(symbol):
+            result.append(i)
+    return result
+
+def test_question_mark_after_plus_or_star_is_lazy_marker():
+    assert compile('m/w+s{4}+?/').tree == compile('m/w+s{4}+/').tree
+    assert compile('e/wl*?/').tree == compile('e/wl*/').tree
+    # Not at the wake epochs, as an optional s{4}+ would.
+    history = 'AA' + 'L' * 20 + 'AA'
+    assert matchesIn(compile('m/w+s{4}+?/'), history) == [9, 17]
+
+def test_question_mark_after_count_is_optional():
+    assert compile('e/r{3}?/').matchesEmpty
+    assert compile('e/r??/').matchesEmpty
+    assert matchesIn(compile('e/ar{2}?/'), 'AARRR') == [0, 1, 3]
+
+# The naive way: each epoch as two characters, the stage it counts as and
+#   whether it was unrecorded, and the pattern as a Python regular
+#   expression over that, searched for at the end of the history so far.
+def encodeHistory(history):
+    encoded = []
+    previous = '?'
+    for ch in history:
+        if ch in STAGE_LETTERS:
+            encoded.append(ch + '.')
+            previous = ch
+        else:
+            encoded.append(previous + 'g')
+    return ''.join(encoded)
+
+def _symbolText(symbol):
+    if symbol == GAP_AT_START:
+        return '?g'
+    if symbol >= GAP_SYMBOL_BASE:
+        return STAGE_LETTERS[symbol - GAP_SYMBOL_BASE] + 'g'
+    return STAGE_LETTERS[symbol] + '.'
+
+def naiveRegex(node):
+    kind = node[0]
+    if kind == 'set':
+        texts = [re.escape(_symbolText(symbol)) for symbol in xrange(N_SYMBOLS)
+                 if node[1] & (1 << symbol)]
+        if len(texts) == 0:
+            return '(?!)'
+        return '(?:' + '|'.join(texts) + ')'
+    elif kind == 'cat':
+        return '(?:' + ''.join([naiveRegex(child) for child in node[1]]) + ')'
+    elif kind == 'alt':
+        return '(?:' + '|'.join([naiveRegex(child) for child in node[1]]) + ')'
+    (lo, hi) = (node[2], node[3])
+    if hi == None:
+        hi = ''
+    return '(?:' + naiveRegex(node[1]) + '){' + str(lo) + ',' + str(hi) + '}'
+
+def regexMatches(pattern, history):
+    regex = re.compile(naiveRegex(pattern.tree) + r'\Z')
+    encoded = encodeHistory(history)
+    return [i for i in xrange(len(history))
+            if regex.search(encoded, 0, 2 * (i + 1)) != None]
+
+# Python's backtracking takes far too long on some patterns, such as
+#   ([Rr]?s)*, so random ones are checked against sets of positions instead:
+#   _ends() returns every j for which the syntax tree matches symbols[i:j].
+def _ends(node, symbols, i, memo):
+    key = (id(node), i)
+    result = memo.get(key)
+    if result != None:
+        return result
+
+    kind = node[0]
+    if kind == 'set':
+        result = set()
+        if i < len(symbols) and node[1] & (1 << symbols[i]):
+            result.add(i + 1)
+    elif kind == 'cat':
+        result = set([i])
+        for child in node[1]:
+            result = _endsFrom(child, symbols, result, memo)
+    elif kind == 'alt':
+        result = set()
+        for child in node[1]:
+            result |= _ends(child, symbols, i, memo)
+    else:
+        (child, lo, hi) = node[1:]
+        current = set([i])
+        for n in xrange(lo):
+            current = _endsFrom(child, symbols, current, memo)
+        result = set(current)
+        n = lo
+        while len(current) > 0 and (hi == None or n < hi):
+            current = _endsFrom(child, symbols, current, memo)
+            if hi == None:
+                current -= result
+            result |= current
+            n += 1
+
+    memo[key] = result
+    return result
+
+def _endsFrom(node, symbols, starts, memo):
+    result = set()
+    for i in starts:
+        result |= _ends(node, symbols, i, memo)
+    return result
+
+def setMatches(pattern, history):
+    symbols = []
+    symbol = None
+    for ch in history:
+        symbol = epochSymbol(ch, symbol)
+        symbols.append(symbol)
+    memo = {}
+    ends = _endsFrom(pattern.tree, symbols, range(len(history) + 1), memo)
+    return [i for i in xrange(len(history)) if i + 1 in ends]
+
+# Quantifiers to put after an item, stacked ones included.
+_QUANTIFIERS = ['', '', '', '?', '*', '+', '{2}', '{1,3}', '{2,}', '+?', '*?',
+                '{2}+', '{2}?', '{1,2}{2}', '??', '?+', '+*']
+
+def randomPattern(rng, depth=0):
+    items = []
+    for i in xrange(rng.randint(1, 3)):
+        roll = rng.random()
+        if roll < 0.5 or depth >= 2:
+            item = rng.choice('arldusw' + 'ARLDUSW' + '. ')
+        elif roll < 0.7:
+            item = '[' + rng.choice(['', '^']) + \
+                ''.join(rng.sample('arldARLD ', rng.randint(1, 3))) + ']'
+        else:
+            item = '(' + randomPattern(rng, depth + 1) + ')'
+        items.append(item + rng.choice(_QUANTIFIERS))
+    pattern = ''.join(items)
+    if depth > 0 and rng.random() < 0.3:
+        pattern += '|' + randomPattern(rng, depth + 1)
+    return pattern
+
+def randomHistory(rng, n):
+    history = []
+    while len(history) < n:
+        history += rng.choice(STAGE_LETTERS + '  ') * rng.randint(1, 6)
+    return ''.join(history[:n])
+
+# The examples from phasic-encabulator.conf.example.
+EXAMPLES = ['m/w+r{20}/', 'm/[^l]l{5}/', 'm/w+s{4}+?/', 'e/awrldusAWRLDUS/',
+            'e!w{2}!', 'm/awrl(dus)*/', 'mZa warldu Z', 'm/r/', 'e/rrRRrr/',
+            'h/rr/', 'm/r{60}r{30}r{30}?/']
+
+# Matches the examples that random histories hardly ever do.
+EXAMPLE_HISTORY = 'aarldudAURLDULaauurrll  aa  aaaarrllddUU  '
+
+def test_examples_agree_with_naive_regex():
+    rng = random.Random(10)
+    for text in EXAMPLES:
+        pattern = compile(text)
+        histories = [EXAMPLE_HISTORY]
+        for i in xrange(4):
+            # Long runs, so that the minute and hour patterns have a chance.
+            histories.append(''.join([rng.choice('AaRrLlDdUu ') * rng.randint(1, 60)
+                                      for j in xrange(8)] + ['R' * 250]))
+        for history in histories:
+            expected = regexMatches(pattern, history)
+            assert matchesIn(pattern, history) == expected, (text, history)
+            assert setMatches(pattern, history) == expected, (text, history)
+
+def test_random_patterns_agree_with_sets():
+    rng = random.Random(11)
+    for i in xrange(400):
+        pattern = compile(rng.choice('em') + '/' + randomPattern(rng) + '/')
+        history = randomHistory(rng, 120)
+        assert matchesIn(pattern, history) == setMatches(pattern, history), \
+            (pattern.source, history)
+
+def test_pattern_set_reports_each_pattern(monkeypatch):
+    # A tiny cache, so that starting over is checked too.
+    monkeypatch.setattr(sleeppattern, 'MAX_DFA_STATES', 16)
+    rng = random.Random(12)
+    patterns = [compile('e/' + randomPattern(rng) + '/') for i in xrange(6)]
+    matcher = SetMatcher(PatternSet(patterns))
+    history = randomHistory(rng, 400)
+    expected = [set(setMatches(pattern, history)) for pattern in patterns]
+
+    symbol = None
+    for i in xrange(len(history)):
+        symbol = epochSymbol(history[i], symbol)
+        mask = matcher.feed(symbol)
+        for j in xrange(len(patterns)):
+            assert bool(mask & (1 << j)) == (i in expected[j]), (patterns[j].source, i)
+    assert matcher.resets > 0
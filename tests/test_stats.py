@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import threading
+
+from stats import LatencyHistogram, PipelineStats, N_BUCKETS, SUB_BUCKETS, \
+    bucketFor, bucketLimit, bucketPercentile
+
+def test_buckets_cover_every_microsecond_in_order():
+    previousLimit = 0
+    for i in xrange(N_BUCKETS):
+        assert bucketFor(previousLimit) == i
+        assert bucketFor(bucketLimit(i) - 1) == i
+        previousLimit = bucketLimit(i)
+    assert previousLimit > 30 * 60 * 1000000
+
+def test_percentiles_are_within_a_sub_bucket():
+    for us in (1, 3, 17, 250, 999, 12345, 5000000):
+        histogram = LatencyHistogram()
+        for i in xrange(100):
+            histogram.record(us / 1000000.0)
+        p50 = bucketPercentile(histogram.buckets, 0.5)
+        assert us < p50 <= us * (1.0 + 1.0 / SUB_BUCKETS) + 1
+
+def test_updates_from_several_threads_are_all_kept():
+    stats = PipelineStats()
+    stage = stats.stage('link: packet')
+    def work():
+        for i in xrange(20000):
+            stage.record(0.000010)
+            stats.count('packets')
+    threads = [threading.Thread(target=work) for i in xrange(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = stats.snapshot()
+    assert snapshot['counters']['packets'] == 80000
+    (buckets, count, total, maximum) = snapshot['stages']['link: packet']
+    assert count == 80000 and sum(buckets) == 80000
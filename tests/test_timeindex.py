@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+import os
+import time
+import random
+
+import pytest
+
+from common import DATA_SGRAM, ZEO_TIMESTAMP_FORMAT
+from sleepconfig import RecordingSection
+from rowwriter import openSink
+from timeindex import findStart, readTimeRange, loadIndex, indexPath, zeoTime
+
+T0 = 1300000000 - (1300000000 % 60)
+
+def test_find_start_bounds():
+    entries = [(100, 10, 0), (160, 20, 5), (220, 30, 0)]
+    assert findStart([], 500) == (0, 0)
+    assert findStart(entries, 99) == (0, 0)
+    assert findStart(entries, 100) == (10, 0)
+    assert findStart(entries, 159) == (10, 0)
+    assert findStart(entries, 160) == (20, 5)
+    assert findStart(entries, 161) == (20, 5)
+    assert findStart(entries, 10 ** 10) == (30, 0)
+
+# The times of the rows written, one a second with a few gaps.
+def rowTimes():
+    rng = random.Random(17)
+    times = []
+    t = T0 + 7
+    while len(times) < 900:
+        times.append(t)
+        t += 1
+        if rng.random() < 0.01:
+            t += rng.randint(2, 200)
+    return times
+
+def writeFile(path):
+    policy = RecordingSection()
+    policy.indexSeconds = 10
+    # Small blocks, so that entries point into the middle of them.
+    policy.compressBlockKb = 2
+    sink = openSink(path, DATA_SGRAM, policy)
+    for (i, t) in enumerate(rowTimes()):
+        timestamp = time.strftime(ZEO_TIMESTAMP_FORMAT, time.gmtime(t))
+        values = [0.125 * ((i + j) % 8) for j in xrange(7)]
+        sink.write([timestamp, '3', '30', '500', 'N'] + values, t)
+        if i % 100 == 0:
+            sink.flush()
+    sink.close()
+
+def timesIn(path, startTime, endTime):
+    result = []
+    for row in readTimeRange(path, startTime, endTime):
+        if path.endswith('.csv') or path.endswith('.csv.gz'):
+            result.append(zeoTime(row[0]))
+        else:
+            result.append(row[0])
+    return result
+
+@pytest.fixture(params=['.csv', '.csv.gz', '.bin', '.bin.gz'])
+def recordedPath(request, tmpdir):
+    path = str(tmpdir.join('sgram' + request.param))
+    writeFile(path)
+    return path
+
+def test_ranges_match_the_rows_written(recordedPath):
+    times = rowTimes()
+    entries = loadIndex(indexPath(recordedPath))
+    assert len(entries) > 50
+    assert entries[0][0] == times[0]
+
+    ranges = [(0, 10 ** 10), (times[0], times[0] + 1), (times[0] + 1, times[0] + 1),
+              (times[-1], times[-1] + 1), (times[-1] + 1, 10 ** 10),
+              (times[400], times[300])]
+    for (entryTime, offset, skip) in entries[1:40:7]:
+        ranges += [(entryTime, entryTime + 25), (entryTime - 1, entryTime),
+                   (entryTime + 1, entryTime + 3), (entryTime - 31, entryTime + 31)]
+    # Starting and ending in gaps.
+    for i in xrange(1, len(times)):
+        if times[i] - times[i - 1] > 2:
+            ranges.append((times[i - 1] + 1, times[i] + 1))
+            ranges.append((times[i] - 1, times[i] + 60))
+
+    for (startTime, endTime) in ranges:
+        expected = [t for t in times if startTime <= t < endTime]
+        assert timesIn(recordedPath, startTime, endTime) == expected, (startTime, endTime)
+
+def test_index_gives_the_same_rows_as_reading_it_all(recordedPath):
+    times = rowTimes()
+    startTime = times[500]
+    endTime = times[620]
+    withIndex = list(readTimeRange(recordedPath, startTime, endTime))
+    assert findStart(loadIndex(indexPath(recordedPath)), startTime)[0] > 0
+    os.remove(indexPath(recordedPath))
+    assert list(readTimeRange(recordedPath, startTime, endTime)) == withIndex
+    assert len(withIndex) == len([t for t in times if startTime <= t < endTime])
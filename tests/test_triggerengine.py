@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+from sleephistory import SleepHistory, SECONDS_PER_EPOCH
+from sleeppattern import parseSleepPattern
+from triggerengine import TriggerEngine
+
+T0 = 1300000000 - (1300000000 % SECONDS_PER_EPOCH)
+
+class Section:
+    def __init__(self, patterns):
+        self.patterns = [(name, parseSleepPattern(text)[0]) for (name, text) in patterns]
+
+# Feeds the history and the engine the way SleepContext and NapTrainer do, and
+#   returns the names of the triggers that fired.
+def record(history, engine, ch, epoch):
+    added = history.record(ch, T0 + epoch * SECONDS_PER_EPOCH)
+    epochTime = history.lastEpochTime
+    if added < 0:
+        fired = engine.revise(history.tail(-added), epochTime)
+    elif added > 0:
+        if added > 1:
+            engine.skipGap(added - 1, epochTime - SECONDS_PER_EPOCH)
+        fired = engine.update(history[-1], epochTime)
+    else:
+        fired = []
+    return [t.name for t in fired]
+
+def makeEngine(*patterns):
+    return TriggerEngine([Section(patterns)], None)
+
+def test_late_reading_completes_pattern():
+    history = SleepHistory(100)
+    engine = makeEngine(('six', 'e/l{6}/'))
+    for epoch in range(5):
+        assert record(history, engine, 'L', epoch) == []
+    assert record(history, engine, 'D', 6) == []
+
+    assert record(history, engine, 'L', 5) == ['six']
+    assert history.tail() == 'LLLLLLD'
+
+def test_late_reading_does_not_fire_twice():
+    history = SleepHistory(100)
+    engine = makeEngine(('six', 'e/l{6}/'))
+    fired = []
+    for epoch in range(7):
+        fired += record(history, engine, 'L', epoch)
+    assert fired == ['six']
+
+    # Still matching, so it's the same match as before.
+    assert record(history, engine, 'l', 5) == []
+    assert record(history, engine, 'L', 7) == []
+
+def test_revise_through_a_gap_matches_a_fresh_engine():
+    steps = [('L', 0), ('L', 1), ('D', 5), ('R', 6), ('L', 3), ('R', 7), ('D', 6)]
+    history = SleepHistory(100)
+    engine = makeEngine(('ld', 'e/l+d/'), ('rem', 'e/dr/'))
+    for (ch, epoch) in steps:
+        record(history, engine, ch, epoch)
+
+    fresh = makeEngine(('ld', 'e/l+d/'), ('rem', 'e/dr/'))
+    fresh.prime(history.tail(), history.lastEpochTime)
+    assert engine.matcher.position() == fresh.matcher.position()
+    assert engine._active == fresh._active
+    assert history.tail() == 'LL L DDR'
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+
+# Timestamp indexes for recorded raw and spectrogram files.
+#
+# Next to each such file is a sidecar, the file's name plus INDEX_EXTENSION,
+#   which says where in the file the rows for a given time start.  An entry is
+#   added for the first row of every interval (index_seconds in the recording
+#   section of the config file) as rows are written, so finding a time only
+#   takes a binary search of the index and a read of the rows after it:
+#
+#   for row in readTimeRange(path, zeoTime("03/08/2011 03:04:00"),
+#                                  zeoTime("03/08/2011 03:24:00")):
+#       ...
+#
+# Index file:
+#   8s  magic
+#   I   format version
+#   I   interval in seconds
+#   then entries:
+#   q   Zeo time of the row, in epoch seconds (see ZeoTimeDecoder)
+#   Q   file offset of the row.  For compressed files, the offset of the
+#       block the row is in.
+#   Q   for compressed files, how far into the block's data the row starts.
+#       Otherwise 0.
+#
+# Times are expected to only move forward.  If the Zeo's clock is set back,
+#   no entries are added until it passes the last indexed time again.
+
+import os
+import csv
+import bisect
+import struct
+
+from common import *
+from binformat import BIN_EXTENSION, readHeader, parseHeader, recordFormat
+from compressedio import codecForPath, stripCodecExtension, readBlocks
+
+INDEX_EXTENSION = ".idx"
+
+INDEX_MAGIC   = b'PEIDX\0\0\0'
+INDEX_VERSION = 1
+INDEX_HEADER_FORMAT = '<8sII'
+INDEX_HEADER_SIZE = struct.calcsize(INDEX_HEADER_FORMAT)
+INDEX_ENTRY_FORMAT = '<qQQ'
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+
+# The data types that get an index.  The others are small enough to read
+#   whole.
+INDEXED_DATA_TYPES = (DATA_RAW, DATA_SGRAM)
+
+# How much to read at a time from plain files.
+_READ_CHUNK_SIZE = 64 * 1024
+
+class IndexFormatError(ValueError):
+    ''' A file is not a timestamp index. '''
+    pass
+
+# Returns the path of the index for a data file.
+def indexPath(path):
+    return path + INDEX_EXTENSION
+
+# Turns a Zeo timestamp ("MM/DD/YYYY HH:MM:SS") into the epoch seconds used
+#   by the index.
+def zeoTime(timestamp):
+    return zeoTimeDecoder.decode(timestamp)[0]
+
+# Reads an index file.  Returns a list of (time, offset, skip) entries; a
+#   partly written entry at the end is left out.
+def loadIndex(path):
+    fileObj = open(path, 'rb')
+    try:
+        data = fileObj.read()
+    finally:
+        fileObj.close()
+
+    _checkHeader(data)
+    nEntries = (len(data) - INDEX_HEADER_SIZE) // INDEX_ENTRY_SIZE
+    unpacker = struct.Struct(INDEX_ENTRY_FORMAT)
+    return [unpacker.unpack_from(data, INDEX_HEADER_SIZE + i * INDEX_ENTRY_SIZE)
+            for i in xrange(nEntries)]
+
+def _checkHeader(data):
+    if len(data) < INDEX_HEADER_SIZE:
+        raise IndexFormatError("File is too short to be an index.")
+    (magic, version, interval) = struct.unpack_from(INDEX_HEADER_FORMAT, data)
+    if magic != INDEX_MAGIC:
+        raise IndexFormatError("Not an index file.")
+    if version != INDEX_VERSION:
+        raise IndexFormatError("Unsupported index version: "+str(version))
+
+# Adds entries to the index of a file that is being appended to.
+class TimeIndexWriter:
+
+    # dataSize is the size of the data file as it is now.  Entries that
+    #   point past it were written before a crash lost the data they point
+    #   to, and are dropped.
+    def __init__(self, path, dataSize, interval):
+        self.path = path
+        self.interval = interval
+        self.lastTime = None
+        self._nextTime = None
+        self._pending = []
+        self._packer = struct.Struct(INDEX_ENTRY_FORMAT)
+
+        entries = []
+        if dataSize > 0 and os.path.isfile(path):
+            try:
+                entries = loadIndex(path)
+            except IndexFormatError:
+                # Written by something else, or damaged.  Start over.
+                entries = []
+
+        # Entries are in file order, so the bad ones are all at the end.
+        nValid = len(entries)
+        while nValid > 0 and entries[nValid - 1][1] >= dataSize:
+            nValid -= 1
+
+        if len(entries) == 0:
+            self.fileObj = open(path, 'wb')
+            self.fileObj.write(struct.pack(INDEX_HEADER_FORMAT, INDEX_MAGIC,
+                INDEX_VERSION, interval))
+        else:
+            self.fileObj = open(path, 'r+b')
+            self.fileObj.truncate(INDEX_HEADER_SIZE + nValid * INDEX_ENTRY_SIZE)
+            self.fileObj.seek(0, os.SEEK_END)
+            if nValid > 0:
+                self._setLast(entries[nValid - 1][0])
+
+    def _setLast(self, epochTime):
+        self.lastTime = epochTime
+        self._nextTime = epochTime - (epochTime % self.interval) + self.interval
+
+    # True if a row at epochTime should get an entry.
+    def wants(self, epochTime):
+        return self._nextTime == None or epochTime >= self._nextTime
+
+    # Records that the row at epochTime starts at (offset, skip).
+    def add(self, epochTime, offset, skip=0):
+        self._pending.append(self._packer.pack(epochTime, offset, skip))
+        self._setLast(epochTime)
+
+    # Writes out the entries added since the last flush.  Flush the data file
+    #   first, so that the index never points at data that isn't there.
+    def flush(self, sync=False):
+        if len(self._pending) > 0:
+            self.fileObj.write(b''.join(self._pending))
+            self._pending = []
+        self.fileObj.flush()
+        if sync:
+            os.fsync(self.fileObj.fileno())
+
+    def close(self):
+        self.flush()
+        self.fileObj.close()
+
+# Finds where to start reading for rows at or after startTime.  Returns
+#   (offset, skip), or (0, 0) if the file has to be read from the start.
+def findStart(entries, startTime):
+    times = [entry[0] for entry in entries]
+    i = bisect.bisect_right(times, startTime) - 1
+    if i < 0:
+        return (0, 0)
+    return entries[i][1:]
+
+# Reads the rows of a recorded file with startTime <= time < endTime.  Times
+#   are epoch seconds, as zeoTime() returns.
+# CSV rows come back as lists of strings, as the csv module reads them.  .bin
+#   records come back as BinReader returns them.
+# Without an index (or for times before the first entry) the file is read
+#   from the start, so this works for any recorded file, just more slowly.
+def readTimeRange(path, startTime, endTime):
+    entries = []
+    if os.path.isfile(indexPath(path)):
+        entries = loadIndex(indexPath(path))
+    (offset, skip) = findStart(entries, startTime)
+
+    codec = codecForPath(path)
+    isBin = stripCodecExtension(path).endswith(BIN_EXTENSION)
+
+    if isBin:
+        rows = _binRecords(path, codec, offset, skip)
+        timeOf = lambda record: record[0]
+    else:
+        rows = csv.reader(_lines(_chunks(path, codec, offset, skip)))
+        timeOf = _csvRowTime
+
+    for row in rows:
+        rowTime = timeOf(row)
+        if rowTime == None or rowTime < startTime:
+            continue
+        if rowTime >= endTime:
+            break
+        yield row
+
+# The column header (or anything else without a timestamp) gives None.
+def _csvRowTime(row):
+    if len(row) == 0:
+        return None
+    try:
+        return zeoTime(row[0])
+    except ValueError:
+        return None
+
+# Yields the data of a file from (offset, skip) on, in pieces.
+def _chunks(path, codec, offset, skip):
+    if codec != None:
+        for (end, data) in readBlocks(path, codec, offset):
+            if skip > 0:
+                data = data[skip:]
+                skip = 0
+            yield data
+        return
+
+    fileObj = open(path, 'rb')
+    try:
+        fileObj.seek(offset + skip)
+        while True:
+            data = fileObj.read(_READ_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+    finally:
+        fileObj.close()
+
+def _lines(chunks):
+    partial = b''
+    for data in chunks:
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if partial:
+        yield partial
+
+def _binRecords(path, codec, offset, skip):
+    if codec != None:
+        header = None
+        for (end, data) in readBlocks(path, codec):
+            header = parseHeader(data)
+            break
+        if header == None:
+            return
+    else:
+        fileObj = open(path, 'rb')
+        try:
+            header = readHeader(fileObj)
+        finally:
+            fileObj.close()
+
+    # Offsets within the first block are offsets within the file, since it
+    #   starts at 0.
+    if offset == 0 and skip < header.headerSize:
+        skip = header.headerSize
+
+    unpacker = struct.Struct(recordFormat(header))
+    size = header.recordSize
+    partial = b''
+    for data in _chunks(path, codec, offset, skip):
+        data = partial + data
+        end = len(data) - len(data) % size
+        for start in xrange(0, end, size):
+            fields = unpacker.unpack_from(data, start)
+            yield fields[:5] + (fields[5:],)
+        partial = data[end:]
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Phasic Encabulator -- Records and responds to sleep data in realtime.
+    Copyright (C) 2011  Chad Joan
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+    To contact the author, send an email to chadjoan@gmail.com
+
+
+    This program will require either the Zeo Raw Data Library or a suitable
+    substitute in order to function.  If you use the Zeo Raw Data Library you
+    must also agree to the terms and conditions for the Zeo Raw Data Library.
+    These terms and conditions can be found at
+    <http://developers.myzeo.com/terms-and-conditions/>.
+
+'''
+
+# Decides when action triggers fire.
+#
+# The engine is handed each epoch as it is added to the sleep history.  All
+#   of the triggers' patterns are matched together by one automaton, which
+#   is advanced by that one epoch and reports which patterns match as a bit
+#   mask.  A trigger fires when its pattern starts matching.  It won't fire
+#   again until the pattern has stopped matching and then matched again.
+#
+# A trigger that has the same name as a timespan only fires during that
+#   timespan.  Triggers without a timespan can fire at any time.  This is
+#   decided by a second bit mask, looked up by the minute of the day.
+#
+# A late reading can change one of the last few epochs after the engine has
+#   been through it.  The engine keeps where it was before each of its last
+#   MAX_REWRITE_EPOCHS + 1 epochs, so revise() can go back there and feed
+#   the corrected epochs through again.
+
+import collections
+
+from sleeppattern import PatternSet, SetMatcher, epochSymbol
+from sleephistory import UNRECORDED, SECONDS_PER_EPOCH, MAX_REWRITE_EPOCHS
+
+SECONDS_PER_DAY = 24 * 60 * 60
+MINUTES_PER_DAY = 24 * 60
+
+# How many epochs of old history are replayed when the engine starts, so that
+#   patterns spanning a restart still match.  This is one day.
+PRIME_EPOCHS = 2 * 60 * 24
+
+class Trigger:
+    def __init__(self, name, pattern, section, bit):
+        self.name = name
+        self.pattern = pattern
+        self.section = section # The action_trigger section it came from.
+        self.bit = bit
+
+class TriggerEngine:
+
+    # triggerTables is a list of TriggerSections from the config file.
+    # timespanIndex decides which triggers are allowed to fire when; it may
+    #   be None.
+    def __init__(self, triggerTables, timespanIndex):
+        self.timespanIndex = timespanIndex
+        self.triggers = []
+        for section in triggerTables:
+            for (name, pattern) in section.patterns:
+                bit = 1 << len(self.triggers)
+                self.triggers.append(Trigger(name, pattern, section, bit))
+
+        self.matcher = SetMatcher(PatternSet([t.pattern for t in self.triggers]))
+        self._allMask = (1 << len(self.triggers)) - 1
+        self._gateMasks = self._buildGateMasks()
+
+        self._previous = None # Symbol of the last epoch fed in.
+        self._active = 0 # Triggers that were matching and scheduled.
+        self._fired = 0 # Triggers that fired on the last epoch.
+
+        # (matcher position, previous symbol, active triggers, fired triggers)
+        #   from before each of the last few epochs, oldest first.
+        self._checkpoints = collections.deque(maxlen=MAX_REWRITE_EPOCHS + 1)
+
+    # Returns a list with, for each minute of the day, the mask of the
+    #   triggers that may fire during that minute.
+    def _buildGateMasks(self):
+        if self.timespanIndex == None:
+            return [self._allMask] * MINUTES_PER_DAY
+
+        unscheduled = 0
+        for trigger in self.triggers:
+            if trigger.name not in self.timespanIndex:
+                unscheduled |= trigger.bit
+
+        # The index shares one set of names between all the minutes that
+        #   have the same names, so only compute each mask once.
+        maskByNames = {}
+        gateMasks = []
+        for names in self.timespanIndex.minuteTable:
+            mask = maskByNames.get(names)
+            if mask == None:
+                mask = unscheduled
+                for trigger in self.triggers:
+                    if trigger.name in names:
+                        mask |= trigger.bit
+                maskByNames[names] = mask
+            gateMasks.append(mask)
+
+        return gateMasks
+
+    # Catches up on epochs recorded before the engine was created, without
+    #   firing anything.  lastEpochTime is the time of the last of them.
+    def prime(self, epochs, lastEpochTime):
+        if len(epochs) > PRIME_EPOCHS:
+            epochs = epochs[-PRIME_EPOCHS:]
+
+        epochTime = _offset(lastEpochTime, 1 - len(epochs))
+        for ch in epochs:
+            self.update(ch, epochTime)
+            epochTime = _offset(epochTime, 1)
+
+    # Advances past count unrecorded epochs without firing anything.  The
+    #   last of them is at lastGapTime.
+    # A run of unrecorded epochs soon stops changing which patterns could
+    #   match, and once it does the rest of the run is skipped.
+    def skipGap(self, count, lastGapTime):
+        if len(self.triggers) == 0:
+            return
+
+        matcher = self.matcher
+        firstGapTime = _offset(lastGapTime, 1 - count)
+        i = 0
+        while i < count:
+            self._checkpoint()
+            symbol = epochSymbol(UNRECORDED, self._previous)
+            before = (matcher.state, matcher.resets, self._previous)
+            self._previous = symbol
+            matcher.feed(symbol)
+            self._active = matcher.matching() & self._gateAt(_offset(firstGapTime, i))
+            self._fired = 0
+            i += 1
+            if (matcher.state, matcher.resets, self._previous) == before:
+                break
+
+        # The rest of the gap doesn't move the matcher, but revise() may need
+        #   to start from one of its last few epochs.
+        for j in xrange(max(i, count - self._checkpoints.maxlen), count):
+            self._active = matcher.matching() & self._gateAt(_offset(firstGapTime, j - 1))
+            self._checkpoint()
+
+        self._active = matcher.matching() & self._gateAt(lastGapTime)
+
+    # Advances every trigger by one epoch.  epochTime is the epoch's local
+    #   time in epoch seconds (as SleepContext keeps it), or None if unknown.
+    # Returns the list of triggers that fired.
+    def update(self, ch, epochTime):
+        if len(self.triggers) == 0:
+            return []
+
+        self._checkpoint()
+        symbol = epochSymbol(ch, self._previous)
+        self._previous = symbol
+
+        active = self.matcher.feed(symbol) & self._gateAt(epochTime)
+        fired = active & ~self._active
+        self._active = active
+        self._fired = fired
+
+        if fired == 0:
+            return []
+        return [t for t in self.triggers if t.bit & fired]
+
+    # Goes back over the newest epochs after a late reading changed the first
+    #   of them.  epochs are their history characters, oldest first, and
+    #   lastEpochTime is the time of the newest.
+    # Returns the list of triggers that fired.  Triggers that already fired
+    #   on any of those epochs don't fire again.
+    def revise(self, epochs, lastEpochTime):
+        n = min(len(epochs), len(self._checkpoints))
+        if len(self.triggers) == 0 or n == 0:
+            return []
+
+        seen = self._fired
+        for i in xrange(n - 1):
+            seen |= self._checkpoints.pop()[3]
+        (position, self._previous, self._active, self._fired) = self._checkpoints.pop()
+        self.matcher.seek(position)
+
+        fired = []
+        epochTime = _offset(lastEpochTime, 1 - n)
+        for ch in epochs[-n:]:
+            if ch == UNRECORDED:
+                self.skipGap(1, epochTime)
+            else:
+                fired.extend(self.update(ch, epochTime))
+            epochTime = _offset(epochTime, 1)
+
+        return [t for t in fired if not t.bit & seen]
+
+    def _checkpoint(self):
+        self._checkpoints.append((self.matcher.position(), self._previous,
+            self._active, self._fired))
+
+    def _gateAt(self, epochTime):
+        if epochTime == None:
+            return self._allMask
+        return self._gateMasks[(epochTime % SECONDS_PER_DAY) // 60]
+
+# Moves an epoch time by a number of epochs.  None stays None.
+def _offset(epochTime, epochs):
+    if epochTime == None:
+        return None
+    return epochTime + SECONDS_PER_EPOCH * epochs